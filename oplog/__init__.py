@@ -3,48 +3,163 @@
 #
 # This file is subject to the MIT License (see the LICENSE file).
 
-import ConfigParser
 import os
+import signal
+import socket
 from ops import exceptions
 from ops import utils as ops_utils
 from twisted import plugin
 from twisted.application import service
+from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import stdio
 from twisted.python import log
 from twisted.python import usage
-from txmongo import lazyMongoConnectionPool
 from zope.interface import implements
+from oplog import api
 from oplog import handler
+from oplog import history
+from oplog import index
+from oplog import metrics
+from oplog import mongo
+from oplog import partition
+from oplog import profile
+from oplog import query
+from oplog import search
 from oplog import settings
+from oplog import spool
+from oplog import supervisor
 from oplog import web
 
 class Service(service.Service):
 
-    def __init__(self, settings):
+    def __init__(self, settings, worker=None, workers=0):
         self.settings = settings
+        self.worker = worker
+        self.workers = workers
         self.http_factory = web.Application(handler.route, settings)
+        self.port = None
 
     def startService(self):
         service.Service.startService(self)
 
-        self.http_factory.mongo = lazyMongoConnectionPool(
-            host=self.settings.mongo.host,
-            port=self.settings.mongo.port,
+        client = self.http_factory.mongo = mongo.Client(
+            mongo.hosts(self.settings.mongo.host, self.settings.mongo.port),
+            pool_size=self.settings.mongo.pool_size,
+            timeout=self.settings.mongo.timeout,
+            read_preference=self.settings.mongo.read_preference,
+            metrics=api.Handler.metrics,
         )
+        client.connect().addErrback(log.err, 'Unable to connect to Mongo')
 
-        reactor.listenTCP(
-            port=self.settings.http.port,
-            factory=self.http_factory,
-            interface=self.settings.http.interface,
-        )
+        if self.settings.index.ensure:
+            client.connected.addCallback(self.ensure_indexes)
+
+        if self.settings.spool.path:
+            api.Handler.spool = spool.Spool(
+                # Every worker has its own spool
+                self.settings.spool.path if self.worker is None else \
+                    '%s.%d' % (self.settings.spool.path, self.worker),
+                lambda: api.Handler.partitions.entries(client[self.settings.mongo.database]),
+                batch_size=self.settings.spool.batch_size,
+                interval=self.settings.spool.interval,
+                max_pending=self.settings.spool.max_pending,
+                sync=self.settings.spool.sync,
+                flushed=lambda entries: api.flushed(entries,
+                    client[self.settings.mongo.database] if self.settings.stats.enabled else None),
+                orphans=spool.orphans(self.settings.spool.path, self.worker, self.workers),
+            )
+            # Spooled entries are replayed once Mongo is connected
+            client.connected.addCallback(self.start_spool)
+
+        if self.settings.metrics.enabled and self.settings.metrics.statsd_host:
+            api.Handler.metrics.sink = metrics.Statsd(
+                self.settings.metrics.statsd_host,
+                port=self.settings.metrics.statsd_port,
+                # Workers report separately
+                prefix=self.settings.metrics.statsd_prefix if self.worker is None else \
+                    '%s.worker%d' % (self.settings.metrics.statsd_prefix, self.worker),
+                interval=self.settings.metrics.statsd_interval,
+            )
+            api.Handler.metrics.sink.start()
+
+        self.port = self.listen()
+
+        if self.worker is not None:
+            stdio.StandardIO(supervisor.Channel(), stdin=0, stdout=supervisor.CHANNEL_FD)
+
+        signal.signal(signal.SIGHUP, lambda *args: reactor.callFromThread(self.reload))
+
+    def listen(self):
+        if self.worker is None:
+            return reactor.listenTCP(
+                port=self.settings.http.port,
+                factory=self.http_factory,
+                interface=self.settings.http.interface,
+            )
+        # Workers each listen on the port and the kernel balances connections
+        # between them
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+        sock.bind((self.settings.http.interface, self.settings.http.port))
+        sock.listen(50)
+        sock.setblocking(False)
+        try:
+            return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, self.http_factory)
+        finally:
+            sock.close()
+
+    def ensure_indexes(self, result=None):
+        # Index builds can take longer than any operation should
+        db = self.http_factory.mongo.database(self.settings.mongo.database, timeout=0)
+        d = index.ensure(db, index.configured(self.settings))
+        d.addErrback(log.err, 'Unable to ensure indexes')
+        fields = search.fields(self.settings.search.fields)
+        if fields:
+            d = search.ensure(db, fields, self.settings.search.language)
+            d.addErrback(log.err, 'Unable to ensure search index')
+        if self.settings.history.retention:
+            d = history.ensure(db, self.settings.history.retention)
+            d.addErrback(log.err, 'Unable to ensure history retention')
+        if api.Handler.partitions.enabled:
+            d = api.Handler.partitions.ensure(db)
+            d.addErrback(log.err, 'Unable to ensure partition indexes')
+        return result
+
+    def start_spool(self, result=None):
+        d = api.Handler.spool.start()
+        d.addErrback(log.err, 'Unable to start spool')
+        return result
+
+    def reload(self):
+        log.msg('Reloading schemas')
+        api.Handler.schema.clear()
+        log.msg('Reloading profiles')
+        try:
+            self.settings.general.profile.load()
+        except profile.Error, error:
+            log.err('Unable to reload profiles: %s' % error)
 
+    @defer.inlineCallbacks
     def stopService(self):
         service.Service.stopService(self)
+        # Stop accepting connections and let the requests in progress finish
+        if self.port is not None:
+            yield self.port.stopListening()
+        handler.Stream.close_all()
+        yield self.http_factory.drain(self.settings.http.drain_timeout)
+        if api.Handler.spool is not None:
+            yield api.Handler.spool.stop()
+        if api.Handler.metrics.sink is not None:
+            api.Handler.metrics.sink.stop()
 
 class Options(usage.Options):
 
     optParameters = [ 
         ['config-file', 'c', '/etc/oplog/main.conf', None, unicode],
+        ['workers', 'w', None, 'Number of worker processes (0 serves in the main process)', int],
+        ['worker', None, None, 'Worker number (used by the supervisor)', int],
     ]
 
 class ServiceMaker(object):
@@ -57,15 +172,44 @@ class ServiceMaker(object):
         s = settings.Settings(self.tapname, optparse=False)
         try:
             p = s.parse(config_file=options['config-file'])
-            # Check and parse profile configuration file
-            if not os.path.isfile(p.general.profile):
-                raise exceptions.Error('invalid profile configuration path')
-            config = ConfigParser.ConfigParser()
-            if not config.read([p.general.profile]):
-                raise exceptions.Error('unable to parse profile configuration file')
-            def profile(name, key):
-                return config.has_section(name) and config.has_option(name, 'key') and config.get(name, 'key') == key
-            p.general.profile = profile
-            return Service(p)
-        except (ConfigParser.Error, exceptions.Error), error:
+            for section, name in settings.SERVICE_REQUIRED:
+                if not getattr(getattr(p, section), name):
+                    raise exceptions.Error('%s in %s is required' % (name, section))
+            # Load API keys from the profile configuration file
+            profiles = profile.Profiles(
+                p.general.profile,
+                rate=p.limit.rate,
+                burst=p.limit.burst,
+                quota=p.limit.quota,
+                interval=p.general.profile_interval,
+            )
+            profiles.load()
+            p.general.profile = profiles
+            # Check index configuration
+            try:
+                index.configured(p)
+            except ValueError, error:
+                raise exceptions.Error('invalid index configuration: %s' % error)
+            try:
+                search.fields(p.search.fields)
+            except ValueError, error:
+                raise exceptions.Error('invalid search fields: %s' % error)
+            if p.partition.interval not in partition.INTERVALS:
+                raise exceptions.Error('invalid partition interval: %s' % p.partition.interval)
+            if p.archive.path and not os.path.isdir(p.archive.path):
+                raise exceptions.Error('archive path is not a directory: %s' % p.archive.path)
+            if p.query.guard not in query.MODES:
+                raise exceptions.Error('invalid query guard: %s' % p.query.guard)
+            # Check Mongo configuration
+            try:
+                mongo.hosts(p.mongo.host, p.mongo.port)
+            except ValueError, error:
+                raise exceptions.Error('invalid mongo host: %s' % error)
+            if p.mongo.read_preference not in mongo.READ_PREFERENCES:
+                raise exceptions.Error('invalid mongo read preference: %s' % p.mongo.read_preference)
+            workers = options['workers'] if options['workers'] is not None else p.http.workers
+            if workers > 0 and options['worker'] is None:
+                return supervisor.Supervisor(p, options['config-file'], workers)
+            return Service(p, worker=options['worker'], workers=workers)
+        except (profile.Error, exceptions.Error), error:
             ops_utils.exit(1, error)
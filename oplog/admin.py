@@ -0,0 +1,210 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+import optparse
+import sys
+from ops import exceptions
+from ops import utils as ops_utils
+from twisted.internet import defer
+from twisted.internet import reactor
+from oplog import archive
+from oplog import history
+from oplog import index
+from oplog import mongo
+from oplog import partition
+from oplog import search
+from oplog import settings
+from oplog import stats
+
+USAGE = """%prog [options] COMMAND [ARGS...]
+
+Commands:
+  index list [COLLECTION]
+  index ensure
+  index create COLLECTION FIELD:DIRECTION[,FIELD:DIRECTION...]
+  index drop COLLECTION NAME
+  stats rebuild
+  history migrate
+  partition list
+  partition drop NAME
+  partition migrate
+  archive list
+  archive run"""
+
+class Command(object):
+
+    def __init__(self, settings, db):
+        self.settings = settings
+        self.db = db
+        self.partitions = partition.Router(settings.partition.interval, created=self.ensure_partition)
+
+    def ensure_partition(self, db, name):
+        d = index.ensure(db, {name: index.configured(self.settings)['entry']})
+        fields = search.fields(self.settings.search.fields)
+        if fields:
+            d.addCallback(lambda result: search.ensure(db, fields, self.settings.search.language, collection=name))
+        return d
+
+    def out(self, line=''):
+        sys.stdout.write('%s\n' % line)
+
+    def collection(self, name):
+        if name not in index.COLLECTIONS and not self.partition(name):
+            raise exceptions.Error('unknown collection: %s' % name)
+        return name
+
+    def partition(self, name):
+        return self.partitions.enabled and partition.start(name, self.partitions.interval) is not None
+
+    @defer.inlineCallbacks
+    def index_list(self, collection=None):
+        names = [self.collection(collection)] if collection else index.COLLECTIONS
+        for name in names:
+            information = yield index.information(self.db, name)
+            self.out(name)
+            for index_name, keys in sorted(information.items()):
+                self.out('  %s %s' % (index_name, ','.join(['%s:%s' % key for key in keys])))
+
+    @defer.inlineCallbacks
+    def index_ensure(self):
+        yield index.ensure(self.db, index.configured(self.settings))
+        fields = search.fields(self.settings.search.fields)
+        if fields:
+            yield search.ensure(self.db, fields, self.settings.search.language)
+        if self.settings.history.retention:
+            yield history.ensure(self.db, self.settings.history.retention)
+        if self.partitions.enabled:
+            yield self.partitions.ensure(self.db)
+        yield self.index_list()
+
+    @defer.inlineCallbacks
+    def index_create(self, collection, spec):
+        try:
+            keys = index.parse(spec)
+        except ValueError, error:
+            raise exceptions.Error(error)
+        if len(keys) != 1:
+            raise exceptions.Error('expected a single index: %s' % spec)
+        name = yield index.create(self.db, self.collection(collection), keys[0])
+        self.out('Created %s on %s' % (name, collection))
+
+    @defer.inlineCallbacks
+    def index_drop(self, collection, name):
+        if name == '_id_':
+            raise exceptions.Error('can not drop the _id index')
+        result = yield index.drop(self.db, self.collection(collection), name)
+        if not result.get('ok'):
+            raise exceptions.Error(result.get('errmsg', 'unable to drop index: %s' % name))
+        self.out('Dropped %s from %s' % (name, collection))
+
+    @defer.inlineCallbacks
+    def stats_rebuild(self):
+        names = [partition.BASE]
+        if self.partitions.enabled:
+            yield self.partitions.load(self.db, force=True)
+            names = self.partitions.all()
+        total = yield stats.rebuild(self.db, names=names)
+        # $out only keeps indexes that entry_stats already had
+        yield index.ensure(self.db, {'entry_stats': index.configured(self.settings)['entry_stats']})
+        self.out('Counted %d entries' % total)
+
+    @defer.inlineCallbacks
+    def history_migrate(self):
+        total = yield history.migrate(self.db)
+        self.out('Updated %d history records' % total)
+
+    @defer.inlineCallbacks
+    def partition_list(self):
+        if not self.partitions.enabled:
+            raise exceptions.Error('entries are not partitioned')
+        yield self.partitions.load(self.db, force=True)
+        for name in self.partitions.all():
+            count = yield self.db[name].count()
+            self.out('%s %d' % (name, count))
+
+    @defer.inlineCallbacks
+    def partition_drop(self, name):
+        if not self.partition(name):
+            raise exceptions.Error('not a partition: %s' % name)
+        result = yield partition.drop(self.db, name)
+        if not result.get('ok'):
+            raise exceptions.Error(result.get('errmsg', 'unable to drop partition: %s' % name))
+        self.out('Dropped %s' % name)
+
+    @defer.inlineCallbacks
+    def partition_migrate(self):
+        if not self.partitions.enabled:
+            raise exceptions.Error('entries are not partitioned')
+        yield self.partitions.load(self.db, force=True)
+        total = yield partition.migrate(self.partitions, self.db)
+        self.out('Moved %d entries' % total)
+
+    def archive_path(self):
+        if not self.settings.archive.path:
+            raise exceptions.Error('no archive path is set')
+        return self.settings.archive.path
+
+    def archive_list(self):
+        a = archive.Archive(self.archive_path())
+        a.refresh()
+        for path, segment in sorted(a.segments.items()):
+            self.out('%s %s %s %d' % (path, segment.first.isoformat(), segment.last.isoformat(), segment.count))
+
+    @defer.inlineCallbacks
+    def archive_run(self):
+        path = self.archive_path()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.settings.archive.age)
+        total = yield archive.run(self.partitions.entries(self.db), path, cutoff,
+            block_size=self.settings.archive.block_size)
+        self.out('Archived %d entries' % total)
+
+    def run(self, args):
+        call = getattr(self, '_'.join(args[:2]), None) if len(args) >= 2 else None
+        if call is None:
+            raise exceptions.Error('unknown command: %s' % ' '.join(args))
+        try:
+            return call(*args[2:])
+        except TypeError:
+            raise exceptions.Error('invalid arguments: %s' % ' '.join(args))
+
+def main(args=None):
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option('-c', '--config-file', default='/etc/oplog/main.conf')
+    options, args = parser.parse_args(args)
+
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        s = settings.Settings('oplog', optparse=False).parse(config_file=options.config_file)
+    except exceptions.Error, error:
+        ops_utils.exit(1, error)
+
+    status = {'code': 0}
+
+    @defer.inlineCallbacks
+    def run():
+        client = None
+        try:
+            client = mongo.Client(mongo.hosts(s.mongo.host, s.mongo.port), pool_size=1)
+            yield client.connect()
+            yield mongo.timeout(client.connected, s.mongo.timeout)
+            # Index builds can take longer than any operation should
+            yield Command(s, client.database(s.mongo.database, timeout=0)).run(args)
+        except Exception, error:
+            sys.stderr.write('%s\n' % error)
+            status['code'] = 1
+        if client is not None:
+            yield client.disconnect()
+        reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    sys.exit(status['code'])
+
+if __name__ == '__main__':
+    main()
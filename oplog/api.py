@@ -3,14 +3,27 @@
 #
 # This file is subject to the MIT License (see the LICENSE file).
 
+import base64
 import datetime
 import json
 import os
+import time
 import txmongo
-import validictory
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.python import log
+from oplog import archive
+from oplog import cache
+from oplog import history
+from oplog import hub
+from oplog import index
+from oplog import metrics
+from oplog import partition
+from oplog import query
+from oplog import search
+from oplog import stats
 from oplog import utils
+from oplog import validation
 
 PARSE_ERROR = -32700
 INVALID_REQUEST = -32600
@@ -18,6 +31,10 @@ METHOD_NOT_FOUND = -32601
 INVALID_PARAMS = -32602
 INTERNAL_ERROR = -32603
 SERVER_ERROR = -32099
+RATE_LIMITED = -32098
+
+# Fields every entry has, with a single type
+SEEK_FIELDS = ('_id', '_date', '_type', '_user')
 
 ERRORS = {
     PARSE_ERROR:      'Parse error',      # Invalid JSON was received by the server.
@@ -26,6 +43,7 @@ ERRORS = {
     INVALID_PARAMS:   'Invalid params',   # Invalid method parameter(s).
     INTERNAL_ERROR:   'Internal error',   # Internal JSON-RPC error.
     SERVER_ERROR:     'Server error',     # Reserved for implementation-defined server-errors.
+    RATE_LIMITED:     'Rate limited',     # The app exceeded its rate limit or quota.
 }
 
 class Error(Exception):
@@ -44,8 +62,18 @@ class ServerError(Error):
 
 class Handler(object):
 
-    _schema = {}
-    _schema_list = [os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schema')]
+    schema = validation.Registry([os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schema')])
+    indexes = index.configured()
+    slow_log = query.SlowLog()
+    result_cache = cache.Cache(size=0)
+    feed = hub.Hub()
+    spool = None
+    partitions = partition.Router()
+    archive = archive.Archive()
+    search_fields = ()
+    metrics = metrics.Registry()
+    name = 'unknown'
+    read_only = False
 
     def __init__(self, user, settings, db):
         self.user = user
@@ -56,31 +84,30 @@ class Handler(object):
         log.err('%s (%s): %s' % (message, type(error), error))
         raise ServerError(message)
 
-    def load_schema(self, name):
-        for root in self._schema_list:
-            path = '%s.json' % os.path.join(root, name)
-            if os.path.isfile(path):
-                try:
-                    with open(path) as f:
-                        return json.loads(f.read())
-                except Exception, error:
-                    log.err('Unable to parse schema: %s' % path)
-        log.err('No schema found for: %s' % name)
-
     def validate(self, name, data):
-        if not name in self._schema:
-            schema = self.load_schema(name)
-            if schema:
-                self._schema[name] = schema
-        else:
-            schema = self._schema.get(name)
-        # Only validate if we have a schema defined
-        if schema:
-            try:
-                validictory.validate(data, schema, required_by_default=False)
-            except ValueError, error:
-                log.err('Validation failed because: %s' % error)
-                raise Error(INVALID_PARAMS)
+        # Only validates if we have a schema defined
+        try:
+            # Type schemas are named by the client supplied _type, so they
+            # share a label to keep the number of series bounded
+            label = 'entry.type' if name.startswith('entry.type.') else name
+            with self.metrics.time('oplog_validate_seconds', schema=label):
+                self.schema.validate(name, data)
+        except ValueError, error:
+            log.err('Validation failed because: %s' % error)
+            raise Error(INVALID_PARAMS)
+
+    def encode(self, value, **kwargs):
+        with self.metrics.time('oplog_mongify_seconds', method=self.name, op='encode'):
+            return utils.mongify.encode(value, **kwargs)
+
+    def decode(self, value):
+        with self.metrics.time('oplog_mongify_seconds', method=self.name, op='decode'):
+            return utils.mongify.decode(value)
+
+    def encode_json(self, value):
+        """Encode documents from Mongo straight to an encoded result."""
+        with self.metrics.time('oplog_mongify_seconds', method=self.name, op='json'):
+            return cache.Encoded(utils.mongo_json.encode(value))
 
     @defer.inlineCallbacks
     def __call__(self, params):
@@ -97,12 +124,54 @@ class Handler(object):
 
 class EntryHandler(Handler):
 
-    def backup(self, entry):
-        return self.db.entry_history.insert({
-            'date': datetime.datetime.utcnow(),
-            'body': entry,
-            'type': self.name,
-        })
+    @property
+    def entries(self):
+        """The entry collection, or its partitions."""
+        return self.partitions.entries(self.db)
+
+    def field_types(self):
+        """Return the fields that are stored as Mongo types, as declared by
+        any entry schema. Fields are typed by name alone so writes and
+        queries agree whatever the _type, other strings are guessed."""
+        return self.schema.combined_types([EntryPut.name] + self.schema.names('entry.type.'))
+
+    def invalidate(self, entry):
+        """Drop cached results that could include entry."""
+        self.result_cache.invalidate(entry.get('_type'), entry.get('_user'))
+
+    def parse_date(self, value):
+        return datetime.datetime.strptime(value, utils.DATE_TIME)
+
+    def group_find(self, find):
+        """Return a query for find that only filters on _type and _user (by
+        value or with $in)."""
+        spec = {}
+        for name, value in (find or {}).items():
+            if name not in stats.GROUPS:
+                raise Error(INVALID_PARAMS, 'Only %s can be filtered on' % ', '.join(stats.GROUPS))
+            if isinstance(value, dict) and (value.keys() != ['$in'] or not isinstance(value['$in'], list)):
+                raise Error(INVALID_PARAMS, 'Filters must be a value or $in')
+            spec[name] = value
+        return spec
+
+    def count(self, added=(), removed=()):
+        """Update the entry.stats rollups for entries added and removed."""
+        if not self.settings.stats.enabled:
+            return
+        counts = stats.changes(added, 1)
+        stats.changes(removed, -1, counts)
+        stats.update(self.db, counts)
+
+    def backup(self, old, new=None):
+        """Add old to the history of the entry, as the changes from new (the
+        version that replaced it) or in full if it was deleted."""
+        return self.db.entry_history.insert(history.record(
+            old,
+            new,
+            self.name,
+            snapshot_interval=self.settings.history.snapshot_interval,
+            threshold=self.settings.history.compress_threshold,
+        ))
 
 class EntryDel(EntryHandler):
 
@@ -112,17 +181,20 @@ class EntryDel(EntryHandler):
     def run(self, **values):
         self.validate(self.name, values)
         try:
-            values = utils.mongify.encode(values)
+            values = self.encode(values, types=self.field_types())
 
             # Get old value so we can add to history
-            entry = yield self.db.entry.find_one(values)
+            entry = yield self.entries.find_one(values)
 
             if not entry:
                 raise Error('Entry with id "%s" not found' % values['_id'])
 
-            result = yield self.db.entry.remove(values, safe=True)
+            result = yield self.entries.remove(values, safe=True)
 
             if not result.get('err'):
+                self.invalidate(entry)
+                self.count(removed=[entry])
+                self.feed.publish('del', {'_id': str(entry['_id'])})
                 yield self.backup(entry)
 
             defer.returnValue(result)
@@ -132,6 +204,31 @@ class EntryDel(EntryHandler):
 class EntryGet(EntryHandler):
 
     name = 'entry.get'
+    read_only = True
+
+    @property
+    def entries(self):
+        """The entries, with the archived ones that match a query added."""
+        return self.archive.entries(super(EntryGet, self).entries)
+
+    @defer.inlineCallbacks
+    def __call__(self, params):
+        # Hot queries are answered from the cache of encoded results, the key
+        # is taken before run encodes the find in place
+        key = self.result_cache.key(params)
+        result = self.result_cache.get(key)
+        if result is None:
+            find = params.get('find')
+            tags = cache.tag(find, '_type'), cache.tag(find, '_user')
+            generation = self.result_cache.current(*tags)
+            result = yield self.run(**params)
+            # A secondary can lag behind a write that was just invalidated,
+            # its results would keep the old entries cached for the whole ttl
+            if self.result_cache.enabled and self.settings.mongo.read_preference != 'secondary':
+                if not isinstance(result, cache.Encoded):
+                    result = cache.Encoded.encode(result)
+                self.result_cache.set(key, result, *tags, generation=generation)
+        defer.returnValue({'result': result})
 
     def gen_sort(self, sort):
         if not sort:
@@ -142,7 +239,118 @@ class EntryGet(EntryHandler):
                 f += txmongo.filter.DESCENDING(name)
             elif ordering == 1:
                 f += txmongo.filter.ASCENDING(name)
-        return txmongo.filter.sort(*f) if f else None
+        return txmongo.filter.sort(f) if f else None
+
+    def guard(self, find):
+        """Return the reason find can't use an index (None if it can or the
+        guard is off), unindexed queries are rejected if the guard is set to
+        reject."""
+        if self.settings.query.guard == 'off':
+            return
+        reason = query.unindexed(find, self.indexes.get('entry', []))
+        if reason and self.settings.query.guard == 'reject':
+            log.msg('Rejected unindexed query: %s (%s)' % (reason, find))
+            raise Error(INVALID_PARAMS, 'Query can not use an index: %s' % reason)
+        return reason
+
+    def check_archive(self, find):
+        """Refuse queries that read the archive with operators archived
+        entries can't be matched with."""
+        if not self.archive.enabled or partition.date_range(find) == (None, None):
+            return
+        operator = query.unsupported(find)
+        if operator:
+            raise Error(INVALID_PARAMS, 'Operator not supported on archived entries: %s' % operator)
+
+    def gen_filter(self, sort, unindexed=None):
+        """Return the query filter for sort, with a time limit if the query
+        is unindexed."""
+        f = self.gen_sort(sort)
+        if unindexed and self.settings.query.max_time:
+            limit = query.max_time(self.settings.query.max_time)
+            f = f + limit if f else limit
+        return f
+
+    def encode_find(self, find):
+        if '_id' in find:
+            find['_id'] = txmongo.ObjectId(find['_id'])
+        return self.encode(find, types=self.field_types())
+
+    def seek_sort(self, sort):
+        """Return sort with _id appended so every entry has a unique
+        position."""
+        sort = [(name, ordering) for name, ordering in sort if ordering in (1, -1)]
+        if '_id' not in [name for name, ordering in sort]:
+            sort.append(('_id', sort[-1][1] if sort else 1))
+        return sort
+
+    def seek(self, find, sort, values):
+        """Return find limited to the entries after the position given by the
+        values of the sort fields, this uses the same index as the sort unlike
+        skip which has to walk every skipped entry."""
+        clauses = []
+        for i, (name, ordering) in enumerate(sort):
+            prefix = dict(zip([n for n, o in sort[:i]], values[:i]))
+            # Values of other types (and missing fields, which sort as null)
+            # are only after the position if their type sorts after it, the
+            # base fields always have the same type
+            if name in SEEK_FIELDS and values[i] is not None:
+                conditions = [{'$gt' if ordering == 1 else '$lt': values[i]}]
+            else:
+                conditions = query.after(values[i], ordering)
+            for condition in conditions:
+                clause = dict(prefix)
+                clause[name] = condition
+                clauses.append(clause)
+        if '$or' in find:
+            return {'$and': [find, {'$or': clauses}]}
+        find = dict(find)
+        find['$or'] = clauses
+        return find
+
+    def seek_values(self, entry, sort):
+        return [query.lookup(entry, name) for name, ordering in sort]
+
+    def seek_fields(self, fields, sort):
+        if fields is None:
+            return
+        return list(set(fields) | set([name for name, ordering in sort]))
+
+    def strip_fields(self, entry, fields):
+        if fields is None:
+            return entry
+        return dict([(n, v) for n, v in entry.items() if n == '_id' or n in fields])
+
+    def dump_position(self, entry, sort):
+        """Return an opaque token for the position of entry in sort."""
+        values = []
+        for value in self.seek_values(entry, sort):
+            if isinstance(value, datetime.datetime):
+                values.append(['d', self.decode(value)])
+            elif isinstance(value, txmongo.ObjectId):
+                values.append(['o', str(value)])
+            else:
+                values.append(['v', value])
+        position = json.dumps({'sort': sort, 'values': values})
+        return base64.urlsafe_b64encode(position)
+
+    def load_position(self, token, sort):
+        """Return the sort values stored in a token from dump_position."""
+        try:
+            position = json.loads(base64.urlsafe_b64decode(str(token)))
+            if [list(s) for s in sort] != position['sort']:
+                raise ValueError('sort does not match')
+            values = []
+            for kind, value in position['values']:
+                if kind == 'd':
+                    value = datetime.datetime.strptime(value, utils.DATE_TIME)
+                elif kind == 'o':
+                    value = txmongo.ObjectId(value)
+                values.append(value)
+            return values
+        except Exception, error:
+            log.err('Invalid position token: %s' % error)
+            raise Error(INVALID_PARAMS)
 
     @defer.inlineCallbacks
     def run(self, **values):
@@ -152,90 +360,392 @@ class EntryGet(EntryHandler):
         limit = values.get('limit', 20) # Default to 20 records
         sort = values.get('sort', [])
         fields = values.get('fields')
+        # Pages are requested with the "after" token returned with the
+        # previous page (null for the first page)
+        paging = 'after' in values
+        if paging:
+            sort = self.seek_sort(sort)
+            position = self.load_position(values['after'], sort) if values['after'] else None
+        unindexed = self.guard(find)
         try:
-            sort = self.gen_sort(sort)
-            if '_id' in find:
-                find['_id'] = txmongo.ObjectId(find['_id'])
-            find = utils.mongify.encode(find)
-            results = yield self.db.entry.find(spec=find, skip=skip, limit=limit, filter=sort, fields=fields)
-            defer.returnValue(utils.mongify.decode(list(results)))
+            find = self.encode_find(find)
+            self.check_archive(find)
+            if paging and position:
+                find = self.seek(find, sort, position)
+            start = time.time()
+            results = yield self.entries.find(spec=find, skip=skip, limit=limit,
+                filter=self.gen_filter(sort, unindexed),
+                fields=self.seek_fields(fields, sort) if paging else fields)
+            self.slow_log(start, method=self.name, user=self.user, find=find,
+                sort=sort, skip=skip, limit=limit, unindexed=unindexed)
+            # Results are encoded straight to JSON rather than decoded first
+            if paging:
+                defer.returnValue(self.encode_json({
+                    'entries': [self.strip_fields(entry, fields) for entry in results],
+                    'after': self.dump_position(results[-1], sort) if len(results) == limit else None,
+                }))
+            defer.returnValue(self.encode_json(results))
+        except Error:
+            raise
         except Exception, error:
             log.err('Get entry error: %s' % error)
             raise ServerError('Failed to query entries')
 
-class EntryPut(EntryHandler):
+class EntryStream(EntryGet):
+    """Query entries without a result limit, results are passed to a write
+    function in batches (each encoded as a JSON array) so they never have to
+    be held in memory at once.
 
-    name = 'entry.put'
+    The next batch isn't queried until a Deferred returned by write fires,
+    and the stream stops early if write returns (or its Deferred fires with)
+    False, so a slow or departed client holds back the queries.
+    """
+
+    name = 'entry.stream'
+    streaming = True
+
+    @defer.inlineCallbacks
+    def stream(self, values, write):
+        self.validate(self.name, values)
+        find = values['find']
+        limit = values.get('limit', 0)
+        sort = self.seek_sort(values.get('sort', []))
+        fields = values.get('fields')
+        batch_size = self.settings.api.stream_batch_size
+        unindexed = self.guard(find)
+        try:
+            find = self.encode_find(find)
+            self.check_archive(find)
+            spec = find
+            count = 0
+            while True:
+                size = min(batch_size, limit - count) if limit else batch_size
+                start = time.time()
+                results = yield self.entries.find(
+                    spec=spec,
+                    limit=size,
+                    filter=self.gen_filter(sort, unindexed),
+                    fields=self.seek_fields(fields, sort),
+                )
+                self.slow_log(start, method=self.name, user=self.user, find=spec,
+                    sort=sort, limit=size, unindexed=unindexed)
+                if results:
+                    spec = self.seek(find, sort, self.seek_values(results[-1], sort))
+                    more = yield write(self.encode_json([self.strip_fields(entry, fields) for entry in results]))
+                    if more is False:
+                        break
+                count += len(results)
+                if len(results) < size or (limit and count >= limit):
+                    break
+        except Error:
+            raise
+        except Exception, error:
+            log.err('Stream entry error: %s' % error)
+            raise ServerError('Failed to query entries')
+
+class EntryStats(EntryHandler):
+    """Count entries over time by _type and _user, answered from the
+    entry_stats rollups that are kept up to date as entries are written."""
+
+    name = 'entry.stats'
+    read_only = True
+
+    @defer.inlineCallbacks
+    def run(self, **values):
+        self.validate(self.name, values)
+        unit = values.get('unit', 'hour')
+        group = []
+        for name in values.get('group', ['_type']):
+            if name not in group:
+                group.append(name)
+        start = stats.bucket(self.parse_date(values['start']), unit)
+        end = self.parse_date(values['end']) if 'end' in values else datetime.datetime.utcnow()
+        if end < start:
+            raise Error(INVALID_PARAMS, 'Stats end is before start')
+        if (end - start).total_seconds() / stats.UNITS[unit].total_seconds() > stats.MAX_BUCKETS:
+            raise Error(INVALID_PARAMS, 'Stats are limited to %d %ss' % (stats.MAX_BUCKETS, unit))
+        spec = self.group_find(values.get('find'))
+        spec['unit'] = unit
+        spec['date'] = {'$gte': start, '$lte': end}
+        try:
+            documents = yield self.db.entry_stats.find(spec=spec, fields=['date', 'count'] + group)
+        except Exception, error:
+            log.err('Get stats error: %s' % error)
+            raise ServerError('Failed to query stats')
+        defer.returnValue(self.decode(stats.summarize(documents, group)))
+
+class EntrySearch(EntryHandler):
+    """Find entries by the words in their text fields, ranked by relevance
+    using the text index."""
+
+    name = 'entry.search'
+    read_only = True
+
+    @defer.inlineCallbacks
+    def run(self, **values):
+        self.validate(self.name, values)
+        if not self.search_fields:
+            raise Error(METHOD_NOT_FOUND)
+        words = search.terms(values['q'])
+        if not words:
+            raise Error(INVALID_PARAMS, 'Search has no words to find')
+        skip = values.get('skip', 0)
+        limit = values.get('limit', 20)
+        fields = values.get('fields')
+        spec = self.group_find(values.get('find'))
+        date = {}
+        if 'start' in values:
+            date['$gte'] = self.parse_date(values['start'])
+        if 'end' in values:
+            date['$lte'] = self.parse_date(values['end'])
+        if date:
+            spec['_date'] = date
+        spec['$text'] = {'$search': values['q']}
+        projection = dict([(name, 1) for name in fields]) if fields is not None else {}
+        projection['_score'] = search.SCORE
+        f = search.score()
+        if self.settings.query.max_time:
+            f += query.max_time(self.settings.query.max_time)
+        try:
+            start = time.time()
+            results = yield self.entries.find(spec=spec, skip=skip, limit=limit, filter=f, fields=projection)
+            self.slow_log(start, method=self.name, user=self.user, find=spec, skip=skip, limit=limit)
+            for entry in results:
+                entry['_highlights'] = search.highlights(entry, self.search_fields, words)
+            defer.returnValue(self.encode_json(results))
+        except Exception, error:
+            log.err('Search entry error: %s' % error)
+            raise ServerError('Failed to search entries')
+
+class EntryHistory(EntryHandler):
+    """List the versions in the history of an entry, or rebuild one of
+    them."""
+
+    name = 'entry.history'
 
     @defer.inlineCallbacks
     def run(self, **values):
+        self.validate(self.name, values)
+        try:
+            _id = txmongo.ObjectId(values['_id'])
+        except Exception:
+            raise Error(INVALID_PARAMS, 'Invalid entry id "%s"' % values['_id'])
+        version = values.get('version')
+        try:
+            current = yield self.entries.find_one({'_id': _id})
+            if version is None:
+                records = yield self.db.entry_history.find({'entry': _id}, fields=['version', 'date', 'type'],
+                    filter=txmongo.filter.sort(txmongo.filter.DESCENDING('version')))
+                defer.returnValue(self.decode({
+                    'current': current.get('_version') or 0 if current else None,
+                    'versions': [dict([(n, r.get(n)) for n in ('version', 'date', 'type')]) for r in records],
+                }))
+            # Rebuilding only needs the records up to the next snapshot
+            spec = {'entry': _id, 'version': {'$gte': version}}
+            ascending = txmongo.filter.sort(txmongo.filter.ASCENDING('version'))
+            limit = self.settings.history.snapshot_interval + 1
+            records = yield self.db.entry_history.find(spec, limit=limit, filter=ascending)
+            snapshots = [i for i, r in enumerate(records) if 'body' in r]
+            if snapshots:
+                records = records[:snapshots[0] + 1]
+            elif len(records) == limit:
+                records = yield self.db.entry_history.find(spec, filter=ascending)
+            entry = history.rebuild(list(reversed(records)), current or None, version)
+        except ValueError, error:
+            log.err('Unable to rebuild entry: %s' % error)
+            raise ServerError('History of entry "%s" is incomplete' % _id)
+        except Exception, error:
+            self.err('Failed to get entry history', error)
+        if entry is None:
+            raise Error(INVALID_PARAMS, 'Entry "%s" has no version %d' % (_id, version))
+        defer.returnValue(self.decode(entry))
 
-        def validate(values):
-            # Validate entry.put schema
-            self.validate(self.name, values)
+class EntryPut(EntryHandler):
+
+    name = 'entry.put'
 
-            # Validate type schema
-            if '_type' in values and isinstance(values['_type'], basestring):
-                self.validate('entry.type.%s' % values['_type'], values)
+    def validate_entry(self, values):
+        # Validate entry.put schema
+        self.validate(EntryPut.name, values)
 
+        # Validate type schema
+        if '_type' in values and isinstance(values['_type'], basestring):
+            self.validate('entry.type.%s' % values['_type'], values)
+
+    def new_entry(self, values):
+        # Set default values
+        if not '_date' in values:
+            values['_date'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        # Enforce user
+        values['_user'] = self.user
+
+        self.validate_entry(values)
+
+        return self.encode(values, types=self.field_types())
+
+    @defer.inlineCallbacks
+    def run(self, **values):
         try:
-            # Update if we have an _id, this operation is much less efficient
-            # than an insert because of the read, write and possible second
-            # write hack to get schema validation
+            # Update if we have an _id, the update is applied to the stored
+            # entry in memory so the result can be validated before it is
+            # written, then saved with a conditional update on the entry
+            # version so a concurrent change can't be overwritten. That's two
+            # round trips, the read can't be folded into a findAndModify
+            # since the new entry has to be validated before it is written,
+            # and the history insert isn't acknowledged so it doesn't wait
             if '_id' in values:
                 _id = txmongo.ObjectId(values.pop('_id'))
 
-                # Get old value so we can revert if schema fails or add to
-                # history collection
-                old_entry = yield self.db.entry.find_one({'_id': _id})
+                # Get old value so we can apply the update and add to history
+                # collection
+                old_entry = yield self.entries.find_one({'_id': _id, '_user': self.user})
 
                 if not old_entry:
                     raise Error('Entry with id "%s" not found' % _id)
 
-                result = yield self.db.entry.update(
-                    {'_id': _id, '_user': self.user},
-                    # "clean" encode is relatively naive and probably adds
-                    # little security, but attempts to disallow updates to base
-                    # fields that start with an underscore
-                    utils.mongify.encode(values, clean=True),
+                try:
+                    new_entry = utils.modify.apply(
+                        old_entry,
+                        # "clean" encode is relatively naive and probably adds
+                        # little security, but attempts to disallow updates to
+                        # base fields that start with an underscore
+                        self.encode(values, clean=True, types=self.field_types()),
+                    )
+                except ValueError, error:
+                    log.err('Unable to apply update: %s' % error)
+                    raise Error(INVALID_PARAMS)
+
+                # Base fields can't be changed through update operators either
+                version = old_entry.get('_version')
+                new_entry['_id'] = _id
+                new_entry['_user'] = old_entry['_user']
+                new_entry['_version'] = (version or 0) + 1
+
+                self.validate_entry(self.decode(new_entry))
+
+                result = yield self.entries.update(
+                    {'_id': _id, '_user': self.user, '_version': version},
+                    new_entry,
                     upsert=False,
                     safe=True,
                 )
 
-                # Get updated value so we can validate
-                new_entry = yield self.db.entry.find_one({'_id': _id})
+                if not result.get('n'):
+                    raise ServerError('Entry with id "%s" was modified by another request' % _id)
 
-                try:
-                    validate(utils.mongify.decode(new_entry))
-                except ValueError, error:
-                    _id = old_entry.pop('_id')
-                    yield self.db.entry.update({'_id': _id}, old_entry, upsert=False, safe=True)
-                    raise error
-                else:
-                    yield self.backup(old_entry)
+                self.invalidate(old_entry)
+                self.invalidate(new_entry)
+                self.count(added=[new_entry], removed=[old_entry])
+                self.feed.publish('put', self.decode(new_entry))
+                yield self.backup(old_entry, new_entry)
             else:
-                # Set default values
-                if not '_date' in values:
-                    values['_date'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+                entry = self.new_entry(values)
+                result = yield self.entries.insert(entry, safe=True)
+                self.invalidate(entry)
+                self.count(added=[entry])
+                self.feed.publish('put', self.decode(entry))
 
-                # Enforce user
-                values['_user'] = self.user
+            defer.returnValue(self.decode(result))
+        except Error, error:
+            raise error
+        except Exception, error:
+            self.err('Failed to put entry', error)
 
-                validate(values)
+class EntryPutMany(EntryPut):
 
-                result = yield self.db.entry.insert(utils.mongify.encode(values), safe=True)
+    name = 'entry.put_many'
 
-            defer.returnValue(utils.mongify.decode(result))
+    @defer.inlineCallbacks
+    def run(self, **values):
+        self.validate(self.name, values)
+        try:
+            # Validate every entry before writing any of them so a bad entry
+            # doesn't leave a partial batch behind
+            entries = []
+            for entry in values['entries']:
+                if '_id' in entry:
+                    raise Error(INVALID_PARAMS, 'Entries can not be updated with entry.put_many')
+                entries.append(self.new_entry(entry))
+
+            # One multi-document insert and a single safe acknowledgement
+            result = yield self.entries.insert(entries, safe=True)
+            self.count(added=entries)
+            for entry in entries:
+                self.invalidate(entry)
+                self.feed.publish('put', self.decode(entry))
+
+            defer.returnValue(self.decode(result))
         except Error, error:
             raise error
         except Exception, error:
-            self.err('Failed to put entry', error)
+            self.err('Failed to put entries', error)
+
+class EntryPutAsync(EntryPut):
+    """Validate and spool a new entry, it is written to Mongo in the
+    background."""
+
+    name = 'entry.put_async'
+
+    @defer.inlineCallbacks
+    def run(self, **values):
+        if self.spool is None:
+            raise Error(METHOD_NOT_FOUND)
+        if '_id' in values:
+            raise Error(INVALID_PARAMS, 'Entries can not be updated with entry.put_async')
+        entry = self.new_entry(values)
+        entry['_id'] = txmongo.ObjectId()
+        try:
+            yield self.spool.put(entry)
+        except Exception, error:
+            self.err('Failed to spool entry', error)
+        defer.returnValue(str(entry['_id']))
 
 ROUTE = {
     EntryDel.name: EntryDel,
     EntryGet.name: EntryGet,
+    EntryHistory.name: EntryHistory,
     EntryPut.name: EntryPut,
+    EntryPutAsync.name: EntryPutAsync,
+    EntryPutMany.name: EntryPutMany,
+    EntrySearch.name: EntrySearch,
+    EntryStats.name: EntryStats,
+    EntryStream.name: EntryStream,
 }
 
+def flushed(entries, db=None):
+    """Tell the result cache, stream subscribers and the entry.stats rollups
+    (if db is given) about entries written by the spool."""
+    for entry in entries:
+        Handler.result_cache.invalidate(entry.get('_type'), entry.get('_user'))
+        Handler.feed.publish('put', utils.mongify.decode(entry))
+    if db is not None:
+        stats.update(db, stats.changes(entries))
+
+def database(request, method):
+    """Return the database a method should use, read only methods can be
+    sent to secondaries."""
+    return request.mongo_read if method.read_only else request.mongo
+
+def measure(d, method):
+    """Record the latency and outcome of a message."""
+    start = time.time()
+    def done(result):
+        Handler.metrics.observe('oplog_method_seconds', time.time() - start, method=method.name)
+        Handler.metrics.count('oplog_requests_total', method=method.name)
+        if isinstance(result, failure.Failure):
+            code = result.value.code if isinstance(result.value, Error) else INTERNAL_ERROR
+            Handler.metrics.count('oplog_errors_total', method=method.name, code=code)
+        return result
+    return d.addBoth(done)
+
 def route(user, request, message):
-    return ROUTE.get(message['method'], Handler)(user, request.settings, request.mongo)(message['params'])
+    method = ROUTE.get(message['method'], Handler)
+    return measure(method(user, request.settings, database(request, method))(message['params']), method)
+
+def streaming(message):
+    return getattr(ROUTE.get(message['method']), 'streaming', False)
+
+def stream(user, request, message, write):
+    method = ROUTE[message['method']]
+    return measure(method(user, request.settings, database(request, method)).stream(message['params'], write), method)
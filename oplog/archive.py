@@ -0,0 +1,325 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+import functools
+import glob
+import mmap
+import os
+import struct
+import zlib
+import txmongo
+from twisted.internet import defer
+from twisted.python import log
+from txmongo._pymongo import bson
+from oplog import partition
+from oplog import query
+
+# Segment files start and end with MAGIC, the end is preceded by the offset
+# of the index
+MAGIC = 'OPLOGSG1'
+TRAILER = struct.Struct('<Q8s')
+
+EXTENSION = '.seg'
+
+class Error(Exception): pass
+
+def documents(data):
+    """Return the BSON documents in data."""
+    result = []
+    position = 0
+    while position < len(data):
+        length = struct.unpack('<i', data[position:position + 4])[0]
+        result.append(bson.BSON(data[position:position + length]).to_dict())
+        position += length
+    return result
+
+class Writer(object):
+    """A segment file written a block at a time.
+
+    The file is written under a temporary name and only renamed to its
+    final path by close, once it is synced, so a segment is never seen
+    half written.
+    """
+
+    def __init__(self, tmp):
+        self.tmp = tmp
+        self.blocks = []
+        self.first = None
+        self.last = None
+        self.count = 0
+        self._file = open(tmp, 'wb')
+        self._file.write(MAGIC)
+
+    def add(self, block):
+        """Append a compressed block of entries (sorted by _date)."""
+        data = zlib.compress(''.join([bson.BSON.from_dict(entry) for entry in block]))
+        self.blocks.append({
+            'first': block[0]['_date'],
+            'last': block[-1]['_date'],
+            'offset': self._file.tell(),
+            'length': len(data),
+            'count': len(block),
+        })
+        self._file.write(data)
+        if self.first is None:
+            self.first = block[0]['_date']
+        self.last = block[-1]['_date']
+        self.count += len(block)
+
+    def close(self, path):
+        """Write the index, sync the file and rename it to path."""
+        offset = self._file.tell()
+        self._file.write(bson.BSON.from_dict({
+            'first': self.first,
+            'last': self.last,
+            'count': self.count,
+            'blocks': self.blocks,
+        }))
+        self._file.write(TRAILER.pack(offset, MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self.tmp, path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+def write(path, entries, block_size=256):
+    """Write entries (sorted by _date) to a segment file at path.
+
+    Entries are stored in zlib compressed blocks of block_size entries,
+    followed by an index of the _date range of every block.
+    """
+    writer = Writer(path + '.tmp')
+    try:
+        for i in xrange(0, len(entries), block_size):
+            writer.add(entries[i:i + block_size])
+        writer.close(path)
+    except Exception:
+        writer.abort()
+        raise
+
+class Segment(object):
+    """A segment file, read through mmap so only the blocks a query needs
+    are paged in."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._map) < len(MAGIC) + TRAILER.size or self._map[:len(MAGIC)] != MAGIC:
+                raise Error('not a segment file: %s' % path)
+            offset, magic = TRAILER.unpack(self._map[-TRAILER.size:])
+            if magic != MAGIC:
+                raise Error('truncated segment file: %s' % path)
+            index = bson.BSON(self._map[offset:-TRAILER.size]).to_dict()
+        except Exception:
+            self._map.close()
+            raise
+        self.first = index['first']
+        self.last = index['last']
+        self.count = index['count']
+        self.blocks = index['blocks']
+
+    def close(self):
+        self._map.close()
+
+    def overlaps(self, low, high):
+        return (low is None or self.last >= low) and (high is None or self.first <= high)
+
+    def blocks_in(self, low=None, high=None):
+        """Return the blocks that overlap the _date range low to high."""
+        return [block for block in self.blocks
+            if (low is None or block['last'] >= low) and (high is None or block['first'] <= high)]
+
+    def read(self, block, spec):
+        """Return the entries in block that match spec."""
+        data = zlib.decompress(self._map[block['offset']:block['offset'] + block['length']])
+        return [entry for entry in documents(data) if query.match(entry, spec)]
+
+    def find(self, spec, low=None, high=None):
+        """Return the entries that match spec in the blocks that overlap the
+        _date range low to high."""
+        results = []
+        for block in self.blocks_in(low, high):
+            results.extend(self.read(block, spec))
+        return results
+
+class Archive(object):
+    """The segment files in a directory.
+
+    Segments are listed again whenever the directory changes. Only queries
+    with a _date condition that overlaps the archived dates read them.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.segments = {}
+        self._mtime = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def entries(self, collection):
+        """Return collection with the archive added to its queries."""
+        return Entries(self, collection) if self.enabled else collection
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        paths = set(glob.glob(os.path.join(self.path, '*' + EXTENSION))) if mtime else set()
+        for path in set(self.segments) - paths:
+            self.segments.pop(path).close()
+        for path in paths - set(self.segments):
+            try:
+                self.segments[path] = Segment(path)
+            except Exception, error:
+                log.err('Unable to open archive segment: %s' % error)
+
+    def find(self, spec, limit=0, filter=None):
+        """Return the archived entries that match spec in the sort order of
+        filter.
+
+        With a limit only the first limit entries are kept and, when the
+        sort starts with _date, blocks are read in _date order until no
+        later block can have an entry that sorts before the last one kept,
+        so a page never reads more of the archive than it has to.
+        """
+        low, high = partition.date_range(spec)
+        if low is None and high is None:
+            return []
+        self.refresh()
+        blocks = [(segment, block) for path, segment in sorted(self.segments.items())
+            if segment.overlaps(low, high) for block in segment.blocks_in(low, high)]
+        sort = partition.orderby(filter)
+        dated = bool(sort) and sort[0][0] == '_date'
+        descending = dated and sort[0][1] == -1
+        if dated:
+            blocks.sort(key=lambda (segment, block): block['last'] if descending else block['first'],
+                reverse=descending)
+        results = []
+        for segment, block in blocks:
+            if limit and len(results) >= limit:
+                if not sort:
+                    break
+                if dated:
+                    edge = results[limit - 1]['_date']
+                    if (block['last'] < edge) if descending else (block['first'] > edge):
+                        break
+            results.extend(segment.read(block, spec))
+            if limit and sort:
+                results.sort(cmp=functools.partial(partition.compare, sort))
+                del results[limit:]
+        return results[:limit] if limit else results
+
+class Entries(object):
+    """A collection whose queries also return the archived entries that
+    match them."""
+
+    def __init__(self, archive, collection):
+        self.archive = archive
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def project(self, entry, fields):
+        if fields is None:
+            return entry
+        names = set([name.split('.')[0] for name in fields])
+        return dict([(n, v) for n, v in entry.items() if n == '_id' or n in names])
+
+    @defer.inlineCallbacks
+    def find(self, spec=None, skip=0, limit=0, fields=None, filter=None):
+        spec = spec if spec is not None else {}
+        archived = self.archive.find(spec, limit=skip + limit if limit else 0, filter=filter)
+        if not archived:
+            results = yield self.collection.find(spec=spec, skip=skip, limit=limit, fields=fields, filter=filter)
+            defer.returnValue(results)
+        fields, extra = partition.sort_fields(fields, filter)
+        results = yield self.collection.find(spec=spec, limit=skip + limit if limit else 0,
+            fields=fields, filter=filter)
+        # Entries that are still in Mongo (an archive run that didn't
+        # finish) are only returned once
+        seen = set([entry['_id'] for entry in results])
+        unique = []
+        for entry in archived:
+            if entry['_id'] not in seen:
+                seen.add(entry['_id'])
+                unique.append(self.project(entry, fields))
+        defer.returnValue(partition.merge([results, unique], filter, skip, limit, extra))
+
+def name(first, last):
+    return '%s-%s-%s%s' % (
+        first.strftime('%Y%m%dT%H%M%S'),
+        last.strftime('%Y%m%dT%H%M%S'),
+        txmongo.ObjectId(),
+        EXTENSION,
+    )
+
+@defer.inlineCallbacks
+def remove(collection, ids):
+    for i in xrange(0, len(ids), 1000):
+        yield collection.remove({'_id': {'$in': ids[i:i + 1000]}}, safe=True)
+
+@defer.inlineCallbacks
+def run(collection, path, cutoff, block_size=256, segment_size=100000):
+    """Move the entries dated before cutoff from collection to segment files
+    in path, a segment per month (or per segment_size entries of a month).
+    Returns the number of entries moved.
+
+    A month is read in (_date, _id) order a block at a time and each block
+    is written as it arrives, so only the ids of the current segment are
+    kept in memory. Entries are removed once their segment is written, so
+    an interrupted run can leave entries in both (which queries only
+    return once).
+    """
+    total = 0
+    ascending = txmongo.filter.sort(txmongo.filter.ASCENDING('_date'))
+    order = txmongo.filter.sort(txmongo.filter.ASCENDING('_date') + txmongo.filter.ASCENDING('_id'))
+    while True:
+        oldest = yield collection.find({'_date': {'$lt': cutoff}}, limit=1, filter=ascending)
+        if not oldest:
+            break
+        start = oldest[0]['_date']
+        start = datetime.datetime(start.year, start.month, 1)
+        month = {'_date': {'$gte': start, '$lt': min(partition.following(start, 'month'), cutoff)}}
+        spec = month
+        writer, ids, moved = None, [], 0
+        try:
+            while True:
+                block = yield collection.find(spec, limit=block_size, filter=order)
+                if block:
+                    if writer is None:
+                        writer = Writer(os.path.join(path, '%s.tmp' % txmongo.ObjectId()))
+                    writer.add(block)
+                    ids.extend([entry['_id'] for entry in block])
+                    last = block[-1]
+                    spec = dict(month, **{'$or': [{'_date': {'$gt': last['_date']}},
+                        {'_date': last['_date'], '_id': {'$gt': last['_id']}}]})
+                if writer is not None and (len(block) < block_size or writer.count >= segment_size):
+                    writer.close(os.path.join(path, name(writer.first, writer.last)))
+                    writer = None
+                    yield remove(collection, ids)
+                    moved += len(ids)
+                    ids = []
+                if len(block) < block_size:
+                    break
+        finally:
+            if writer is not None:
+                writer.abort()
+        log.msg('Archived %d entries from %s' % (moved, start.strftime('%Y-%m')))
+        total += moved
+    defer.returnValue(total)
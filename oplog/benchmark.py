@@ -0,0 +1,395 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import copy
+import json
+import math
+import optparse
+import sys
+import time
+from ops import exceptions
+from ops import utils as ops_utils
+from twisted.internet import defer
+from twisted.internet import reactor
+from huck import http
+import txmongo
+from oplog import api
+from oplog import handler
+from oplog import mongo
+from oplog import query
+from oplog import settings
+from oplog import utils
+from oplog import web
+
+USAGE = """%%prog [options] [BENCHMARK...]
+
+Benchmarks:
+  %s"""
+
+# Allowed slowdown against the baseline before a benchmark fails
+TOLERANCE = 0.2
+
+USER = 'benchmark'
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values (nearest rank)."""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+class Collection(object):
+    """In-memory stand-in for the parts of a txmongo collection the API
+    uses, so the hot path can be measured without a server."""
+
+    def __init__(self, name):
+        self._collection_name = name
+        self.documents = {}
+
+    def __str__(self):
+        return 'benchmark.%s' % self._collection_name
+
+    def _project(self, document, fields):
+        if not fields:
+            return copy.deepcopy(document)
+        if isinstance(fields, dict):
+            fields = [name for name, include in fields.items() if include]
+        result = {'_id': document['_id']}
+        for name in fields:
+            if name in document:
+                result[name] = copy.deepcopy(document[name])
+        return result
+
+    def find(self, spec=None, skip=0, limit=0, fields=None, filter=None):
+        results = [d for d in self.documents.values() if query.match(d, spec or {})]
+        if filter and 'orderby' in filter:
+            for name, direction in reversed(filter['orderby']):
+                results.sort(key=lambda d: query.lookup(d, name), reverse=direction < 0)
+        results = results[skip:]
+        if limit:
+            results = results[:abs(limit)]
+        return defer.succeed([self._project(d, fields) for d in results])
+
+    def find_one(self, spec=None, fields=None):
+        if isinstance(spec, txmongo.ObjectId):
+            spec = {'_id': spec}
+        d = self.find(spec, limit=1, fields=fields)
+        d.addCallback(lambda results: results[0] if results else {})
+        return d
+
+    def count(self, spec=None):
+        return defer.succeed(len([d for d in self.documents.values() if query.match(d, spec or {})]))
+
+    def insert(self, docs, safe=False):
+        single = isinstance(docs, dict)
+        ids = []
+        for doc in [docs] if single else docs:
+            doc['_id'] = doc.get('_id', txmongo.ObjectId())
+            self.documents[doc['_id']] = copy.deepcopy(doc)
+            ids.append(doc['_id'])
+        return defer.succeed(ids[0] if single else ids)
+
+    def update(self, spec, document, upsert=False, multi=False, safe=False):
+        matched = [d for d in self.documents.values() if query.match(d, spec)]
+        if not multi:
+            matched = matched[:1]
+        for old in matched:
+            if any(name.startswith('$') for name in document):
+                new = utils.modify.apply(old, document)
+            else:
+                new = copy.deepcopy(document)
+            new['_id'] = old['_id']
+            self.documents[old['_id']] = new
+        if not matched and upsert:
+            if any(name.startswith('$') for name in document):
+                # Operators are applied to the equality fields of the spec
+                base = dict([(n, v) for n, v in spec.items() if not n.startswith('$') and
+                    not (isinstance(v, dict) and v and v.keys()[0].startswith('$'))])
+                self.insert(utils.modify.apply(base, document))
+            else:
+                self.insert(dict(document))
+        return defer.succeed({'ok': 1.0, 'err': None, 'n': len(matched) or int(upsert),
+            'updatedExisting': bool(matched)})
+
+    def remove(self, spec, safe=False):
+        if isinstance(spec, txmongo.ObjectId):
+            spec = {'_id': spec}
+        matched = [d['_id'] for d in self.documents.values() if query.match(d, spec)]
+        for _id in matched:
+            del self.documents[_id]
+        return defer.succeed({'ok': 1.0, 'err': None, 'n': len(matched)})
+
+    def drop(self, safe=False):
+        self.documents.clear()
+        return defer.succeed({'ok': 1.0, 'err': None})
+
+class Database(object):
+
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = Collection(name)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+def entry(number, size=1):
+    """Return a realistic entry, size scales the number of nested
+    fields."""
+    result = {
+        '_type': ('deploy', 'release', 'incident')[number % 3],
+        '_date': '2011-%02d-%02dT%02d:%02d:00Z' % (number % 12 + 1, number % 28 + 1, number % 24, number % 60),
+        'summary': 'Deployed build %d of service-%d to production' % (number, number % 10),
+        'description': 'Rolled out to the web tier after the canary finished.\n' * 4,
+        'service': 'service-%d' % (number % 10),
+        'build': number,
+        'success': number % 7 != 0,
+        'ticket': '4d433c461f485171140%05d' % (number % 100000),
+    }
+    # Deploy manifests carry a file list
+    result['manifest'] = [
+        {'path': '/srv/service/lib/module%d.py' % i, 'sha': '%024x' % (number * 1000 + i)}
+        for i in range(size * 10)
+    ]
+    result['tags'] = ['production', 'web', 'service-%d' % (number % 10)]
+    for i in range(size):
+        result['host%d' % i] = {
+            'name': 'web%02d.example.org' % i,
+            'started': '2011-01-28T21:%02d:34Z' % (i % 60),
+            'finished': '2011-01-28T22:%02d:34Z' % (i % 60),
+            'checks': {'http': 'ok', 'latency': 0.01 * i, 'version': '1.%d' % i},
+        }
+    return result
+
+class Result(object):
+
+    def __init__(self, name, latencies, elapsed):
+        self.name = name
+        latencies = sorted(latencies)
+        self.count = len(latencies)
+        self.throughput = self.count / elapsed if elapsed else 0.0
+        self.p50 = percentile(latencies, 50)
+        self.p99 = percentile(latencies, 99)
+
+    def compare(self, baseline, tolerance=TOLERANCE):
+        """Return the ways this result regressed against a baseline."""
+        problems = []
+        for name in ('p50', 'p99'):
+            if name in baseline and getattr(self, name) > baseline[name] * (1 + tolerance):
+                problems.append('%s %.3fms > %.3fms' % (name, getattr(self, name) * 1000, baseline[name] * 1000))
+        if 'throughput' in baseline and self.throughput < baseline['throughput'] * (1 - tolerance):
+            problems.append('throughput %.0f/s < %.0f/s' % (self.throughput, baseline['throughput']))
+        return problems
+
+    def dump(self):
+        return {'throughput': self.throughput, 'p50': self.p50, 'p99': self.p99}
+
+    def __str__(self):
+        return '%-16s %8d %10.0f/s %9.3fms %9.3fms' % (
+            self.name, self.count, self.throughput, self.p50 * 1000, self.p99 * 1000)
+
+class Connection(object):
+    """Stand-in for the HTTP connection of a request."""
+
+    xheaders = False
+    no_keep_alive = False
+
+    def __init__(self):
+        self.data = []
+        self.finished = defer.Deferred()
+
+    def write(self, chunk):
+        self.data.append(chunk)
+
+    def finish(self):
+        self.finished.callback(''.join(self.data))
+
+    def notifyFinish(self):
+        return defer.Deferred()
+
+class Api(handler.Api):
+
+    def get_current_user(self):
+        return USER
+
+class Client(object):
+    """Hands the benchmark database to request handlers."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return self.db
+
+    def database(self, name, read=False, timeout=None):
+        return self.db
+
+class Benchmark(object):
+    """Runs each API method against a database and measures it.
+
+    The database is either the in-memory stand-in (which measures the
+    time spent in oplog itself) or a local Mongo server.
+    """
+
+    names = ('mongify.encode', 'mongify.decode', 'entry.put', 'entry.get', 'entry.del', 'api.batch')
+
+    def __init__(self, settings, db, iterations=1000, size=10, seed=1000):
+        self.settings = settings
+        self.db = db
+        self.iterations = iterations
+        self.size = size
+        self.seed = seed
+        self.application = web.Application([(r'/api', Api)], settings)
+        self.application.mongo = Client(db)
+        self.ids = []
+
+    def handler(self, cls):
+        return cls(USER, self.settings, self.db)
+
+    @defer.inlineCallbacks
+    def setup(self, count):
+        yield self.db.entry.drop(safe=True)
+        yield self.db.entry_history.drop(safe=True)
+        yield self.db.entry_stats.drop(safe=True)
+        entries = [utils.mongify.encode(dict(entry(i, self.size), _user=USER)) for i in range(count)]
+        self.ids = yield self.db.entry.insert(entries, safe=True)
+
+    @defer.inlineCallbacks
+    def measure(self, name, call):
+        latencies = []
+        start = time.time()
+        for i in xrange(self.iterations):
+            call_start = time.time()
+            yield call(i)
+            latencies.append(time.time() - call_start)
+        defer.returnValue(Result(name, latencies, time.time() - start))
+
+    def mongify_encode(self, i):
+        utils.mongify.encode(entry(i, self.size))
+
+    def mongify_decode(self, i):
+        utils.mongify.decode(self.encoded)
+
+    def entry_put(self, i):
+        return self.handler(api.EntryPut)(entry(i, self.size))
+
+    def entry_get(self, i):
+        return self.handler(api.EntryGet)({
+            'find': {'_type': ('deploy', 'release', 'incident')[i % 3]},
+            'sort': [['_date', -1]],
+            'limit': 20,
+        })
+
+    def entry_del(self, i):
+        return self.handler(api.EntryDel)({'_id': str(self.ids[i % len(self.ids)])})
+
+    def api_batch(self, i):
+        body = json.dumps([
+            {'method': 'entry.put', 'params': entry(i * 10 + n, self.size)}
+            for n in range(10)
+        ])
+        request = http.Request('POST', '/api', body=body, connection=Connection())
+        api_handler = Api(self.application, request)
+        api_handler._execute([])
+        def check(response):
+            if api_handler._status_code != 200:
+                raise exceptions.Error('batch request failed: %s' % response)
+        return request.connection.finished.addCallback(check)
+
+    @defer.inlineCallbacks
+    def run(self, names=None):
+        results = []
+        yield self.setup(self.seed)
+        self.encoded = utils.mongify.encode(entry(0, self.size))
+        for name in names or self.names:
+            if name == 'entry.del':
+                # Every iteration needs an entry to delete
+                yield self.setup(max(self.seed, self.iterations))
+            call = getattr(self, name.replace('.', '_'))
+            result = yield self.measure(name, lambda i: defer.maybeDeferred(call, i))
+            results.append(result)
+        defer.returnValue(results)
+
+def command(args=None, out=None):
+    """Run the benchmarks given on the command line args, returns a Deferred
+    that fires with the exit status. Results are written to out (stdout by
+    default)."""
+    out = out or sys.stdout
+    parser = optparse.OptionParser(usage=USAGE % '\n  '.join(Benchmark.names))
+    parser.add_option('-c', '--config-file', help='read settings (and the Mongo server) from FILE')
+    parser.add_option('-m', '--mongo', action='store_true', help='run against the configured Mongo server')
+    parser.add_option('-n', '--iterations', type='int', default=1000)
+    parser.add_option('-s', '--size', type='int', default=10, help='number of nested fields in entries')
+    parser.add_option('-b', '--baseline', help='fail if results regress against FILE')
+    parser.add_option('-t', '--tolerance', type='float', default=TOLERANCE)
+    parser.add_option('-w', '--write', help='write results to FILE (to use as a baseline)')
+    options, args = parser.parse_args(args)
+
+    for name in args:
+        if name not in Benchmark.names:
+            parser.error('unknown benchmark: %s' % name)
+
+    try:
+        s = settings.Settings('oplog', optparse=False).parse(config_file=options.config_file)
+        baseline = {}
+        if options.baseline:
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+    except (IOError, ValueError, exceptions.Error), error:
+        ops_utils.exit(1, error)
+    s.general.profile = None
+    # Measure oplog, not its caches
+    s.cache.size = 0
+
+    @defer.inlineCallbacks
+    def run():
+        code = 0
+        client = None
+        try:
+            if options.mongo:
+                client = mongo.Client(mongo.hosts(s.mongo.host, s.mongo.port), pool_size=s.mongo.pool_size)
+                yield client.connect()
+                yield mongo.timeout(client.connected, s.mongo.timeout)
+                db = client['%s_benchmark' % s.mongo.database]
+            else:
+                db = Database()
+            benchmark = Benchmark(s, db, iterations=options.iterations, size=options.size)
+            results = yield benchmark.run(args)
+            out.write('%-16s %8s %12s %11s %11s\n' % ('benchmark', 'count', 'throughput', 'p50', 'p99'))
+            for result in results:
+                problems = result.compare(baseline.get(result.name, {}), options.tolerance)
+                out.write('%s%s\n' % (result, '  REGRESSED: ' + ', '.join(problems) if problems else ''))
+                if problems:
+                    code = 2
+            if options.write:
+                with open(options.write, 'w') as f:
+                    json.dump(dict((r.name, r.dump()) for r in results), f, indent=2, sort_keys=True)
+        except Exception, error:
+            sys.stderr.write('%s\n' % error)
+            code = 1
+        if client is not None:
+            yield client.disconnect()
+        defer.returnValue(code)
+
+    return run()
+
+def main(args=None):
+    status = {'code': 0}
+
+    def done(code):
+        status['code'] = code
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: command(args).addCallback(done))
+    reactor.run()
+    sys.exit(status['code'])
+
+if __name__ == '__main__':
+    main()
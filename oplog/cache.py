@@ -0,0 +1,125 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import collections
+import json
+import time
+from huck import utils
+
+class Encoded(str):
+    """A result that has already been JSON encoded."""
+
+    @classmethod
+    def encode(cls, value):
+        return cls(utils.json.encode(value))
+
+def encode(data):
+    """JSON encode a response, results that are already encoded are written
+    as is."""
+    if isinstance(data, dict) and isinstance(data.get('result'), Encoded):
+        return '{"result": %s}' % data['result']
+    return utils.json.encode(data)
+
+def tag(find, name):
+    """Return the value find matches name against, or None if it isn't
+    limited to a single value."""
+    value = find.get(name) if isinstance(find, dict) else None
+    return value if isinstance(value, basestring) else None
+
+class Cache(object):
+    """LRU cache of encoded query results that expire after ttl seconds.
+
+    Results are tagged with the entry type and user their query is limited to
+    (None for any) so a write only has to invalidate the results it could
+    change. Invalidation also bumps the generation of the tags it drops, a
+    result computed while a write to its tags happened isn't stored (writes
+    to other types don't keep it out).
+
+    If relay is set it is called with every invalidation made in this
+    process, so they can be passed on to the caches of other processes.
+    """
+
+    relay = None
+
+    def __init__(self, size=1000, ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self._cleared = 0
+        self._generations = {}
+        self._items = collections.OrderedDict()
+        self._types = {}
+
+    @property
+    def enabled(self):
+        return self.size > 0 and self.ttl > 0
+
+    def key(self, params):
+        return json.dumps(params, sort_keys=True)
+
+    def current(self, _type=None, user=None):
+        """Return the generation of results tagged with type and user, pass
+        it to set to only store a result if no write could have changed it
+        since."""
+        return max(self._generations.get((_type, user), 0), self._cleared)
+
+    def get(self, key):
+        item = self._items.pop(key, None)
+        if item is None:
+            return
+        expires, _type, user, value = item
+        if expires < time.time():
+            self._discard(key, _type)
+            return
+        # Move to the end so the least recently used item is first
+        self._items[key] = item
+        return value
+
+    def set(self, key, value, _type=None, user=None, generation=None):
+        if not self.enabled:
+            return
+        if generation is not None and generation != self.current(_type, user):
+            return
+        if key in self._items:
+            self._discard(key, self._items[key][1])
+        while len(self._items) >= self.size:
+            old_key, item = self._items.popitem(last=False)
+            self._discard(old_key, item[1])
+        self._items[key] = (time.time() + self.ttl, _type, user, value)
+        self._types.setdefault(_type, set()).add(key)
+
+    def _discard(self, key, _type):
+        self._items.pop(key, None)
+        keys = self._types.get(_type)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._types[_type]
+
+    def invalidate(self, _type=None, user=None, relay=True):
+        """Drop results that could include an entry of type and user."""
+        if relay and self.relay is not None:
+            self.relay(_type, user)
+        if _type is not None and not isinstance(_type, basestring):
+            # Array types match queries for any of their values
+            return self.clear()
+        self.generation += 1
+        # The tags of the results that could include the entry
+        for tags in ((None, None), (_type, None), (None, user), (_type, user)):
+            self._generations[tags] = self.generation
+        keys = set(self._types.get(None, ()))
+        if _type is not None:
+            keys.update(self._types.get(_type, ()))
+        for key in keys:
+            item = self._items.get(key)
+            if item is not None and item[2] in (None, user):
+                self._discard(key, item[1])
+
+    def clear(self):
+        self.generation += 1
+        self._cleared = self.generation
+        self._generations.clear()
+        self._items.clear()
+        self._types.clear()
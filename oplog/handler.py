@@ -3,9 +3,17 @@
 #
 # This file is subject to the MIT License (see the LICENSE file).
 
+import math
 from twisted.internet import defer
+from twisted.internet import interfaces
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import log
+from zope.interface import implements
 from huck import utils
 from oplog import api
+from oplog import cache
+from oplog import metrics
 from oplog import web
 
 class Error(Exception): pass
@@ -22,12 +30,66 @@ class Home(web.Handler):
     def get(self):
         self.render('home.html')
 
+class Backpressure(object):
+    """Streaming producer registered with a connection's transport, so a
+    writer can wait for the client to take what was written before it
+    writes more."""
+    implements(interfaces.IPushProducer)
+
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+        self._waiting = []
+
+    def wait(self):
+        """Return a Deferred that fires with False if the connection is gone
+        and True once the transport wants more data."""
+        if self.paused and not self.stopped:
+            d = defer.Deferred()
+            self._waiting.append(d)
+            return d
+        return defer.succeed(not self.stopped)
+
+    def _release(self):
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(not self.stopped)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._release()
+
+    def stopProducing(self):
+        self.stopped = True
+        self._release()
+
 class Api(web.Handler):
 
+    response_bytes = 0
+    retry_after = 1
+    aborted = False
+
+    def write(self, chunk):
+        if isinstance(chunk, str):
+            self.response_bytes += len(chunk)
+        super(Api, self).write(chunk)
+
+    def finish(self, chunk=None):
+        # Nothing more can be sent on an aborted connection
+        if self.aborted:
+            return
+        super(Api, self).finish(chunk)
+        api.Handler.metrics.observe('oplog_response_bytes', self.response_bytes, buckets=metrics.BYTES)
+
     def get_error_html(self, status_code, **kwargs):
         if hasattr(self, 'error'):
             code = self.error.code
             message = unicode(self.error)
+            if code == api.RATE_LIMITED:
+                self.set_header('Retry-After', str(max(int(math.ceil(self.retry_after)), 1)))
         else:
             code = api.INTERNAL_ERROR
             message = api.ERRORS.get(code)
@@ -41,35 +103,221 @@ class Api(web.Handler):
         if not isinstance(message.get('params'), dict):
             raise api.Error(api.INVALID_REQUEST)
 
+    def limit(self, user, count=1):
+        """Take count requests from the limits of the app making the request,
+        logged in users aren't limited."""
+        if not (user.startswith('[') and user.endswith(']')):
+            return
+        profiles = self.settings.general.profile
+        app = user[1:-1]
+        reason = profiles.limit(app, count)
+        if reason:
+            log.msg('Refused request from %s: %s' % (user, reason))
+            self.retry_after = profiles.wait(app, count)
+            raise api.Error(api.RATE_LIMITED, reason.capitalize(), http_code=503)
+
+    def check_batch(self, user, size):
+        """Refuse a batch larger than the app could ever make at once, no
+        amount of waiting would let it through."""
+        if not (user.startswith('[') and user.endswith(']')):
+            return
+        largest = self.settings.general.profile.largest(user[1:-1])
+        if largest is not None and size > largest:
+            raise api.Error(api.INVALID_REQUEST, 'Batches are limited to %d messages' % largest)
+
+    def batch_error(self, failure):
+        if failure.check(api.Error):
+            code = failure.value.code
+            message = unicode(failure.value)
+        else:
+            log.err(failure)
+            code = api.INTERNAL_ERROR
+            message = api.ERRORS.get(code)
+        return {'error': {'code': code, 'message': message}}
+
+    def route_batch(self, user, container):
+        """Route batch messages concurrently, results are returned in request
+        order and failed messages are replaced with their error."""
+        semaphore = defer.DeferredSemaphore(self.settings.api.batch_concurrency)
+        deferreds = []
+        for message in container:
+            d = semaphore.run(api.route, user, self, message)
+            d.addErrback(self.batch_error)
+            deferreds.append(d)
+        return defer.gatherResults(deferreds)
+
+    @defer.inlineCallbacks
+    def stream(self, user, message):
+        """Write a result list to the client as each batch of results
+        arrives, the next batch waits until the client has taken the last
+        one."""
+        state = {'started': False, 'flushed': False}
+        # There's no Content-Length, the client sees the end of the result
+        # when the connection closes
+        self.set_header('Connection', 'close')
+        self.request.connection.no_keep_alive = True
+        transport = self.request.connection.transport
+        producer = Backpressure()
+        transport.registerProducer(producer, True)
+
+        def write(results):
+            if producer.stopped:
+                return False
+            # Each batch is an encoded array, only its items are written
+            if len(results) > 2:
+                self.write(',' if state['started'] else '{"result": [')
+                self.write(results[1:-1])
+                state['started'] = True
+            self.flush()
+            state['flushed'] = True
+            return producer.wait()
+
+        try:
+            yield api.stream(user, self, message, write)
+        except Exception, error:
+            if not state['flushed']:
+                raise
+            # The status and part of the result are already sent, dropping
+            # the connection is all that's left to tell the client
+            log.err('Stream failed after the response started: %s' % error)
+            self.aborted = True
+            transport.abortConnection()
+            return
+        finally:
+            if not producer.stopped:
+                transport.unregisterProducer()
+        self.write(']}' if state['started'] else '{"result": []}')
+
     @defer.inlineCallbacks
     @web.authenticated
     def post(self):
         container = {}
+        routed = False
         user = self.get_current_user()
 
         try:
             if not user:
                 raise api.Error(api.INVALID_REQUEST)
+            # Limits are checked before the body is parsed
+            self.limit(user)
+            api.Handler.metrics.observe('oplog_request_bytes', len(self.request.body), buckets=metrics.BYTES)
             try:
-                container = utils.json.decode(self.request.body)
+                with api.Handler.metrics.time('oplog_decode_seconds'):
+                    container = utils.json.decode(self.request.body)
             except ValueError:
                 raise api.Error(api.PARSE_ERROR)
             if isinstance(container, list):
+                # A batch costs a request per message, one was taken before
+                # parsing
+                self.check_batch(user, len(container))
+                if len(container) > 1:
+                    self.limit(user, len(container) - 1)
                 # Validate all messages before routing
                 for message in container:
                     self.validate_message(message)
-                for message in container:
-                    data = yield api.route(user, self, message)
-                    self.write(utils.json.encode(data))
+                    # Streamed results can't be held for the rest of a batch
+                    if api.streaming(message):
+                        raise api.Error(api.INVALID_REQUEST)
+                routed = True
+                results = yield self.route_batch(user, container)
+                with api.Handler.metrics.time('oplog_encode_seconds'):
+                    for data in results:
+                        self.write(cache.encode(data))
             else:
                 self.validate_message(container)
-                data = yield api.route(user, self, container)
-                self.write(utils.json.encode(data))
+                routed = True
+                if api.streaming(container):
+                    yield self.stream(user, container)
+                else:
+                    data = yield api.route(user, self, container)
+                    with api.Handler.metrics.time('oplog_encode_seconds'):
+                        self.write(cache.encode(data))
             self.finish()
         except api.Error, error:
+            # Errors from routed messages are counted by method
+            if not routed:
+                api.Handler.metrics.count('oplog_errors_total', method='request', code=error.code)
             self.error = error
             raise web.Error(error.http_code)
 
+class Stream(web.Handler):
+    """Push entry changes to the client as Server-Sent Events.
+
+    Every connection subscribes to the same in-process feed, connections are
+    closed after the stream timeout and resume from the Last-Event-ID header
+    when the client reconnects. A reset event is sent if the client missed
+    events that are no longer buffered.
+    """
+
+    _closed = False
+    _keepalive = None
+    _timeout = None
+    _open = set()
+
+    @classmethod
+    def close_all(cls):
+        for stream in list(cls._open):
+            stream.close()
+
+    @web.authenticated
+    @web.asynchronous
+    def get(self):
+        feed = api.Handler.feed
+        if len(feed.subscribers) >= self.settings.stream.max_subscribers:
+            raise web.Error(503)
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        # Closing the connection is how the client learns the stream ended
+        # (and reconnects), a kept alive connection would just go quiet
+        self.set_header('Connection', 'close')
+        self.request.connection.no_keep_alive = True
+        self.write('retry: 1000\n\n')
+
+        last_id = self.request.headers.get('Last-Event-ID') or self.request.get('last_id', None)
+        if not feed.subscribe(self.send, last_id):
+            self.write('event: reset\ndata: {}\n\n')
+        self.flush()
+        self._open.add(self)
+
+        self._timeout = reactor.callLater(self.settings.stream.timeout, self.close)
+        self._keepalive = task.LoopingCall(self.send, ':\n\n')
+        self._keepalive.start(self.settings.stream.keepalive, now=False)
+
+    def send(self, message):
+        self.write(message)
+        self.flush()
+
+    def cleanup(self):
+        self._closed = True
+        self._open.discard(self)
+        api.Handler.feed.unsubscribe(self.send)
+        if self._keepalive is not None and self._keepalive.running:
+            self._keepalive.stop()
+        if self._timeout is not None and self._timeout.active():
+            self._timeout.cancel()
+
+    def close(self):
+        if not self._closed:
+            self.cleanup()
+            self.finish()
+
+    def on_connection_close(self, *args, **kwargs):
+        if not self._closed:
+            self.cleanup()
+
+class Metrics(web.Handler):
+    """Expose metrics in the Prometheus text format to allowed
+    addresses."""
+
+    def get(self):
+        settings = self.settings.metrics
+        allow = [address.strip() for address in settings.allow.split(',')]
+        if not settings.enabled or ('*' not in allow and self.request.remote_ip not in allow):
+            raise web.Error(404)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(api.Handler.metrics.render())
+
 class Login(web.Handler):
     """Log user into Oplog."""
 
@@ -91,7 +339,8 @@ class Login(web.Handler):
             if not password:
                 raise FormError('Password required', 'password')
 
-            valid_user = yield self.plugin(self.settings.plugin.authentication).valid(username, password)
+            valid_user = yield self.plugin(self.settings.plugin.authentication).valid(
+                username, password, self.request.remote_ip)
 
             if not valid_user:
                 raise FormError('Invalid username or password.', 'password')
@@ -123,5 +372,7 @@ route = [
     (r'/api', Api),
     (r'/login', Login),
     (r'/logout', Logout),
+    (r'/metrics', Metrics),
+    (r'/stream', Stream),
     (r'(.*)', NotFound),
 ]
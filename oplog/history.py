@@ -0,0 +1,128 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+import zlib
+import txmongo
+from twisted.internet import defer
+from txmongo._pymongo import bson
+from txmongo._pymongo.binary import Binary
+from oplog import utils
+
+# Name of the index that expires old history
+RETENTION_INDEX = 'retention'
+
+def diff(new, old, prefix=''):
+    """Return the fields to set and unset to turn new back into old, nested
+    documents are compared field by field."""
+    sets = []
+    unsets = []
+    for name, value in old.items():
+        path = prefix + name
+        if name not in new:
+            sets.append([path, value])
+        elif isinstance(value, dict) and isinstance(new[name], dict) and value:
+            s, u = diff(new[name], value, path + '.')
+            sets.extend(s)
+            unsets.extend(u)
+        elif new[name] != value or isinstance(new[name], bool) != isinstance(value, bool):
+            sets.append([path, value])
+    for name in new:
+        if name not in old:
+            unsets.append(prefix + name)
+    return sets, unsets
+
+def pack(value, threshold):
+    """Return value as is, or compressed BSON if its BSON is at least
+    threshold bytes (0 never compresses)."""
+    if not threshold:
+        return value
+    data = bson.BSON.from_dict(value)
+    if len(data) < threshold:
+        return value
+    return Binary(zlib.compress(data))
+
+def unpack(value):
+    if isinstance(value, basestring):
+        return bson.BSON(zlib.decompress(value)).to_dict()
+    return value
+
+def size(value):
+    return len(value) if isinstance(value, basestring) else len(bson.BSON.from_dict(value))
+
+def record(old, new, kind, snapshot_interval=10, threshold=1024):
+    """Return the history record of old, the version replaced by new (None
+    if it was deleted).
+
+    Records are reverse deltas that turn the next version back into old, so
+    the newest versions (which are read the most) are the cheapest to rebuild
+    and expiring the oldest records never breaks the rest. Deletes, every
+    snapshot_interval versions and changes that don't make for a smaller
+    delta are stored in full.
+    """
+    version = old.get('_version') or 0
+    result = {
+        'entry': old['_id'],
+        'version': version,
+        'date': datetime.datetime.utcnow(),
+        'type': kind,
+    }
+    body = pack(old, threshold)
+    if new is not None and version % snapshot_interval:
+        sets, unsets = diff(new, old)
+        delta = pack({'set': sets, 'unset': unsets}, threshold)
+        if size(delta) < size(body):
+            result['delta'] = delta
+            return result
+    result['body'] = body
+    return result
+
+def apply(document, delta):
+    delta = unpack(delta)
+    return utils.modify.apply(document, {
+        '$set': dict([(path, value) for path, value in delta['set']]),
+        '$unset': dict([(path, 1) for path in delta['unset']]),
+    })
+
+def rebuild(records, current, version):
+    """Return the entry at version from its history records (newest first,
+    down to at least version) and the current entry (None if deleted)."""
+    document = current
+    for r in records:
+        if 'body' in r:
+            document = unpack(r['body'])
+        else:
+            if document is None or (document.get('_version') or 0) != r['version'] + 1:
+                raise ValueError('history of version %d is incomplete' % r['version'])
+            document = apply(document, r['delta'])
+        if r['version'] == version:
+            return document
+    if current is not None and (current.get('_version') or 0) == version:
+        return current
+    return None
+
+def ensure(db, days):
+    """Create the index that expires history records after days."""
+    return db.entry_history.ensure_index(txmongo.filter.sort(txmongo.filter.ASCENDING('date')),
+        name=RETENTION_INDEX, expireAfterSeconds=days * 86400)
+
+@defer.inlineCallbacks
+def migrate(db, batch_size=1000):
+    """Add the entry id and version to history records written before
+    history was indexed by entry, returns the number of records updated."""
+    total = 0
+    while True:
+        records = yield db.entry_history.find({'entry': {'$exists': False}}, limit=batch_size,
+            fields=['body._id', 'body._version'])
+        if not records:
+            break
+        for r in records:
+            body = r.get('body') or {}
+            yield db.entry_history.update({'_id': r['_id']}, {'$set': {
+                'entry': body.get('_id'),
+                'version': body.get('_version') or 0,
+            }}, safe=True)
+        total += len(records)
+    defer.returnValue(total)
@@ -0,0 +1,85 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import collections
+import os
+import time
+from huck import utils
+from twisted.python import log
+
+def event(id, name, data):
+    """Encode a Server-Sent Event."""
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (id, name, utils.json.encode(data))
+
+class Hub(object):
+    """Fans entry changes out to every subscriber.
+
+    Events are encoded once and the most recent ``size`` are kept in a ring
+    buffer so a subscriber that reconnects with the id of the last event it
+    saw can resume without missing any. Ids are prefixed with the time the hub
+    was created and the process id so ids from before a restart or from
+    another worker aren't mistaken for ours.
+
+    If relay is set it is called with every event published in this process,
+    so they can be passed on to the hubs of other processes.
+    """
+
+    relay = None
+
+    def __init__(self, size=1000):
+        self.prefix = '%x.%d' % (int(time.time()), os.getpid())
+        self.counter = 0
+        self.events = collections.deque(maxlen=size)
+        # A list rather than a set, subscribers don't have to be hashable
+        self.subscribers = []
+
+    def publish(self, name, data, relay=True):
+        if relay and self.relay is not None:
+            self.relay(name, data)
+        self.counter += 1
+        message = event('%s-%d' % (self.prefix, self.counter), name, data)
+        self.events.append((self.counter, message))
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber(message)
+            except Exception, error:
+                log.err('Unable to send event: %s' % error)
+                self.unsubscribe(subscriber)
+
+    def _position(self, last_id):
+        """Return the counter of last_id, or None if it can't be resumed
+        from."""
+        try:
+            prefix, counter = last_id.rsplit('-', 1)
+            counter = int(counter)
+        except (AttributeError, ValueError):
+            return
+        if prefix != self.prefix or counter > self.counter:
+            return
+        # Events after last_id have already been dropped from the buffer
+        oldest = self.events[0][0] if self.events else self.counter + 1
+        if counter < oldest - 1:
+            return
+        return counter
+
+    def subscribe(self, subscriber, last_id=None):
+        """Send new events to subscriber, events after last_id are sent first.
+        Returns False if last_id couldn't be resumed from."""
+        resumed = True
+        if last_id:
+            counter = self._position(last_id)
+            if counter is None:
+                resumed = False
+            else:
+                for number, message in self.events:
+                    if number > counter:
+                        subscriber(message)
+        if subscriber not in self.subscribers:
+            self.subscribers.append(subscriber)
+        return resumed
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
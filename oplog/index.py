@@ -0,0 +1,65 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import txmongo
+from twisted.internet import defer
+from twisted.python import log
+
+# Collections with configurable indexes, the index section of the settings has
+# an option of the same name for each
+COLLECTIONS = ('entry', 'entry_history', 'entry_stats')
+
+DEFAULTS = {
+    'entry': '_date:-1; _type:1,_date:-1; _user:1,_date:-1',
+    'entry_history': 'entry:1,version:-1',
+    'entry_stats': 'unit:1,date:1',
+}
+
+def parse(value):
+    """Parse an index list in the format "a:1,b:-1; c:1" into a list of
+    ``[(field, direction), ...]`` index keys."""
+    indexes = []
+    for spec in value.split(';'):
+        spec = spec.strip()
+        if not spec:
+            continue
+        keys = []
+        for key in spec.split(','):
+            name, sep, direction = key.strip().rpartition(':')
+            if not name or direction not in ('1', '-1'):
+                raise ValueError('Invalid index key: %s' % key.strip())
+            keys.append((name, int(direction)))
+        indexes.append(keys)
+    return indexes
+
+def configured(settings=None):
+    """Return a dict of collection names to the index keys in settings, or the
+    default indexes if no settings are given."""
+    return dict([
+        (name, parse(getattr(settings.index, name) if settings else DEFAULTS[name]))
+        for name in COLLECTIONS
+    ])
+
+def sort(keys):
+    return txmongo.filter.sort([(name, direction) for name, direction in keys])
+
+def ensure(db, indexes):
+    """Create any indexes in ``indexes`` (from configured) that don't exist."""
+    deferreds = []
+    for collection, keys_list in indexes.items():
+        for keys in keys_list:
+            d = db[collection].ensure_index(sort(keys))
+            d.addCallback(lambda result, c=collection: log.msg('Ensured index %s on %s' % (result, c)))
+            deferreds.append(d)
+    return defer.gatherResults(deferreds)
+
+def create(db, collection, keys):
+    return db[collection].create_index(sort(keys))
+
+def drop(db, collection, name):
+    return db[collection].drop_index(name)
+
+def information(db, collection):
+    return db[collection].index_information()
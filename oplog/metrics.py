@@ -0,0 +1,200 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import bisect
+import contextlib
+import re
+import time
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import log
+
+# Upper bounds of the latency buckets in seconds
+SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the size buckets in bytes
+BYTES = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+HELP = {
+    'oplog_requests_total': 'API messages by method.',
+    'oplog_errors_total': 'API errors by method and error code.',
+    'oplog_method_seconds': 'Time taken to answer API messages by method.',
+    'oplog_request_bytes': 'Size of API request bodies.',
+    'oplog_response_bytes': 'Size of API response bodies.',
+    'oplog_decode_seconds': 'Time taken to parse API request bodies.',
+    'oplog_encode_seconds': 'Time taken to encode API responses.',
+    'oplog_validate_seconds': 'Time taken to validate API params by schema.',
+    'oplog_mongify_seconds': 'Time taken to convert between JSON and Mongo types.',
+    'oplog_mongo_seconds': 'Time taken by Mongo operations by collection and operation.',
+    'oplog_mongo_errors_total': 'Failed Mongo operations by collection and operation.',
+}
+
+STATSD_UNSAFE = re.compile(r'[^a-zA-Z0-9_\-]')
+
+def labels(values):
+    return tuple(sorted(values.items()))
+
+def format_labels(values, extra=()):
+    values = list(values) + list(extra)
+    if not values:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in values)
+
+def escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+class Registry(object):
+    """Counters and histograms kept in process and rendered in the
+    Prometheus text format.
+
+    Metrics are named when first used, ``sink`` (if set) is passed every
+    observation as it happens so they can also be sent to statsd.
+    """
+
+    def __init__(self, enabled=True, sink=None):
+        self.enabled = enabled
+        self.sink = sink
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1, **values):
+        if not self.enabled:
+            return
+        counter = self.counters.setdefault(name, {})
+        key = labels(values)
+        counter[key] = counter.get(key, 0) + value
+        if self.sink is not None:
+            self.sink.count(name, value, key)
+
+    def observe(self, name, value, buckets=SECONDS, **values):
+        if not self.enabled:
+            return
+        histogram = self.histograms.setdefault(name, {})
+        key = labels(values)
+        if key not in histogram:
+            histogram[key] = Histogram(buckets)
+        histogram[key].observe(value)
+        if self.sink is not None:
+            self.sink.observe(name, value, key, buckets is SECONDS)
+
+    @contextlib.contextmanager
+    def time(self, name, **values):
+        """Observe how long the block takes in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **values)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.counters):
+            if name in HELP:
+                lines.append('# HELP %s %s' % (name, HELP[name]))
+            lines.append('# TYPE %s counter' % name)
+            for key, value in sorted(self.counters[name].items()):
+                lines.append('%s%s %s' % (name, format_labels(key), format_value(value)))
+        for name in sorted(self.histograms):
+            if name in HELP:
+                lines.append('# HELP %s %s' % (name, HELP[name]))
+            lines.append('# TYPE %s histogram' % name)
+            for key, histogram in sorted(self.histograms[name].items()):
+                for bound, total in histogram.cumulative():
+                    lines.append('%s_bucket%s %d' % (name, format_labels(key, [('le', format_value(bound))]), total))
+                lines.append('%s_sum%s %s' % (name, format_labels(key), format_value(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, format_labels(key), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+class Statsd(protocol.DatagramProtocol):
+    """Sends observations to statsd, they are buffered and sent every interval
+    seconds (or when a packet is full) rather than a packet each."""
+
+    MAX_PACKET = 1400
+
+    def __init__(self, host, port=8125, prefix='oplog', interval=1.0):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.interval = interval
+        self.address = None
+        self.lines = []
+        self.size = 0
+        self._loop = None
+
+    def start(self):
+        def resolved(ip):
+            self.address = (ip, self.port)
+            reactor.listenUDP(0, self)
+        d = reactor.resolve(self.host)
+        d.addCallback(resolved)
+        d.addErrback(log.err, 'Unable to resolve statsd host')
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(self.interval, now=False)
+        return d
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self.flush()
+
+    def name(self, name, key):
+        # oplog_method_seconds{method="entry.get"} is prefix.method_seconds.entry_get
+        if name.startswith('oplog_'):
+            name = name[len('oplog_'):]
+        parts = [self.prefix, name] if self.prefix else [name]
+        parts.extend(STATSD_UNSAFE.sub('_', unicode(value).encode('utf-8')) for _, value in key)
+        return '.'.join(parts)
+
+    def count(self, name, value, key):
+        self.add('%s:%d|c' % (self.name(name, key), value))
+
+    def observe(self, name, value, key, seconds=True):
+        if seconds:
+            self.add('%s:%.3f|ms' % (self.name(name, key), value * 1000))
+        else:
+            self.add('%s:%s|h' % (self.name(name, key), value))
+
+    def add(self, line):
+        if self.size + len(line) + 1 > self.MAX_PACKET:
+            self.flush()
+        self.lines.append(line)
+        self.size += len(line) + 1
+
+    def flush(self):
+        if not self.lines:
+            return
+        lines, self.lines, self.size = self.lines, [], 0
+        if self.transport is None or self.address is None:
+            return
+        try:
+            self.transport.write('\n'.join(lines), self.address)
+        except Exception, error:
+            log.msg('Unable to send metrics to statsd: %s' % error)
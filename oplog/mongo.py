@@ -0,0 +1,273 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import os
+import struct
+import time
+import txmongo
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.python import failure
+from twisted.python import log
+from txmongo import collection
+# txmongo's package namespace shadows its protocol module with Twisted's
+from txmongo.protocol import MongoProtocol
+from txmongo.protocol import _ZERO
+
+READ_PREFERENCES = ('primary', 'secondary')
+
+OP_QUERY = 2004
+SLAVE_OK = struct.pack('<i', 4)
+
+class Timeout(Exception): pass
+
+def hosts(value, port=27017):
+    """Parse a comma separated list of host[:port] seeds."""
+    seeds = []
+    for seed in value.split(','):
+        seed = seed.strip()
+        if not seed:
+            continue
+        host, _, seed_port = seed.partition(':')
+        if not host:
+            raise ValueError('invalid host: %s' % seed)
+        seeds.append((host, int(seed_port) if seed_port else port))
+    if not seeds:
+        raise ValueError('no hosts')
+    return seeds
+
+def address(value, port=27017):
+    return hosts(value, port)[0]
+
+def timeout(d, seconds, clock=reactor):
+    """Return a deferred that fires with the result of d, or fails with
+    Timeout if d hasn't fired after seconds.
+
+    The operation itself isn't cancelled (Mongo has no way to), so a write
+    that times out may still be applied.
+    """
+    if not seconds:
+        return d
+    result = defer.Deferred()
+    def expire():
+        result.errback(Timeout('Mongo operation timed out after %s seconds' % seconds))
+    call = clock.callLater(seconds, expire)
+    def done(value):
+        if call.active():
+            call.cancel()
+            result.callback(value)
+        elif isinstance(value, failure.Failure):
+            # Already reported as a timeout
+            log.msg('Mongo operation failed after timing out: %s' % value.value)
+    d.addBoth(done)
+    return result
+
+class Collection(object):
+    """Wraps a txmongo collection so every operation fails with Timeout
+    instead of waiting forever on a slow server, operations are timed if
+    a metrics registry is given."""
+
+    def __init__(self, collection, seconds, metrics=None):
+        self._collection = collection
+        self._timeout = seconds
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        value = getattr(self._collection, name)
+        if isinstance(value, collection.Collection):
+            return Collection(value, self._timeout, self._metrics)
+        if not callable(value):
+            return value
+        def call(*args, **kwargs):
+            result = value(*args, **kwargs)
+            if isinstance(result, defer.Deferred):
+                result = timeout(result, self._timeout)
+                if self._metrics is not None:
+                    result.addBoth(self._measure, name, time.time())
+            return result
+        return call
+
+    def _measure(self, result, op, start):
+        values = {'collection': self._collection._collection_name, 'op': op}
+        self._metrics.observe('oplog_mongo_seconds', time.time() - start, **values)
+        if isinstance(result, failure.Failure):
+            self._metrics.count('oplog_mongo_errors_total', **values)
+        return result
+
+    def __getitem__(self, name):
+        return Collection(self._collection[name], self._timeout, self._metrics)
+
+    def __str__(self):
+        return str(self._collection)
+
+class Database(object):
+
+    def __init__(self, database, seconds, metrics=None):
+        self._database = database
+        self._timeout = seconds
+        self._metrics = metrics
+
+    def __getitem__(self, name):
+        return Collection(self._database[name], self._timeout, self._metrics)
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def __str__(self):
+        return str(self._database)
+
+class SlaveOkProtocol(MongoProtocol):
+    """Sets the slaveOk flag on queries so secondaries answer them."""
+
+    def sendMessage(self, operation, collection, message, query_opts=_ZERO):
+        if operation == OP_QUERY:
+            query_opts = SLAVE_OK
+        return MongoProtocol.sendMessage(self, operation, collection, message, query_opts)
+
+class Factory(txmongo._MongoFactory):
+    """A txmongo connection pool that reconnects to wherever the client
+    last found its server."""
+
+    def __init__(self, client, pool_size, slave_ok=False):
+        txmongo._MongoFactory.__init__(self, pool_size)
+        self.client = client
+        self.address = None
+        self.connectors = []
+        if slave_ok:
+            self.protocol = SlaveOkProtocol
+
+    def connect(self, address, seconds=30):
+        self.address = address
+        for i in xrange(self.pool_size):
+            self.connectors.append(reactor.connectTCP(address[0], address[1], self, timeout=seconds or 30))
+
+    def move(self, address):
+        if address == self.address:
+            return
+        log.msg('Moving Mongo pool from %s:%d to %s:%d' % (self.address + address))
+        self.address = address
+        for connector in self.connectors:
+            connector.host, connector.port = address
+
+    def clientConnectionLost(self, connector, reason):
+        # The server may have stepped down
+        if self.continueTrying:
+            self.client.discover()
+        protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.continueTrying:
+            self.client.discover()
+        protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+@defer.inlineCallbacks
+def is_master(address, seconds):
+    connecting = txmongo.MongoConnection(address[0], address[1], reconnect=False)
+    try:
+        api = yield timeout(connecting, seconds)
+    except Timeout:
+        # Don't leave the connection open if it is made after all
+        connecting.addCallback(lambda api: api.disconnect())
+        raise
+    try:
+        result = yield timeout(api.admin['$cmd'].find_one({'ismaster': 1}), seconds)
+    finally:
+        api.disconnect()
+    defer.returnValue(result)
+
+@defer.inlineCallbacks
+def discover(seeds, seconds=10):
+    """Ask the seeds (and any other members they know of) which is the
+    primary and which are secondaries."""
+    primary, secondaries = None, []
+    queue, seen = list(seeds), set()
+    while queue:
+        member = queue.pop(0)
+        if member in seen:
+            continue
+        seen.add(member)
+        try:
+            result = yield is_master(member, seconds)
+        except Exception, error:
+            log.msg('Unable to reach Mongo at %s:%d: %s' % (member + (error,)))
+            continue
+        if result.get('ismaster'):
+            primary = member
+        elif result.get('secondary'):
+            secondaries.append(member)
+        for host in result.get('hosts', []):
+            queue.append(address(host))
+    defer.returnValue((primary, secondaries))
+
+class Client(object):
+    """Mongo connection pools for a standalone server or a replica set.
+
+    The seeds are asked for the members of the replica set when connecting
+    and whenever a connection is lost. Writes always go to the primary, reads
+    from ``read`` databases go to a secondary (falling back to the primary if
+    there isn't one) when the read preference is ``secondary``. Operations
+    fail with Timeout if they take more than timeout seconds (0 waits
+    forever) and are timed in metrics if it is set.
+    """
+
+    def __init__(self, seeds, pool_size=5, timeout=0, read_preference='primary', metrics=None):
+        self.seeds = seeds
+        self.timeout = timeout
+        self.metrics = metrics
+        self.primary = Factory(self, pool_size)
+        if read_preference == 'secondary':
+            self.secondary = Factory(self, pool_size, slave_ok=True)
+        else:
+            self.secondary = self.primary
+        self.connected = self.primary.deferred
+        self._discovering = None
+
+    def factories(self):
+        return [self.primary] if self.secondary is self.primary else [self.primary, self.secondary]
+
+    def discover(self):
+        """Find the members of the replica set and point the pools at them,
+        returns the (primary, secondary) addresses used."""
+        if self._discovering is not None:
+            return self._discovering
+        def found(result):
+            primary, secondaries = result
+            if primary is None:
+                log.msg('No Mongo primary found')
+                primary = self.primary.address or self.seeds[0]
+            # Spread the workers over the secondaries
+            secondary = secondaries[os.getpid() % len(secondaries)] if secondaries else primary
+            if self.primary.address is not None:
+                self.primary.move(primary)
+                if self.secondary is not self.primary:
+                    self.secondary.move(secondary)
+            return primary, secondary
+        def done(result):
+            self._discovering = None
+            return result
+        d = discover(self.seeds, self.timeout or 10)
+        d.addCallback(found)
+        d.addBoth(done)
+        if not d.called:
+            self._discovering = d
+        return d
+
+    @defer.inlineCallbacks
+    def connect(self):
+        primary, secondary = yield self.discover()
+        self.primary.connect(primary, self.timeout)
+        if self.secondary is not self.primary:
+            self.secondary.connect(secondary, self.timeout)
+
+    def database(self, name, read=False, timeout=None):
+        factory = self.secondary if read else self.primary
+        return Database(factory.API[name], self.timeout if timeout is None else timeout, self.metrics)
+
+    def __getitem__(self, name):
+        return self.database(name)
+
+    def disconnect(self):
+        return defer.gatherResults([factory.API.disconnect() for factory in self.factories()])
@@ -0,0 +1,415 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import collections
+import datetime
+import functools
+import re
+import time
+import txmongo
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.python import log
+from txmongo._pymongo.son import SON
+from oplog import query
+
+# Partition sizes, "none" keeps every entry in the entry collection
+INTERVALS = ('none', 'year', 'month', 'day')
+
+# Entries written before partitioning was enabled stay here until they are
+# migrated
+BASE = 'entry'
+
+NAMES = {
+    'year': (re.compile(r'^entry_(\d{4})$'), '%(base)s_%(year)04d'),
+    'month': (re.compile(r'^entry_(\d{4})_(\d{2})$'), '%(base)s_%(year)04d_%(month)02d'),
+    'day': (re.compile(r'^entry_(\d{4})_(\d{2})_(\d{2})$'), '%(base)s_%(year)04d_%(month)02d_%(day)02d'),
+}
+
+def name(date, interval):
+    """Return the name of the partition date is in."""
+    return NAMES[interval][1] % {'base': BASE, 'year': date.year, 'month': date.month, 'day': date.day}
+
+def start(name, interval):
+    """Return the first date in a partition, or None if name isn't a
+    partition."""
+    match = NAMES[interval][0].match(name)
+    if match is None:
+        return
+    try:
+        return datetime.datetime(*([int(v) for v in match.groups()] + [1, 1])[:3])
+    except ValueError:
+        return
+
+def following(date, interval):
+    """Return the first date in the partition after the one date starts."""
+    if interval == 'year':
+        return datetime.datetime(date.year + 1, 1, 1)
+    elif interval == 'month':
+        return datetime.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+    return date + datetime.timedelta(days=1)
+
+def entry_date(entry):
+    """Return the date an entry is partitioned by, its _date or when its _id
+    was made if _date isn't a date."""
+    if isinstance(entry.get('_date'), datetime.datetime):
+        return entry['_date'].replace(tzinfo=None)
+    if isinstance(entry.get('_id'), txmongo.ObjectId):
+        return entry['_id'].generation_time.replace(tzinfo=None)
+    return datetime.datetime.utcnow()
+
+def date_range(spec):
+    """Return the (low, high) _date bounds of a query (None if it isn't
+    bounded), top level, $and and $or conditions are used."""
+    lows, highs = [], []
+    value = spec.get('_date')
+    if isinstance(value, datetime.datetime):
+        lows.append(value)
+        highs.append(value)
+    elif isinstance(value, dict):
+        lows.extend([v for o, v in value.items() if o in ('$gt', '$gte') and isinstance(v, datetime.datetime)])
+        highs.extend([v for o, v in value.items() if o in ('$lt', '$lte') and isinstance(v, datetime.datetime)])
+        values = value.get('$in')
+        if isinstance(values, list) and values and \
+                all(isinstance(v, datetime.datetime) for v in values):
+            lows.append(min(values))
+            highs.append(max(values))
+    for clause in spec.get('$and', []):
+        if isinstance(clause, dict):
+            low, high = date_range(clause)
+            lows.extend([low] if low else [])
+            highs.extend([high] if high else [])
+    # An $or is bounded by the widest of its clauses (and only if they all
+    # are), this is how the position of a stream narrows its range
+    ranges = [date_range(c) if isinstance(c, dict) else (None, None) for c in spec.get('$or', [])]
+    if ranges and all(low for low, high in ranges):
+        lows.append(min(low for low, high in ranges))
+    if ranges and all(high for low, high in ranges):
+        highs.append(max(high for low, high in ranges))
+    return max(lows) if lows else None, min(highs) if highs else None
+
+def orderby(filter):
+    """Return the sort of a query filter as (name, direction) pairs, sorts
+    on a $meta score are descending."""
+    if not filter or 'orderby' not in filter:
+        return []
+    return [(n, d if d in (1, -1) else -1) for n, d in filter['orderby']]
+
+def compare(sort, a, b):
+    for name, direction in sort:
+        result = cmp(query.lookup(a, name), query.lookup(b, name))
+        if result:
+            return result * direction
+    return 0
+
+def sort_fields(fields, filter):
+    """Return fields with the sort fields of filter added, so results can be
+    merged, and the names that were added."""
+    sort = orderby(filter)
+    if not isinstance(fields, list) or not sort:
+        return fields, []
+    extra = [n for n, d in sort if n not in fields]
+    return fields + extra, extra
+
+def merge(results, filter, skip=0, limit=0, extra=()):
+    """Merge lists of results in the order of the sort of filter, and cut
+    them down to the page skip and limit select."""
+    merged = [entry for result in results for entry in result]
+    sort = orderby(filter)
+    if sort:
+        merged.sort(cmp=functools.partial(compare, sort))
+    merged = merged[skip:skip + limit] if limit else merged[skip:]
+    for entry in merged:
+        for n in extra:
+            if n != '_id':
+                entry.pop(n, None)
+    return merged
+
+def list_collections(db):
+    """Return the names of the collections in db."""
+    d = db['$cmd'].find_one(SON([
+        ('listCollections', 1),
+        ('filter', {'name': {'$regex': '^%s' % BASE}}),
+        ('cursor', {'batchSize': 100000}),
+    ]))
+    def listed(result):
+        if result.get('ok'):
+            return [c['name'] for c in result['cursor']['firstBatch']]
+        # Servers before 3.0 list collections in system.namespaces
+        d = db['system.namespaces'].find()
+        prefix = '%s.' % db
+        d.addCallback(lambda results: [r['name'][len(prefix):] for r in results
+            if r['name'].startswith(prefix) and '$' not in r['name']])
+        return d
+    d.addCallback(listed)
+    return d
+
+def drop(db, name):
+    return db['$cmd'].find_one({'drop': name})
+
+class Router(object):
+    """Keeps track of the partitions of the entry collection.
+
+    Entries are split into a collection per interval of their _date, so old
+    entries can be dropped with their collection and queries on recent
+    entries only use small indexes. The partitions are listed from Mongo at
+    most every refresh seconds, created is called with the database and the
+    name of any partition this process writes to first so it can be
+    indexed.
+    """
+
+    def __init__(self, interval='none', refresh=60, created=None):
+        if interval not in INTERVALS:
+            raise ValueError('unknown partition interval: %s' % interval)
+        self.interval = interval
+        self.refresh = refresh
+        self.created = created
+        self.names = set()
+        self.loaded = None
+        self._loading = None
+        self._waiting = []
+
+    @property
+    def enabled(self):
+        return self.interval != 'none'
+
+    def entries(self, db):
+        """Return the entry collection of db, or its partitions."""
+        return Entries(self, db) if self.enabled else db[BASE]
+
+    def load(self, db, force=False):
+        """Update the list of partitions if it is older than refresh
+        seconds, the returned deferred fires once it is up to date."""
+        if not force and self.loaded is not None and time.time() - self.loaded < self.refresh:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if self._loading is None:
+            self._loading = list_collections(db)
+            self._loading.addBoth(self._loaded)
+        return d
+
+    def _loaded(self, result):
+        waiting, self._waiting, self._loading = self._waiting, [], None
+        if not isinstance(result, failure.Failure):
+            self.names = set([n for n in result if n == BASE or start(n, self.interval) is not None])
+            self.loaded = time.time()
+            result = None
+        for d in waiting:
+            if result is None:
+                d.callback(None)
+            else:
+                d.errback(result)
+
+    @defer.inlineCallbacks
+    def ensure(self, db):
+        """Call created for every partition."""
+        yield self.load(db, force=True)
+        if self.created is not None:
+            for n in self.all():
+                if n != BASE:
+                    yield self.created(db, n)
+
+    def partition(self, entry):
+        return name(entry_date(entry), self.interval)
+
+    def add(self, db, n):
+        if n in self.names:
+            return
+        self.names.add(n)
+        if self.created is not None:
+            d = defer.maybeDeferred(self.created, db, n)
+            d.addErrback(log.err, 'Unable to set up partition %s' % n)
+
+    def all(self):
+        """Return the partitions, newest first with the base collection
+        last."""
+        dated = [(start(n, self.interval), n) for n in self.names if n != BASE]
+        names = [n for s, n in sorted(dated, reverse=True)]
+        if BASE in self.names:
+            names.append(BASE)
+        return names
+
+    def route(self, low=None, high=None):
+        """Return the partitions that can hold entries dated between low and
+        high, newest first.
+
+        The partition for now is always included (if it is in range) since
+        another process may have just created it.
+        """
+        names = set(self.names)
+        names.add(name(datetime.datetime.utcnow(), self.interval))
+        result = []
+        for s, n in sorted([(start(n, self.interval), n) for n in names if n != BASE], reverse=True):
+            if (high is None or s <= high) and (low is None or following(s, self.interval) > low):
+                result.append(n)
+        if BASE in names:
+            result.append(BASE)
+        return result
+
+class Entries(object):
+    """The partitions of the entry collection behind the collection methods
+    the handlers use.
+
+    Queries are sent to the partitions that overlap their _date range and
+    the results merged in the order of the query sort. Entries are written
+    to the partition of their date. Entries found by _id are looked for in
+    the partition of the date the _id was made first and then in the other
+    partitions the query's _date range allows at once. Updates and removes
+    go to the first partition that has the entry (unsafe ones only to the
+    first partition it is likely to be in), a replaced entry whose _date
+    moved to another interval is moved to that partition.
+    """
+
+    def __init__(self, router, db):
+        self.router = router
+        self.db = db
+
+    def __str__(self):
+        return '%s.%s_*' % (self.db, BASE)
+
+    def candidates(self, spec, document=None):
+        names = self.router.route(*date_range(spec))
+        first = None
+        if document and not any(n.startswith('$') for n in document):
+            first = self.router.partition(dict(document, _id=spec.get('_id', document.get('_id'))))
+        elif isinstance(spec.get('_id'), txmongo.ObjectId):
+            first = self.router.partition({'_id': spec['_id']})
+        if first is None:
+            return names
+        return [first] + [n for n in names if n != first]
+
+    @defer.inlineCallbacks
+    def find(self, spec=None, skip=0, limit=0, fields=None, filter=None):
+        spec = spec if spec is not None else {}
+        yield self.router.load(self.db)
+        names = self.router.route(*date_range(spec))
+        if len(names) == 1:
+            results = yield self.db[names[0]].find(spec=spec, skip=skip, limit=limit, fields=fields, filter=filter)
+            defer.returnValue(results)
+        # Every partition is asked for enough entries to fill the page and
+        # the merged results are cut down to it
+        fields, extra = sort_fields(fields, filter)
+        results = yield defer.gatherResults([
+            self.db[n].find(spec=spec, limit=skip + limit if limit else 0, fields=fields, filter=filter)
+            for n in names
+        ])
+        defer.returnValue(merge(results, filter, skip, limit, extra))
+
+    @defer.inlineCallbacks
+    def find_one(self, spec=None, fields=None):
+        spec = spec if spec is not None else {}
+        if not isinstance(spec.get('_id'), txmongo.ObjectId):
+            results = yield self.find(spec, limit=1, fields=fields)
+            defer.returnValue(results[0] if results else {})
+        yield self.router.load(self.db)
+        names = self.candidates(spec)
+        entry = yield self.db[names[0]].find_one(spec, fields=fields)
+        if entry or len(names) == 1:
+            defer.returnValue(entry)
+        # The rest of the partitions are asked at once
+        entries = yield defer.gatherResults([self.db[n].find_one(spec, fields=fields) for n in names[1:]])
+        defer.returnValue(([entry for entry in entries if entry] or [{}])[0])
+
+    @defer.inlineCallbacks
+    def count(self, spec=None):
+        spec = spec if spec is not None else {}
+        yield self.router.load(self.db)
+        counts = yield defer.gatherResults([self.db[n].count(spec) for n in self.router.route(*date_range(spec))])
+        defer.returnValue(sum(counts))
+
+    @defer.inlineCallbacks
+    def insert(self, docs, safe=False):
+        single = isinstance(docs, dict)
+        docs = [docs] if single else docs
+        groups = collections.OrderedDict()
+        for doc in docs:
+            doc['_id'] = doc.get('_id', txmongo.ObjectId())
+            groups.setdefault(self.router.partition(doc), []).append(doc)
+        yield self.router.load(self.db)
+        for n, group in groups.items():
+            self.router.add(self.db, n)
+            yield self.db[n].insert(group, safe=safe)
+        ids = [doc['_id'] for doc in docs]
+        defer.returnValue(ids[0] if single else ids)
+
+    @defer.inlineCallbacks
+    def update(self, spec, document, upsert=False, multi=False, safe=False):
+        yield self.router.load(self.db)
+        names = self.candidates(spec, document)
+        if upsert:
+            self.router.add(self.db, names[0])
+            names = names[:1]
+        elif safe and not multi and not any(n.startswith('$') for n in document):
+            result = yield self.replace(names, spec, document)
+            defer.returnValue(result)
+        for n in names:
+            result = yield self.db[n].update(spec, document, upsert=upsert, multi=multi, safe=safe)
+            if not safe or result.get('n'):
+                break
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def replace(self, names, spec, document):
+        """Replace the entry that matches spec with document, moving it to
+        the partition of its new _date (the first of names) if it's in
+        another one.
+
+        The entry is written to its new partition before it is removed
+        from the old one, if spec no longer matches it there (it was
+        changed by another request) the copy is removed again.
+        """
+        result = yield self.db[names[0]].update(spec, document, safe=True)
+        if result.get('n') or len(names) == 1:
+            defer.returnValue(result)
+        found = yield defer.gatherResults([self.db[n].find_one(spec, fields=['_id']) for n in names[1:]])
+        old = [n for n, entry in zip(names[1:], found) if entry]
+        if not old:
+            defer.returnValue(result)
+        _id = document.get('_id', spec.get('_id'))
+        self.router.add(self.db, names[0])
+        yield self.db[names[0]].update({'_id': _id}, dict(document, _id=_id), upsert=True, safe=True)
+        result = yield self.db[old[0]].remove(spec, safe=True)
+        if not result.get('n'):
+            copy = dict([(n, v) for n, v in document.items() if n == '_version'], _id=_id)
+            yield self.db[names[0]].remove(copy, safe=True)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def remove(self, spec, safe=False):
+        yield self.router.load(self.db)
+        # A single entry is only removed from the first partition it is in
+        single = isinstance(spec.get('_id'), txmongo.ObjectId)
+        total = 0
+        for n in self.candidates(spec):
+            result = yield self.db[n].remove(spec, safe=safe)
+            if safe:
+                total += result.get('n', 0)
+            if single and (not safe or result.get('n')):
+                break
+        if safe:
+            result['n'] = total
+        defer.returnValue(result)
+
+@defer.inlineCallbacks
+def migrate(router, db, batch_size=1000):
+    """Move the entries in the base collection to their partitions, returns
+    the number of entries moved.
+
+    Entries are copied before they are removed so an interrupted migration
+    can be run again, but changes made to them while it runs can be lost.
+    """
+    total = 0
+    while True:
+        entries = yield db[BASE].find({}, limit=batch_size)
+        if not entries:
+            break
+        for entry in entries:
+            n = router.partition(entry)
+            router.add(db, n)
+            yield db[n].update({'_id': entry['_id']}, entry, upsert=True, safe=True)
+        yield db[BASE].remove({'_id': {'$in': [entry['_id'] for entry in entries]}}, safe=True)
+        total += len(entries)
+    defer.returnValue(total)
@@ -8,5 +8,6 @@ class Base(object):
     def __init__(self, settings, *args, **kwargs):
         self.settings = settings
 
-    def valid(self, username, password):
+    def valid(self, username, password, address=None):
+        """Check a login, address is the remote address it was made from."""
         raise NotImplementedError('Authentication valid check not implemented.')
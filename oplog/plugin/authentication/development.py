@@ -8,7 +8,7 @@ from oplog.plugin import authentication
 
 class Authentication(authentication.Base):
 
-    def valid(self, username, password):
+    def valid(self, username, password, address=None):
         return defer.succeed(username == password)
 
 def register(settings, *args, **kwargs):
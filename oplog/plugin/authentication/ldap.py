@@ -3,39 +3,214 @@
 #
 # This file is subject to the MIT License (see the LICENSE file).
 
+import hashlib
+import os
 import string
+import time
 from twisted.internet import defer
 from twisted.python import log
 import txldap
+from oplog import utils
 from oplog.plugin import authentication
 
 class Error(Exception): pass
 
+class Pool(object):
+    """A bounded pool of LDAP connections.
+
+    Idle connections are kept bound as the service account (or anonymously if
+    no bind_dn is set), a connection that fails with anything but invalid
+    credentials is dropped rather than returned to the pool.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.semaphore = defer.DeferredSemaphore(settings.pool_size)
+        self.idle = []
+
+    def bind(self, ldap):
+        if self.settings.bind_dn:
+            return ldap.bind(self.settings.bind_dn, self.settings.bind_password)
+        return ldap.bind()
+
+    @defer.inlineCallbacks
+    def connect(self):
+        ldap = txldap.Connection(self.settings.uri, timeout=self.settings.timeout)
+        if self.settings.start_tls and not self.settings.uri.startswith('ldaps://'):
+            yield ldap.start_tls()
+        yield self.bind(ldap)
+        defer.returnValue(ldap)
+
+    def close(self, ldap):
+        d = ldap.unbind()
+        d.addErrback(lambda failure: log.err('Failed to unbind: %s' % failure.value))
+        return d
+
+    @defer.inlineCallbacks
+    def run(self, function, *args, **kwargs):
+        """Call function with a connection from the pool as its first
+        argument.
+
+        An idle connection may have been closed by the server (or a
+        firewall) since it was last used, so if it fails with SERVER_DOWN
+        function is called once more with a fresh connection.
+        """
+        yield self.semaphore.acquire()
+        try:
+            while True:
+                ldap = None
+                reused = bool(self.idle)
+                try:
+                    if reused:
+                        ldap = self.idle.pop()
+                    else:
+                        ldap = yield self.connect()
+                    result = yield function(ldap, *args, **kwargs)
+                except Exception, error:
+                    if ldap is not None:
+                        self.close(ldap)
+                    if not (reused and isinstance(error, txldap.SERVER_DOWN)):
+                        raise
+                    # The other idle connections are likely as stale
+                    while self.idle:
+                        self.close(self.idle.pop())
+                    continue
+                self.idle.append(ldap)
+                defer.returnValue(result)
+        finally:
+            self.semaphore.release()
+
+class Credentials(object):
+    """Cache of successful credential checks, passwords are only kept as a
+    salted hash and expire after ttl seconds."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._cache = {}
+
+    def _digest(self, salt, username, password):
+        values = [v.encode('utf-8') if isinstance(v, unicode) else v for v in (username, password)]
+        return hashlib.sha256(salt + '\0'.join(values)).digest()
+
+    def add(self, username, password):
+        if self.ttl <= 0:
+            return
+        salt = os.urandom(16)
+        self._cache[username] = (time.time() + self.ttl, salt, self._digest(salt, username, password))
+
+    def check(self, username, password):
+        item = self._cache.get(username)
+        if item is None:
+            return False
+        expires, salt, digest = item
+        if expires < time.time():
+            del self._cache[username]
+            return False
+        return utils.compare(digest, self._digest(salt, username, password))
+
+    def remove(self, username):
+        self._cache.pop(username, None)
+
+class Failures(object):
+    """Tracks failed logins, a username is locked out from an address once
+    it has failed limit times from there in the last window seconds, so
+    failures from one address can't lock the user out everywhere."""
+
+    def __init__(self, limit=5, window=300):
+        self.limit = limit
+        self.window = window
+        self._failures = {}
+
+    def _recent(self, key, now):
+        return [t for t in self._failures.get(key, ()) if t > now - self.window]
+
+    def add(self, username, address=None):
+        now = time.time()
+        key = (username, address)
+        self._failures[key] = self._recent(key, now) + [now]
+        # Don't let logins that are never tried again build up
+        if len(self._failures) > 10000:
+            for key in self._failures.keys():
+                if not self._recent(key, now):
+                    del self._failures[key]
+
+    def limited(self, username, address=None):
+        if not self.limit:
+            return False
+        key = (username, address)
+        failures = self._recent(key, time.time())
+        if failures:
+            self._failures[key] = failures
+        else:
+            self._failures.pop(key, None)
+        return len(failures) >= self.limit
+
+    def clear(self, username, address=None):
+        self._failures.pop((username, address), None)
+
 class Authentication(authentication.Base):
 
     def __init__(self, *args, **kwargs):
         super(Authentication, self).__init__(*args, **kwargs)
         self.template = string.Template(self.settings.ldap.user_dn_template)
+        self.pool = Pool(self.settings.ldap)
+        self.credentials = Credentials(self.settings.ldap.cache_ttl)
+        self.failures = Failures(self.settings.ldap.max_failures, self.settings.ldap.failure_window)
 
     @defer.inlineCallbacks
-    def valid(self, username, password):
-        ldap = txldap.Connection(self.settings.ldap.uri)
-        if self.settings.ldap.start_tls and not self.settings.ldap.uri.startswith('ldaps://'):
-            yield ldap.start_tls()
+    def user_dn(self, ldap, username):
+        """Return the dn of username, it is searched for with the service
+        account if one is set and built from the template otherwise."""
+        if not self.settings.ldap.bind_dn:
+            defer.returnValue(self.template.safe_substitute({'user': txldap.dn.escape_dn_chars(username)}))
+        results = yield ldap.search(
+            self.settings.ldap.user_search,
+            txldap.SCOPE_SUBTREE,
+            '(%s=%s)' % (self.settings.ldap.user_filter_attribute, txldap.filter.escape_filter_chars(username)),
+            ['dn'],
+        )
+        results = [dn for dn, attributes in results if dn]
+        if len(results) != 1:
+            log.msg('Found %d users matching: %s' % (len(results), username))
+            defer.returnValue(None)
+        defer.returnValue(results[0])
+
+    @defer.inlineCallbacks
+    def check(self, ldap, username, password):
+        user_dn = yield self.user_dn(ldap, username)
+        if not user_dn:
+            defer.returnValue(False)
         try:
-            # NOTE(ssewell): we should probably support search and bind
-            user_dn = self.template.safe_substitute({'user': txldap.dn.escape_dn_chars(username)})
             yield ldap.bind(user_dn, password)
-            defer.returnValue(True)
+            valid = True
         except txldap.INVALID_CREDENTIALS:
+            valid = False
+        # Connections go back to the pool bound as the service account
+        yield self.pool.bind(ldap)
+        defer.returnValue(valid)
+
+    @defer.inlineCallbacks
+    def valid(self, username, password, address=None):
+        # An empty password would be an unauthenticated bind
+        if not username or not password:
             defer.returnValue(False)
+        if self.failures.limited(username, address):
+            log.msg('Too many failed logins for %s from %s' % (username, address))
+            defer.returnValue(False)
+        if self.credentials.check(username, password):
+            defer.returnValue(True)
+        try:
+            valid = yield self.pool.run(self.check, username, password)
         except txldap.LDAPError, error:
             log.err('Failed to bind: %s' % error)
-        finally:
-            try:
-                ldap.unbind()
-            except Exception, error:
-                log.err('Failed to unbind: %s' % error)
+            defer.returnValue(None)
+        if valid:
+            self.failures.clear(username, address)
+            self.credentials.add(username, password)
+        else:
+            self.failures.add(username, address)
+            self.credentials.remove(username)
+        defer.returnValue(valid)
 
 def register(settings, *args, **kwargs):
     return Authentication(settings)
@@ -0,0 +1,198 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import ConfigParser
+import hashlib
+import os
+import time
+from twisted.python import log
+from oplog import utils
+
+class Error(Exception): pass
+
+def digest(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).digest()
+
+class Bucket(object):
+    """Token bucket that refills at rate tokens a second up to burst."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count=1):
+        self.refill()
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def wait(self, count=1):
+        """Return the seconds until count tokens can be taken."""
+        self.refill()
+        return max(count - self.tokens, 0) / self.rate
+
+class Quota(object):
+    """Limit on the number of requests in a UTC day."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.day = None
+        self.used = 0
+
+    def reset(self):
+        day = time.gmtime()[:3]
+        if day != self.day:
+            self.day = day
+            self.used = 0
+
+    def take(self, count=1):
+        self.reset()
+        if self.used + count > self.limit:
+            return False
+        self.used += count
+        return True
+
+    def wait(self, count=1):
+        """Return the seconds until count requests can be taken, which is
+        the start of the next UTC day once the quota is used up."""
+        self.reset()
+        if self.used + count <= self.limit:
+            return 0
+        return 86400 - time.time() % 86400
+
+class Profile(object):
+
+    def __init__(self, name, digest, rate=0, burst=0, quota=0):
+        self.name = name
+        self.digest = digest
+        self.rate = rate
+        self.burst = burst
+        self.quota = quota
+        self.bucket = Bucket(rate, burst or int(rate) or 1) if rate > 0 else None
+        self.quotas = Quota(quota) if quota > 0 else None
+
+    def limits(self):
+        return (self.rate, self.burst, self.quota)
+
+class Profiles(object):
+    """Table of API keys compiled from the profile configuration file.
+
+    Each section is an app with a ``key`` and optional ``rate`` (requests a
+    second), ``burst`` and ``quota`` (requests a day) limits, which default to
+    the values given here. Keys are only kept as digests and compared in
+    constant time. The file is reloaded when its modification time changes
+    (checked every ``interval`` seconds) or when load is called, rate limit
+    state is kept for apps whose limits didn't change.
+    """
+
+    def __init__(self, path, rate=0, burst=0, quota=0, interval=5):
+        self.path = path
+        self.defaults = {'rate': rate, 'burst': burst, 'quota': quota}
+        self.interval = interval
+        self.mtime = None
+        self.checked = 0
+        self._profiles = {}
+
+    def _option(self, config, name, option, type):
+        if config.has_option(name, option):
+            return type(config.get(name, option))
+        return self.defaults[option]
+
+    def load(self):
+        """Load the profile file, raises Error if it can't be parsed."""
+        if not os.path.isfile(self.path):
+            raise Error('invalid profile configuration path')
+        mtime = os.stat(self.path).st_mtime
+        config = ConfigParser.ConfigParser()
+        try:
+            if not config.read([self.path]):
+                raise Error('unable to parse profile configuration file')
+            profiles = {}
+            for name in config.sections():
+                if not config.has_option(name, 'key'):
+                    continue
+                profile = Profile(
+                    name,
+                    digest(config.get(name, 'key')),
+                    rate=self._option(config, name, 'rate', float),
+                    burst=self._option(config, name, 'burst', int),
+                    quota=self._option(config, name, 'quota', int),
+                )
+                old = self._profiles.get(name)
+                if old is not None and old.limits() == profile.limits():
+                    profile.bucket, profile.quotas = old.bucket, old.quotas
+                profiles[name] = profile
+        except (ConfigParser.Error, ValueError), error:
+            raise Error('unable to parse profile configuration file: %s' % error)
+        self._profiles = profiles
+        self.mtime = mtime
+        self.checked = time.time()
+
+    def check(self):
+        """Reload the profile file if it changed, the current table is kept
+        if the new file can't be loaded."""
+        now = time.time()
+        if self.checked + self.interval > now:
+            return
+        self.checked = now
+        try:
+            if os.stat(self.path).st_mtime != self.mtime:
+                log.msg('Reloading profiles')
+                self.load()
+        except (OSError, Error), error:
+            log.err('Unable to reload profiles: %s' % error)
+
+    def valid(self, name, key):
+        self.check()
+        profile = self._profiles.get(name)
+        # Compare against something even if the app doesn't exist
+        expected = profile.digest if profile else digest('')
+        return utils.compare(expected, digest(key)) and profile is not None
+
+    def limit(self, name, count=1):
+        """Take count requests from the limits of an app, returns the reason
+        the requests were refused or None."""
+        profile = self._profiles.get(name)
+        if profile is None:
+            return
+        if profile.bucket is not None and not profile.bucket.take(count):
+            return 'rate limit exceeded'
+        if profile.quotas is not None and not profile.quotas.take(count):
+            return 'quota exceeded'
+
+    def largest(self, name):
+        """Return the most requests an app can ever make at once (its burst
+        or quota), or None if there's no such limit."""
+        profile = self._profiles.get(name)
+        if profile is None:
+            return
+        sizes = []
+        if profile.bucket is not None:
+            sizes.append(profile.bucket.burst)
+        if profile.quotas is not None:
+            sizes.append(profile.quotas.limit)
+        return min(sizes) if sizes else None
+
+    def wait(self, name, count=1):
+        """Return the seconds until an app can make count requests."""
+        profile = self._profiles.get(name)
+        if profile is None:
+            return 0
+        waits = [0]
+        if profile.bucket is not None:
+            waits.append(profile.bucket.wait(count))
+        if profile.quotas is not None:
+            waits.append(profile.quotas.wait(count))
+        return max(waits)
@@ -0,0 +1,359 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+import json
+import math
+import re
+import time
+import txmongo
+from twisted.python import log
+from twisted.python import logfile
+from oplog import utils
+
+# Guard modes: "off" runs every query, "limit" runs unindexed queries with
+# $maxTimeMS and "reject" refuses them
+MODES = ('off', 'limit', 'reject')
+
+# Operators that can be answered by walking an index
+INDEXED_OPERATORS = set(['$all', '$gt', '$gte', '$in', '$lt', '$lte'])
+
+class max_time(txmongo.filter.sort):
+    """Query filter that sets $maxTimeMS, this is a sort so txmongo accepts it
+    and it can be added to the sort filter of a query."""
+
+    def __init__(self, ms):
+        txmongo.filter._QueryFilter.__init__(self)
+        self['$maxTimeMS'] = ms
+
+def _indexed_regex(pattern, options=''):
+    # Only case sensitive prefix expressions are index bounded
+    return isinstance(pattern, basestring) and pattern.startswith('^') and \
+        'i' not in (options or '')
+
+def _indexed_condition(condition):
+    if not isinstance(condition, dict) or not condition or \
+            not all(name.startswith('$') for name in condition):
+        return True
+    if '$regex' in condition:
+        return _indexed_regex(condition['$regex'], condition.get('$options'))
+    return bool(INDEXED_OPERATORS.intersection(condition))
+
+def _fields(find):
+    """Return the fields in find with conditions that can use an index."""
+    fields = set()
+    for name, condition in find.items():
+        if name == '$and':
+            for clause in condition:
+                fields |= _fields(clause)
+        elif not name.startswith('$') and _indexed_condition(condition):
+            fields.add(name)
+    return fields
+
+def unindexed(find, indexes):
+    """Return the reason find can't be answered with an index (a list of index
+    keys as returned by oplog.index.parse), or None if it can.
+
+    This is a rule based check rather than an explain, a query is indexed if
+    it is empty, it has an index usable condition on the first field of an
+    index or every $or clause is indexed.
+    """
+    if '$where' in find:
+        return '$where can not use an index'
+    if not find:
+        return
+    firsts = set([keys[0][0] for keys in indexes if keys])
+    firsts.add('_id')
+    if _fields(find) & firsts:
+        return
+    if '$or' in find and find['$or']:
+        for clause in find['$or']:
+            reason = unindexed(clause, indexes) if clause else 'empty $or clause'
+            if reason:
+                return reason
+        return
+    return 'no index on %s' % ', '.join(sorted(n for n in find if not n.startswith('$')) or ['query'])
+
+# Marks a field that isn't in a document, unlike a field that is null
+MISSING = object()
+
+# $type names and their BSON type numbers
+TYPES = {
+    'double': 1, 'string': 2, 'object': 3, 'array': 4, 'objectId': 7,
+    'bool': 8, 'date': 9, 'null': 10, 'regex': 11, 'int': 16, 'long': 18,
+}
+
+# Operators match supports, on documents and on values
+LOGICAL_OPERATORS = set(['$and', '$or', '$nor'])
+VALUE_OPERATORS = set(['$eq', '$ne', '$in', '$nin', '$all', '$gt', '$gte',
+    '$lt', '$lte', '$exists', '$regex', '$options', '$not', '$elemMatch',
+    '$size', '$type', '$mod'])
+
+# After null (and missing fields) Mongo sorts values of different types in
+# this order (arrays aside), with their $type numbers
+SORT_TYPES = [
+    ((int, long, float), (1, 16, 18)),
+    (basestring, (2,)),
+    (dict, (3,)),
+    (txmongo.ObjectId, (7,)),
+    (bool, (8,)),
+    (datetime.datetime, (9,)),
+]
+
+def _sort_type(value):
+    if isinstance(value, bool):
+        return 4
+    for position, (kind, numbers) in enumerate(SORT_TYPES):
+        if isinstance(value, kind):
+            return position
+
+def after(value, direction):
+    """Return the conditions that match the values after value in a sort in
+    direction (1 or -1), including the values of the types Mongo sorts after
+    its type and null for a descending sort."""
+    if value is None:
+        return [{'$ne': None}] if direction == 1 else []
+    position = _sort_type(value)
+    if direction == 1:
+        conditions = [{'$gt': value}]
+        if position is not None:
+            conditions.extend([{'$type': n} for kind, numbers in SORT_TYPES[position + 1:] for n in numbers])
+        return conditions
+    conditions = [{'$lt': value}]
+    if position is not None:
+        conditions.extend([{'$type': n} for kind, numbers in SORT_TYPES[:position] for n in numbers])
+    return conditions + [None]
+
+def lookup(document, name, default=None):
+    for part in name.split('.'):
+        if not isinstance(document, dict) or part not in document:
+            return default
+        document = document[part]
+    return document
+
+def resolve(document, name):
+    """Return the value of the dotted field name in document, or MISSING.
+    Like Mongo, a path through an array of documents resolves to the list
+    of values found in its elements."""
+    value = document
+    parts = name.split('.')
+    for i, part in enumerate(parts):
+        if isinstance(value, list) and not part.isdigit():
+            values = [resolve(v, '.'.join(parts[i:])) for v in value if isinstance(v, dict)]
+            values = [v for v in values if v is not MISSING]
+            return values if values else MISSING
+        if isinstance(value, list):
+            index = int(part)
+            if index >= len(value):
+                return MISSING
+            value = value[index]
+        elif isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return MISSING
+    return value
+
+def unsupported(spec):
+    """Return the first operator in spec that match doesn't support, or
+    None."""
+    if isinstance(spec, list):
+        for value in spec:
+            operator = unsupported(value)
+            if operator:
+                return operator
+        return
+    if not isinstance(spec, dict):
+        return
+    for name, value in spec.items():
+        if name.startswith('$') and name not in LOGICAL_OPERATORS and name not in VALUE_OPERATORS:
+            return name
+        operator = unsupported(value)
+        if operator:
+            return operator
+
+def match(document, spec):
+    """Whether document matches a query, for documents that aren't in Mongo.
+    Array fields match a condition if the array or any of its elements do,
+    as they do in Mongo. Operators that aren't supported (see unsupported)
+    raise ValueError."""
+    for name, condition in spec.items():
+        if name == '$and':
+            if not all(match(document, s) for s in condition):
+                return False
+        elif name == '$or':
+            if not any(match(document, s) for s in condition):
+                return False
+        elif name == '$nor':
+            if any(match(document, s) for s in condition):
+                return False
+        elif name.startswith('$'):
+            raise ValueError('unsupported operator: %s' % name)
+        elif not match_value(resolve(document, name), condition):
+            return False
+    return True
+
+def _candidates(value):
+    # A condition on an array is tried on the array and each element
+    if value is MISSING:
+        return []
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+def _bracket(value):
+    """Return the type values have to share to be compared, Mongo doesn't
+    compare across types (Python 2 does)."""
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, long, float)):
+        return 'number'
+    if isinstance(value, basestring):
+        return 'string'
+    if isinstance(value, datetime.datetime):
+        return 'date'
+    if isinstance(value, txmongo.ObjectId):
+        return 'objectId'
+    if value is None:
+        return 'null'
+    return type(value).__name__
+
+def _type(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, float):
+        return 'double'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, long):
+        return 'long'
+    if isinstance(value, basestring):
+        return 'string'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, datetime.datetime):
+        return 'date'
+    if isinstance(value, txmongo.ObjectId):
+        return 'objectId'
+    if value is None:
+        return 'null'
+
+def _equal(value, operand):
+    if value is MISSING:
+        return operand is None
+    return any(v == operand and _bracket(v) == _bracket(operand) for v in _candidates(value))
+
+def _compare(value, operand, test):
+    return any(_bracket(v) == _bracket(operand) and test(cmp(v, operand))
+        for v in _candidates(value))
+
+def _operator_condition(condition):
+    return isinstance(condition, dict) and bool(condition) and \
+        all(n.startswith('$') and n not in LOGICAL_OPERATORS for n in condition)
+
+def match_value(value, condition):
+    """Whether a field value (MISSING if the field isn't set) matches a
+    condition."""
+    if not _operator_condition(condition):
+        return _equal(value, condition)
+    for operator, operand in condition.items():
+        if operator == '$eq':
+            if not _equal(value, operand):
+                return False
+        elif operator == '$ne':
+            if _equal(value, operand):
+                return False
+        elif operator == '$in':
+            if not any(_equal(value, o) for o in operand):
+                return False
+        elif operator == '$nin':
+            if any(_equal(value, o) for o in operand):
+                return False
+        elif operator == '$all':
+            if not operand or not all(match_value(value, o) if _operator_condition(o) else _equal(value, o)
+                    for o in operand):
+                return False
+        elif operator == '$gt':
+            if not _compare(value, operand, lambda c: c > 0):
+                return False
+        elif operator == '$gte':
+            if not _compare(value, operand, lambda c: c >= 0):
+                return False
+        elif operator == '$lt':
+            if not _compare(value, operand, lambda c: c < 0):
+                return False
+        elif operator == '$lte':
+            if not _compare(value, operand, lambda c: c <= 0):
+                return False
+        elif operator == '$exists':
+            if (value is not MISSING) != bool(operand):
+                return False
+        elif operator == '$regex':
+            flags = 0
+            for option, flag in (('i', re.I), ('m', re.M), ('s', re.S), ('x', re.X)):
+                if option in condition.get('$options', ''):
+                    flags |= flag
+            if not any(isinstance(v, basestring) and re.search(operand, v, flags) for v in _candidates(value)):
+                return False
+        elif operator == '$options':
+            continue
+        elif operator == '$not':
+            if match_value(value, operand):
+                return False
+        elif operator == '$elemMatch':
+            if not isinstance(value, list):
+                return False
+            if _operator_condition(operand):
+                matched = any(match_value(v, operand) for v in value)
+            else:
+                matched = any(isinstance(v, dict) and match(v, operand) for v in value)
+            if not matched:
+                return False
+        elif operator == '$size':
+            if not isinstance(value, list) or len(value) != operand:
+                return False
+        elif operator == '$type':
+            names = set([operand]) if isinstance(operand, basestring) else \
+                set([n for n, number in TYPES.items() if number == operand])
+            if 'number' in names:
+                names |= set(['double', 'int', 'long'])
+            if not any(_type(v) in names for v in _candidates(value)):
+                return False
+        elif operator == '$mod':
+            divisor, remainder = operand
+            if not any(_bracket(v) == 'number' and math.fmod(int(v), divisor) == remainder
+                    for v in _candidates(value)):
+                return False
+        else:
+            raise ValueError('unsupported operator: %s' % operator)
+    return True
+
+class SlowLog(object):
+    """Writes queries that take longer than threshold seconds to a file as one
+    JSON document per line."""
+
+    def __init__(self, path=None, threshold=1.0):
+        self.path = path
+        self.threshold = threshold
+        self._file = None
+
+    @property
+    def file(self):
+        if self._file is None and self.path:
+            self._file = logfile.LogFile.fromFullPath(self.path)
+        return self._file
+
+    def __call__(self, start, **query):
+        elapsed = time.time() - start
+        if not self.path or elapsed < self.threshold:
+            return
+        query['time'] = round(elapsed * 1000, 1)
+        query['date'] = time.strftime(utils.DATE_TIME, time.gmtime(start))
+        try:
+            self.file.write(json.dumps(utils.mongify.decode(query), default=repr) + '\n')
+            self.file.flush()
+        except Exception, error:
+            log.err('Unable to write slow query log: %s' % error)
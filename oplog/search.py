@@ -0,0 +1,94 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import re
+import txmongo
+
+# Name of the text index on the entry collection
+INDEX = 'entry_text'
+
+# Projection of the relevance of an entry to a $text query
+SCORE = {'$meta': 'textScore'}
+
+# Query words, "phrases" and -negated words or phrases as $text parses them
+QUERY = re.compile(r'(-?)"([^"]*)"|(-?)([^\s"]+)')
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Suffixes dropped when matching words for highlights, roughly what the Mongo
+# stemmer does for english
+SUFFIXES = ('ing', 'ed', 'es', 's')
+
+class text_index(txmongo.filter.sort):
+    """Index keys for a text index on fields, this is a sort so txmongo
+    accepts it as the keys of an index."""
+
+    def __init__(self, fields):
+        txmongo.filter._QueryFilter.__init__(self)
+        self['orderby'] = tuple([(name, 'text') for name, weight in fields])
+
+class score(txmongo.filter.sort):
+    """Query filter that sorts $text results by relevance."""
+
+    def __init__(self):
+        txmongo.filter._QueryFilter.__init__(self)
+        self['orderby'] = (('_score', SCORE),)
+
+def fields(value):
+    """Parse a search field list in the format "summary:10, host" into a list
+    of ``[(field, weight), ...]``, fields without a weight have a weight of
+    1."""
+    result = []
+    for spec in value.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        name, sep, weight = spec.partition(':')
+        try:
+            weight = int(weight) if sep else 1
+        except ValueError:
+            weight = 0
+        if not name or weight < 1:
+            raise ValueError('Invalid search field: %s' % spec)
+        result.append((name, weight))
+    return result
+
+def ensure(db, fields, language='english', collection='entry'):
+    """Create the text index over fields, a collection can only have one so
+    it has to be dropped before the fields can be changed."""
+    return db[collection].ensure_index(text_index(fields), name=INDEX,
+        weights=dict(fields), default_language=language)
+
+def terms(value):
+    """Return the lowercased words a search query is looking for (negated
+    words and phrases are left out)."""
+    result = []
+    for negate_phrase, phrase, negate_word, word in QUERY.findall(value):
+        if negate_phrase or negate_word:
+            continue
+        result.extend([w.lower() for w in WORD.findall(phrase or word)])
+    return result
+
+def stem(word):
+    word = word.lower()
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def highlights(entry, fields, words):
+    """Return the [start, end] offsets of the search words in each of the
+    text fields of entry, by field name."""
+    stems = set([stem(word) for word in words])
+    result = {}
+    for name, weight in fields:
+        value = entry
+        for part in name.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        if not isinstance(value, basestring):
+            continue
+        spans = [[m.start(), m.end()] for m in WORD.finditer(value) if stem(m.group()) in stems]
+        if spans:
+            result[name] = spans
+    return result
@@ -4,13 +4,96 @@
 # This file is subject to the MIT License (see the LICENSE file).
 
 from ops import settings
+from oplog import index
+
+# Options the service can't run without, other commands (like the benchmark)
+# don't need them
+SERVICE_REQUIRED = (('general', 'profile'), ('http', 'cookie_secret'))
 
 class Settings(settings.Settings):
 
     class General(settings.Section):
         debug = settings.Boolean(default=False)
         schema = settings.String(default='/etc/oplog/schema')
-        profile = settings.String()
+        schema_interval = settings.Integer(default=5, min_value=0)
+        profile = settings.String(required=False)
+        profile_interval = settings.Integer(default=5, min_value=0)
+
+    class Api(settings.Section):
+        batch_concurrency = settings.Integer(default=10, min_value=1)
+        stream_batch_size = settings.Integer(default=500, min_value=1)
+
+    class Index(settings.Section):
+        ensure = settings.Boolean(default=True)
+        entry = settings.String(default=index.DEFAULTS['entry'])
+        entry_history = settings.String(default=index.DEFAULTS['entry_history'])
+        entry_stats = settings.String(default=index.DEFAULTS['entry_stats'])
+
+    class Query(settings.Section):
+        guard = settings.String(default='limit')
+        max_time = settings.Integer(default=5000, min_value=0)
+        slow_log = settings.String(default='')
+        slow_time = settings.Float(default=1.0, min_value=0)
+
+    class Limit(settings.Section):
+        rate = settings.Float(default=0.0, min_value=0)
+        burst = settings.Integer(default=0, min_value=0)
+        quota = settings.Integer(default=0, min_value=0)
+
+    class Metrics(settings.Section):
+        enabled = settings.Boolean(default=True)
+        allow = settings.String(default='127.0.0.1')
+        statsd_host = settings.String(default='')
+        statsd_port = settings.Integer(default=8125)
+        statsd_prefix = settings.String(default='oplog')
+        statsd_interval = settings.Float(default=1.0, min_value=0.1)
+
+    class Partition(settings.Section):
+        # Size of the entry partitions: none, year, month or day
+        interval = settings.String(default='none')
+        refresh = settings.Integer(default=60, min_value=1)
+
+    class Archive(settings.Section):
+        # Directory of the archive segment files (empty to disable)
+        path = settings.String(default='')
+        # Days old an entry has to be to be archived
+        age = settings.Integer(default=365, min_value=1)
+        # Entries per compressed block of a segment
+        block_size = settings.Integer(default=256, min_value=1)
+
+    class History(settings.Section):
+        # Versions between full copies of an entry, the rest are deltas
+        snapshot_interval = settings.Integer(default=10, min_value=1)
+        # History records this size in bytes or larger are compressed (0 to
+        # disable)
+        compress_threshold = settings.Integer(default=1024, min_value=0)
+        # Days history is kept for (0 keeps it forever)
+        retention = settings.Integer(default=0, min_value=0)
+
+    class Search(settings.Section):
+        # Text fields in the search index, with an optional weight
+        fields = settings.String(default='summary')
+        language = settings.String(default='english')
+
+    class Stats(settings.Section):
+        enabled = settings.Boolean(default=True)
+
+    class Cache(settings.Section):
+        size = settings.Integer(default=1000, min_value=0)
+        ttl = settings.Float(default=5.0, min_value=0)
+
+    class Stream(settings.Section):
+        buffer = settings.Integer(default=1000, min_value=1)
+        timeout = settings.Integer(default=300, min_value=1)
+        keepalive = settings.Integer(default=15, min_value=1)
+        max_subscribers = settings.Integer(default=1000, min_value=1)
+
+    class Spool(settings.Section):
+        path = settings.String(default='')
+        batch_size = settings.Integer(default=500, min_value=1)
+        interval = settings.Float(default=1.0, min_value=0.01)
+        max_pending = settings.Integer(default=100000, min_value=1)
+        sync = settings.Boolean(default=True)
 
     class Plugin(settings.Section):
         authentication = settings.String(default='oplog.plugin.authentication.development')
@@ -24,23 +107,32 @@ class Settings(settings.Settings):
         url = settings.String(default='https://oplog.example.org')
         interface = settings.String(default='0.0.0.0')
         port = settings.Integer(default=80)
-        cookie_secret = settings.String()
+        cookie_secret = settings.String(required=False)
+        workers = settings.Integer(default=0, min_value=0)
+        drain_timeout = settings.Integer(default=10, min_value=0)
 
     class Ldap(settings.Section):
         uri = settings.String(default='ldaps://ldap.example.org')
         start_tls = settings.Boolean(default=True)
         user_dn_template = settings.String(default='uid=${user},ou=people,dc=example,dc=org')
-        # NOTE(ssewell): stubbed out settings I should probably implement
+        # Users are searched for with the service account if bind_dn is set
         bind_dn = settings.String(default='')
         bind_password = settings.String(default='')
         user_search = settings.String(default='ou=people,dc=example,dc=org')
         user_filter_attribute = settings.String(default='uid')
+        timeout = settings.Integer(default=5, min_value=0)
+        pool_size = settings.Integer(default=5, min_value=1)
+        cache_ttl = settings.Integer(default=300, min_value=0)
+        max_failures = settings.Integer(default=5, min_value=0)
+        failure_window = settings.Integer(default=300, min_value=1)
 
     class Mongo(settings.Section):
         host = settings.String(default='localhost')
         port = settings.Integer(default=27017)
         database = settings.String(default='oplog')
-        timeout = settings.Integer(default=3)
+        timeout = settings.Float(default=10.0, min_value=0)
+        pool_size = settings.Integer(default=5, min_value=1)
+        read_preference = settings.String(default='primary')
 
     class Theme(settings.Section):
         logo = settings.String(default='')
@@ -0,0 +1,221 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import os
+import re
+import struct
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import log
+from txmongo._pymongo import bson
+
+class Error(Exception): pass
+
+def read(path):
+    """Return the documents in a spool file, a document cut short by a crash
+    is skipped."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    documents = []
+    position = 0
+    while position + 4 <= len(data):
+        length = struct.unpack('<i', data[position:position + 4])[0]
+        if length < 5 or position + length > len(data):
+            log.err('Truncated spool document at %d in %s' % (position, path))
+            break
+        documents.append(bson.BSON(data[position:position + length]).to_dict())
+        position += length
+    return documents
+
+def orphans(path, worker=None, workers=0):
+    """Return the spool files at path that belong to no running process,
+    flushing files first.
+
+    Workers spool to path.N and a single process to path, so changing the
+    number of workers leaves spools nobody replays. The single process and
+    worker 0 claim them.
+    """
+    if worker not in (None, 0):
+        return []
+    if worker is None:
+        owned = set([path])
+    else:
+        owned = set(['%s.%d' % (path, n) for n in range(workers)])
+    directory, base = os.path.split(path)
+    pattern = re.compile(r'%s(\.\d+)?(\.flushing)?$' % re.escape(base))
+    try:
+        names = os.listdir(directory or '.')
+    except OSError, error:
+        log.err('Unable to list spool files: %s' % error)
+        return []
+    spools = set()
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            spools.add(os.path.join(directory, base + (match.group(1) or '')))
+    paths = []
+    for spool in sorted(spools - owned):
+        paths.extend([p for p in (spool + '.flushing', spool) if os.path.exists(p)])
+    return paths
+
+class Spool(object):
+    """Write-behind queue of entries.
+
+    Entries are appended to a spool file as BSON and written to Mongo in
+    batches of up to batch_size every interval seconds. Appends are synced
+    to disk once per reactor iteration (group commit) and put doesn't fire
+    until its entry is synced. When a batch is written the spool file is
+    rotated to a flushing file which is removed once the batch is in Mongo,
+    both files are replayed with upserts on start so nothing is lost or
+    duplicated by a crash, along with any orphans (spool files of processes
+    that no longer run).
+    """
+
+    def __init__(self, path, collection, batch_size=500, interval=1.0,
+            max_pending=100000, sync=True, flushed=None, orphans=()):
+        self.path = path
+        self.orphans = orphans
+        self.flushing_path = path + '.flushing'
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.sync = sync
+        self.flushed = flushed
+        self.pending = []
+        self.flushing = []
+        self._file = None
+        self._waiting = []
+        self._sync_call = None
+        self._loop = None
+        self._flush = None
+
+    @defer.inlineCallbacks
+    def start(self):
+        yield self.replay()
+        self._file = open(self.path, 'ab')
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.start(self.interval, now=False)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        # Write everything we can, anything left is replayed on start
+        try:
+            while self.pending or self.flushing:
+                yield self.flush()
+        except Exception, error:
+            log.err('Unable to flush spool on stop: %s' % error)
+        self._sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @defer.inlineCallbacks
+    def replay(self):
+        for path in list(self.orphans) + [self.flushing_path, self.path]:
+            if not os.path.exists(path):
+                continue
+            entries = read(path)
+            log.msg('Replaying %d spooled entries from %s' % (len(entries), path))
+            yield self.upsert(entries)
+            os.remove(path)
+
+    @defer.inlineCallbacks
+    def upsert(self, entries):
+        # Entries may already have been written before a crash
+        for entry in entries:
+            yield self.collection().update({'_id': entry['_id']}, entry, upsert=True, safe=True)
+        if self.flushed and entries:
+            self.flushed(entries)
+
+    def put(self, entry):
+        """Spool an entry, the returned deferred fires once it is on disk."""
+        if self._file is None:
+            raise Error('Spool is not running')
+        if len(self.pending) + len(self.flushing) >= self.max_pending:
+            raise Error('Spool is full')
+        self._file.write(bson.BSON.from_dict(entry))
+        self.pending.append(entry)
+        if len(self.pending) >= self.batch_size and self._flush is None:
+            reactor.callLater(0, self._tick)
+        if not self.sync:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if self._sync_call is None:
+            self._sync_call = reactor.callLater(0, self._sync)
+        return d
+
+    def _sync(self):
+        if self._sync_call is not None and self._sync_call.active():
+            self._sync_call.cancel()
+        self._sync_call = None
+        waiting, self._waiting = self._waiting, []
+        if self._file is None:
+            return
+        try:
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+        except (IOError, OSError), error:
+            log.err('Unable to sync spool: %s' % error)
+            for d in waiting:
+                d.errback(Error('Unable to sync spool'))
+            return
+        for d in waiting:
+            d.callback(None)
+
+    def _rotate(self):
+        """Move the spooled entries to the flushing file."""
+        self._sync()
+        self._file.close()
+        os.rename(self.path, self.flushing_path)
+        self._file = open(self.path, 'ab')
+        self.flushing, self.pending = self.pending, []
+
+    def _tick(self):
+        # Failures are retried with the next flush
+        d = defer.maybeDeferred(self.flush)
+        d.addErrback(log.err, 'Unable to flush spool')
+        return d
+
+    def flush(self):
+        """Write the spooled entries to Mongo."""
+        if self._flush is not None:
+            # Wait for the flush in progress
+            d = defer.Deferred()
+            self._flush.addBoth(lambda result: d.callback(None) or result)
+            return d
+        if not self.flushing:
+            if not self.pending or self._file is None:
+                return defer.succeed(None)
+            self._rotate()
+        d = self._write()
+        if not d.called:
+            self._flush = d
+            def done(result):
+                self._flush = None
+                return result
+            d.addBoth(done)
+        return d
+
+    @defer.inlineCallbacks
+    def _write(self):
+        while self.flushing:
+            batch = self.flushing[:self.batch_size]
+            try:
+                yield self.collection().insert(batch, safe=True)
+            except Exception, error:
+                # A retried batch may be partly written already
+                log.msg('Spool insert failed, upserting: %s' % error)
+                yield self.upsert(batch)
+            else:
+                if self.flushed:
+                    self.flushed(batch)
+            self.flushing = self.flushing[len(batch):]
+        os.remove(self.flushing_path)
@@ -1,5 +1,5 @@
-/* @type {int} Total number of entries display on page, used for query offset */
-var ENTRY_TOTAL = 0
+/* @type {string|null} Position token of the last entry displayed, used to get the next page */
+var ENTRY_AFTER = null
 
 /* @type {Date|null} oldest entry retrieved */
 var ENTRY_LATEST = null
@@ -160,7 +160,10 @@ function uiPopulateEntries(options) {
 
   var entryList = $('entry-list')
 
-  var skip = options.more ? ENTRY_TOTAL : 0
+  // Nothing left to page through
+  if (options.more && !ENTRY_AFTER) return
+
+  var after = options.more ? ENTRY_AFTER : null
   var find = {}
 
   if (options.latest && ENTRY_LATEST) {
@@ -169,16 +172,19 @@ function uiPopulateEntries(options) {
     find._date = {$lt: new Date().oplog()}
   }
 
-  entryGet({ find: find, skip: skip, sort: [['_date', -1]] }, function(err, results) {
+  entryGet({ find: find, after: after, sort: [['_date', -1]] }, function(err, result) {
     if (err) return setError(err.message || 'Unable to populate entries.')
 
     if (!options.more && !options.latest) {
-      ENTRY_TOTAL = 0
       entryList.empty()
       ENTRY_LATEST = null
     }
 
-    results.each(function(entry, i) {
+    if (!options.latest) {
+      ENTRY_AFTER = result.after
+    }
+
+    result.entries.each(function(entry, i) {
       var date = new Date(Date.parse(entry._date))
 
       if (date && (!ENTRY_LATEST || date > ENTRY_LATEST)) {
@@ -189,6 +195,51 @@ function uiPopulateEntries(options) {
   })
 }
 
+/**
+ * Add or update an entry pushed from the server
+ *
+ * @param {Object} entry Single entry
+ */
+function uiUpdateEntry(entry) {
+  var element = $(entry._id)
+
+  if (element) {
+    uiCreateEntry(entry).replaces(element)
+    return
+  }
+
+  // Older entries are picked up when paging
+  var date = new Date(Date.parse(entry._date))
+  if (ENTRY_LATEST && date < ENTRY_LATEST) return
+
+  ENTRY_LATEST = date
+  $('entry-list').grab(uiCreateEntry(entry), 'top')
+}
+
+/**
+ * Listen for entry changes pushed from the server, the browser reconnects
+ * and resumes from the last event it saw when the stream is closed
+ */
+function uiStreamEntries() {
+  if (!window.EventSource) return
+
+  var source = new EventSource('/stream')
+
+  source.addEventListener('put', function(e) {
+    uiUpdateEntry(JSON.decode(e.data))
+  }, false)
+
+  source.addEventListener('del', function(e) {
+    var element = $(JSON.decode(e.data)._id)
+    if (element) element.dispose()
+  }, false)
+
+  // Events were missed, catch up with a query
+  source.addEventListener('reset', function(e) {
+    uiPopulateEntries({latest: true})
+  }, false)
+}
+
 /**
  * Create and return entry element
  *
@@ -196,8 +247,6 @@ function uiPopulateEntries(options) {
  * @param {function} fn Callback
  */
 function uiCreateEntry(entry, fn) {
-  ENTRY_TOTAL++
-
   var date = new Date(Date.parse(entry._date))
   var now = new Date()
   var user = Cookie.read('user')
@@ -327,6 +376,7 @@ function uiEditEntry(id, fn) {
  */
 function uiOnLoad() {
   uiPopulateEntries()
+  uiStreamEntries()
 
   var datetimePicker = $('entry-datetime')
   DATEPICKER = new Picker.Date(datetimePicker, {
@@ -386,7 +436,8 @@ function uiOnLoad() {
         } else {
           entry._date = entry._date || new Date()
           entry._user = Cookie.read('user')
-          $('entry-list').grab(uiCreateEntry(entry), 'top')
+          // The entry may already have been pushed by the stream
+          if (!$(entry._id)) $('entry-list').grab(uiCreateEntry(entry), 'top')
         }
       }
     })
@@ -0,0 +1,127 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import collections
+import datetime
+import json
+from twisted.internet import defer
+from twisted.python import log
+import txmongo
+from txmongo._pymongo.son import SON
+
+UNITS = collections.OrderedDict([
+    ('minute', datetime.timedelta(minutes=1)),
+    ('hour', datetime.timedelta(hours=1)),
+    ('day', datetime.timedelta(days=1)),
+])
+
+# Fields counts can be grouped by
+GROUPS = ('_type', '_user')
+
+# Most buckets a single query can return
+MAX_BUCKETS = 10000
+
+# Collection the rollups are rebuilt in before they replace entry_stats
+REBUILD = 'entry_stats_rebuild'
+
+class Error(Exception): pass
+
+def bucket(date, unit):
+    """Return the start of the bucket of unit that date is in."""
+    if unit == 'minute':
+        return date.replace(second=0, microsecond=0)
+    elif unit == 'hour':
+        return date.replace(minute=0, second=0, microsecond=0)
+    elif unit == 'day':
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError('unknown unit: %s' % unit)
+
+def key(unit, date, _type, _user):
+    return json.dumps([unit, date.isoformat(), _type, _user])
+
+def changes(entries, sign=1, result=None):
+    """Add the count changes for entries being added (1) or removed (-1) to
+    result, keyed by (unit, bucket, _type, _user)."""
+    if result is None:
+        result = collections.defaultdict(int)
+    for entry in entries:
+        date = entry.get('_date')
+        # Only entries with a date can be counted
+        if not isinstance(date, datetime.datetime):
+            continue
+        for unit in UNITS:
+            result[(unit, bucket(date, unit), entry.get('_type'), entry.get('_user'))] += sign
+    return result
+
+def document(unit, date, _type, _user):
+    return {'_id': key(unit, date, _type, _user), 'unit': unit, 'date': date, '_type': _type, '_user': _user}
+
+def update(db, counts):
+    """Apply count changes to the rollups, every bucket is a single upsert
+    that isn't waited on."""
+    for (unit, date, _type, _user), count in counts.items():
+        if not count:
+            continue
+        d = db.entry_stats.update(document(unit, date, _type, _user), {'$inc': {'count': count}}, upsert=True)
+        d.addErrback(log.err, 'Unable to update stats')
+
+@defer.inlineCallbacks
+def rebuild(db, batch_size=1000, names=('entry',)):
+    """Recount the rollups from every entry in the collections names,
+    returns the number of entries counted.
+
+    The rollups are written to a separate collection and swapped in with
+    $out, which keeps the indexes of entry_stats and never has live updates
+    collide with the rebuilt rollups. Entries written while the rebuild runs
+    may be counted twice or not at all, so it should be run when writes are
+    stopped or quiet.
+    """
+    counts = collections.defaultdict(int)
+    total = 0
+    for name in names:
+        last = None
+        while True:
+            spec = {'_id': {'$gt': last}} if last is not None else {}
+            entries = yield db[name].find(spec, limit=batch_size, fields=['_date', '_type', '_user'],
+                filter=txmongo.filter.sort(txmongo.filter.ASCENDING('_id')))
+            if not entries:
+                break
+            changes(entries, 1, counts)
+            total += len(entries)
+            last = entries[-1]['_id']
+    yield db[REBUILD].drop(safe=True)
+    documents = []
+    for (unit, date, _type, _user), count in counts.items():
+        documents.append(dict(document(unit, date, _type, _user), count=count))
+        if len(documents) >= batch_size:
+            yield db[REBUILD].insert(documents, safe=True)
+            documents = []
+    if documents:
+        yield db[REBUILD].insert(documents, safe=True)
+    result = yield db['$cmd'].find_one(SON([
+        ('aggregate', REBUILD),
+        ('pipeline', [{'$out': 'entry_stats'}]),
+        ('cursor', {}),
+    ]))
+    if not result.get('ok'):
+        raise Error('unable to replace entry_stats: %s' % result.get('errmsg'))
+    yield db[REBUILD].drop(safe=True)
+    defer.returnValue(total)
+
+def summarize(documents, group):
+    """Sum rollup documents by bucket date and the group fields, in date
+    order."""
+    totals = collections.OrderedDict()
+    for doc in sorted(documents, key=lambda doc: doc['date']):
+        if doc.get('count', 0) <= 0:
+            continue
+        name = (doc['date'],) + tuple(doc.get(field) for field in group)
+        totals[name] = totals.get(name, 0) + doc['count']
+    results = []
+    for name, count in totals.items():
+        result = {'date': name[0], 'count': count}
+        result.update(zip(group, name[1:]))
+        results.append(result)
+    return results
@@ -0,0 +1,167 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import json
+import os
+import signal
+import sys
+import time
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.protocols import basic
+from twisted.python import log
+from oplog import api
+
+# Workers send changes to the supervisor on this descriptor and receive the
+# changes of the other workers on stdin
+CHANNEL_FD = 3
+
+# Restart delays for workers that keep crashing
+MIN_DELAY = 1
+MAX_DELAY = 30
+
+class Channel(basic.LineReceiver):
+    """Worker side of the channel to the supervisor, so every worker's live
+    stream sees all changes and drops cached results any worker changed."""
+
+    delimiter = '\n'
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def connectionMade(self):
+        api.Handler.feed.relay = lambda name, data: \
+            self.send('publish', name=name, data=data)
+        api.Handler.result_cache.relay = lambda _type, user: \
+            self.send('invalidate', _type=_type, user=user)
+
+    def send(self, kind, **values):
+        values['kind'] = kind
+        self.sendLine(json.dumps(values))
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+            kind = message.pop('kind')
+            if kind == 'publish':
+                api.Handler.feed.publish(message['name'], message['data'], relay=False)
+            elif kind == 'invalidate':
+                api.Handler.result_cache.invalidate(message['_type'], message['user'], relay=False)
+        except (KeyError, ValueError), error:
+            log.err('Invalid channel message: %s' % error)
+
+class Worker(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor, number):
+        self.supervisor = supervisor
+        self.number = number
+        self.started = time.time()
+        self.ended = defer.Deferred()
+        self._buffers = {}
+
+    def childDataReceived(self, fd, data):
+        lines = (self._buffers.get(fd, '') + data).split('\n')
+        self._buffers[fd] = lines.pop()
+        for line in lines:
+            if fd == CHANNEL_FD:
+                self.supervisor.relay(self, line)
+            elif line:
+                log.msg('[worker %d] %s' % (self.number, line))
+
+    def send(self, line):
+        self.transport.writeToChild(0, line + '\n')
+
+    def signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except Exception, error:
+            log.err('Unable to signal worker %d: %s' % (self.number, error))
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+        self.ended.callback(None)
+
+class Supervisor(service.Service):
+    """Runs the service in worker processes that each listen on the HTTP port
+    with SO_REUSEPORT.
+
+    Crashed workers are restarted (with a growing delay if they keep
+    crashing) and stopping the supervisor drains the workers with a SIGTERM,
+    any worker still running after the drain timeout is killed.
+    """
+
+    def __init__(self, settings, config_file, workers):
+        self.settings = settings
+        self.config_file = config_file
+        self.workers = {}
+        self.delays = {}
+        self.count = workers
+
+    def args(self, number):
+        return [
+            sys.executable,
+            '-c', 'from twisted.scripts.twistd import run; run()',
+            '--nodaemon',
+            '--pidfile=',
+            '--logfile=-',
+            'oplog',
+            '--config-file', self.config_file,
+            '--workers', str(self.count),
+            '--worker', str(number),
+        ]
+
+    def spawn(self, number):
+        if not self.running:
+            return
+        log.msg('Starting worker %d' % number)
+        worker = Worker(self, number)
+        reactor.spawnProcess(worker, sys.executable, self.args(number), env=os.environ,
+            childFDs={0: 'w', 1: 'r', 2: 'r', CHANNEL_FD: 'r'})
+        self.workers[number] = worker
+
+    def relay(self, sender, line):
+        for worker in self.workers.values():
+            if worker is not sender:
+                worker.send(line)
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.number) is worker:
+            del self.workers[worker.number]
+        if not self.running:
+            return
+        # Back off if the worker didn't stay up
+        if time.time() - worker.started < MAX_DELAY:
+            delay = min(self.delays.get(worker.number, MIN_DELAY / 2.0) * 2, MAX_DELAY)
+        else:
+            delay = MIN_DELAY
+        self.delays[worker.number] = delay
+        log.msg('Worker %d ended (%s), restarting in %s seconds' % (
+            worker.number, reason.value, delay))
+        reactor.callLater(delay, self.spawn, worker.number)
+
+    def reload(self):
+        for worker in self.workers.values():
+            worker.signal('HUP')
+
+    def startService(self):
+        service.Service.startService(self)
+        for number in range(self.count):
+            self.spawn(number)
+        signal.signal(signal.SIGHUP, lambda *args: reactor.callFromThread(self.reload))
+
+    def stopService(self):
+        service.Service.stopService(self)
+        workers = self.workers.values()
+        for worker in workers:
+            worker.signal('TERM')
+        kill = reactor.callLater(self.settings.http.drain_timeout + 5, self.kill)
+        d = defer.DeferredList([worker.ended for worker in workers])
+        d.addCallback(lambda result: kill.active() and kill.cancel())
+        return d
+
+    def kill(self):
+        for worker in self.workers.values():
+            log.msg('Killing worker %d' % worker.number)
+            worker.signal('KILL')
@@ -13,6 +13,27 @@ class Settings(object):
     class general(object):
         profile = schema = ''
 
+    class api(object):
+        batch_concurrency = 10
+        stream_batch_size = 2
+
+    class query(object):
+        guard = 'limit'
+        max_time = 5000
+
+    class stats(object):
+        enabled = True
+
+    class history(object):
+        snapshot_interval = 10
+        compress_threshold = 1024
+
+    class mongo(object):
+        read_preference = 'primary'
+
+    class ldap(object):
+        pool_size = 2
+
 class MongoTestCase(TestCase):
 
     mongo_host = os.environ.get('OPLOG_TEST_MONGO_HOST', 'localhost')
@@ -26,6 +47,8 @@ class MongoTestCase(TestCase):
         self.db = self.connection[self.mongo_name]
         self.user = 'testuser'
         yield self.db.entry.drop(safe=True)
+        yield self.db.entry_stats.drop(safe=True)
+        yield self.db.entry_history.drop(safe=True)
 
     @defer.inlineCallbacks
     def tearDown(self):
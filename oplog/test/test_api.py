@@ -3,12 +3,21 @@
 #
 # This file is subject to the MIT License (see the LICENSE file).
 
+import json
 from twisted.internet import defer
+import txmongo
 from oplog import api
+from oplog import cache
+from oplog import hub
 from oplog.test import helper
 
 class TestEntry(helper.MongoTestCase):
 
+    def result(self, response):
+        # entry.get results are encoded straight from Mongo
+        self.assertTrue(isinstance(response['result'], cache.Encoded))
+        return json.loads(response['result'])
+
     @defer.inlineCallbacks
     def test_del(self):
         handler = self.init(api.EntryDel)
@@ -50,9 +59,9 @@ class TestEntry(helper.MongoTestCase):
         })
 
         # Check limit
-        self.assertEqual(len(response['result']), 2)
+        self.assertEqual(len(self.result(response)), 2)
 
-        result1, result2 = response['result']
+        result1, result2 = self.result(response)
 
         # Check find, sort and skip
         self.assertEqual(result1['summary'], 'test 2')
@@ -67,6 +76,153 @@ class TestEntry(helper.MongoTestCase):
         self.assertTrue('_id' in result2)
         self.assertTrue('summary' in result2)
 
+    @defer.inlineCallbacks
+    def test_get_guard(self):
+        settings = helper.Settings()
+        settings.query = type('query', (object,), {'guard': 'reject', 'max_time': 0})
+        handler = self.init(api.EntryGet, settings=settings)
+
+        yield self.db.entry.insert({'summary': 'test 1', '_type': 'user'})
+
+        # Indexed
+        response = yield handler({'find': {'_type': 'user'}})
+        self.assertEqual(len(self.result(response)), 1)
+
+        # Unindexed
+        try:
+            yield handler({'find': {'summary': {'$regex': 'test'}}})
+        except api.Error, error:
+            self.assertEqual(error.code, api.INVALID_PARAMS)
+        else:
+            self.fail('Expected unindexed query to fail')
+
+    @defer.inlineCallbacks
+    def test_get_cache(self):
+        self.patch(api.Handler, 'result_cache', cache.Cache())
+        get = self.init(api.EntryGet)
+        put = self.init(api.EntryPut)
+        params = {'find': {'_type': 'user'}, 'sort': [['_date', -1]]}
+
+        yield put({'_type': 'user', 'summary': 'test 1'})
+        response = yield get(params)
+        self.assertTrue(isinstance(response['result'], cache.Encoded))
+        self.assertEqual(len(json.loads(response['result'])), 1)
+
+        # Cached
+        yield self.db.entry.insert({'_type': 'user', 'summary': 'test 2'})
+        response = yield get(params)
+        self.assertEqual(len(json.loads(response['result'])), 1)
+
+        # Invalidated by put
+        yield put({'_type': 'user', 'summary': 'test 3'})
+        response = yield get(params)
+        self.assertEqual(len(json.loads(response['result'])), 3)
+
+    @defer.inlineCallbacks
+    def test_put_publish(self):
+        self.patch(api.Handler, 'feed', hub.Hub())
+        messages = []
+        api.Handler.feed.subscribe(messages.append)
+
+        _id = yield self.init(api.EntryPut)({'_type': 'user', 'summary': 'test 1'})
+        yield self.init(api.EntryDel)({'_id': _id['result']})
+
+        self.assertEqual(len(messages), 2)
+        self.assertTrue('event: put\n' in messages[0])
+        self.assertTrue(_id['result'] in messages[0])
+        self.assertTrue('event: del\n' in messages[1])
+
+    @defer.inlineCallbacks
+    def test_get_pages(self):
+        handler = self.init(api.EntryGet)
+
+        yield self.db.entry.insert([{'summary': 'test %s' % i, 'number': i % 3} for i in range(7)])
+        yield self.check_count(7)
+
+        summaries = []
+        tokens = []
+        after = None
+        for i in range(3):
+            response = yield handler({'find': {}, 'sort': [['number', 1]], 'limit': 3, 'after': after})
+            result = self.result(response)
+            summaries.extend([entry['summary'] for entry in result['entries']])
+            after = result['after']
+            if not after:
+                break
+            tokens.append(after)
+
+        # Every entry exactly once, in sort order
+        self.assertEqual(after, None)
+        self.assertEqual(len(summaries), 7)
+        self.assertEqual(sorted(summaries), sorted(['test %s' % i for i in range(7)]))
+        numbers = [int(summary.split()[1]) % 3 for summary in summaries]
+        self.assertEqual(numbers, sorted(numbers))
+
+        # A valid token has to match the sort it was issued for
+        self.assertTrue(tokens)
+        try:
+            yield handler({'find': {}, 'sort': [['summary', 1]], 'after': tokens[0]})
+        except api.Error, error:
+            self.assertEqual(error.code, api.INVALID_PARAMS)
+        else:
+            self.fail('Expected a token for another sort to fail')
+
+    @defer.inlineCallbacks
+    def test_stream(self):
+        handler = self.init(api.EntryStream)
+
+        yield self.db.entry.insert([
+            {'summary': 'test 1', 'number': 1},
+            {'summary': 'test 2', 'number': 2},
+            {'summary': 'test 3', 'number': 2},
+            {'summary': 'test 4', 'number': 3},
+            {'summary': 'test 5', 'number': 4},
+        ])
+        yield self.check_count(5)
+
+        batches = []
+        yield handler.stream({
+            'find': {'summary': {'$ne': 'test 1'}},
+            'sort': [['number', -1]],
+            'fields': ['summary'],
+        }, batches.append)
+
+        # Results are written in encoded batches of stream_batch_size
+        batches = [json.loads(batch) for batch in batches]
+        self.assertEqual([len(batch) for batch in batches], [2, 2])
+
+        results = sum(batches, [])
+        self.assertEqual([r['summary'] for r in results], ['test 5', 'test 4', 'test 3', 'test 2'])
+        # Sort fields used for paging aren't returned
+        self.assertEqual(sorted(results[0].keys()), ['_id', 'summary'])
+
+        # Limit
+        batches = []
+        yield handler.stream({'find': {}, 'limit': 3}, batches.append)
+        self.assertEqual(len(sum([json.loads(batch) for batch in batches], [])), 3)
+
+    @defer.inlineCallbacks
+    def test_stream_missing(self):
+        handler = self.init(api.EntryStream)
+
+        yield self.db.entry.insert([
+            {'summary': 'test 1', 'number': 1},
+            {'summary': 'test 2'},
+            {'summary': 'test 3', 'number': 'two'},
+            {'summary': 'test 4', 'number': 3},
+            {'summary': 'test 5', 'number': None},
+        ])
+
+        # Entries missing the sort field, or with other types in it, are
+        # still returned in Mongo's order
+        for ordering, expected in ((1, ['test 2', 'test 5', 'test 1', 'test 4', 'test 3']),
+                (-1, ['test 3', 'test 4', 'test 1', 'test 5', 'test 2'])):
+            batches = []
+            yield handler.stream({'find': {}, 'sort': [['number', ordering]], 'fields': ['summary']},
+                batches.append)
+            results = sum([json.loads(batch) for batch in batches], [])
+            self.assertEqual([r['summary'] for r in results], expected)
+
     @defer.inlineCallbacks
     def test_put(self):
         handler = self.init(api.EntryPut)
@@ -102,3 +258,54 @@ class TestEntry(helper.MongoTestCase):
         # Data actually got updated
         self.assertEqual(str(entry['_id']), _id)
         self.assertEqual(entry['summary'], 'hello world2')
+
+    @defer.inlineCallbacks
+    def test_put_invalid_update(self):
+        handler = self.init(api.EntryPut)
+
+        response = yield handler({'summary': 'hello world', '_type': 'test'})
+        _id = response['result']
+
+        # Removing a required field fails validation before anything is
+        # written
+        try:
+            yield handler({'_id': _id, '$unset': {'_type': 1}})
+        except api.Error:
+            pass
+        else:
+            self.fail('Expected update to fail validation')
+
+        entry = yield self.db.entry.find_one({})
+        self.assertEqual(entry['_type'], 'test')
+        self.assertTrue('_version' not in entry)
+
+    @defer.inlineCallbacks
+    def test_put_many(self):
+        handler = self.init(api.EntryPutMany)
+
+        yield self.check_count(0)
+        response = yield handler({'entries': [
+            {'summary': 'test 1', '_type': 'test'},
+            {'summary': 'test 2', '_type': 'test'},
+            {'summary': 'test 3', '_type': 'test'},
+        ]})
+        yield self.check_count(3)
+
+        ids = response['result']
+
+        # Check result is list of ids in request order
+        self.assertEqual(len(ids), 3)
+        for _id, summary in zip(ids, ['test 1', 'test 2', 'test 3']):
+            self.assertTrue(isinstance(_id, basestring))
+            entry = yield self.db.entry.find_one({'_id': txmongo.ObjectId(_id)})
+            self.assertEqual(entry['summary'], summary)
+            self.assertEqual(entry['_user'], self.user)
+
+        # Nothing is written if any entry is invalid
+        try:
+            yield handler({'entries': [{'summary': 'test 4'}, {'_id': ids[0]}]})
+        except api.Error:
+            pass
+        else:
+            self.fail('Expected entry.put_many to reject an update')
+        yield self.check_count(3)
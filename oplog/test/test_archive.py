@@ -0,0 +1,159 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from twisted.internet import defer
+import txmongo
+from oplog import api
+from oplog import archive
+from oplog.test import helper
+
+def entries(count, start=datetime.datetime(2010, 1, 1)):
+    return [{'_id': txmongo.ObjectId(), '_date': start + datetime.timedelta(days=i), 'n': i}
+        for i in range(count)]
+
+class TestSegment(helper.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'test.seg')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_segment(self):
+        archive.write(self.path, entries(10), block_size=3)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        segment = archive.Segment(self.path)
+        self.assertEqual((segment.first, segment.last, segment.count), (datetime.datetime(2010, 1, 1),
+            datetime.datetime(2010, 1, 10), 10))
+        self.assertEqual([b['count'] for b in segment.blocks], [3, 3, 3, 1])
+        self.assertEqual([e['n'] for e in segment.find({'n': {'$gte': 8}})], [8, 9])
+        # Only the blocks that overlap the date range are read
+        low, high = datetime.datetime(2010, 1, 5), datetime.datetime(2010, 1, 6)
+        self.assertEqual([e['n'] for e in segment.find({}, low, high)], [3, 4, 5])
+        segment.close()
+
+    def test_writer(self):
+        writer = archive.Writer(self.path + '.tmp')
+        writer.add(entries(2))
+        # Blocks are written as they are added, only their index is kept
+        self.assertEqual((writer.count, writer.blocks[0]['offset']), (2, len(archive.MAGIC)))
+        writer.add(entries(1, datetime.datetime(2010, 1, 3)))
+        writer.close(self.path)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        segment = archive.Segment(self.path)
+        self.assertEqual((segment.first, segment.last, segment.count), (datetime.datetime(2010, 1, 1),
+            datetime.datetime(2010, 1, 3), 3))
+        self.assertEqual([b['count'] for b in segment.blocks], [2, 1])
+        segment.close()
+        writer = archive.Writer(self.path + '.tmp')
+        writer.abort()
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_invalid(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a segment')
+        self.assertRaises(archive.Error, archive.Segment, self.path)
+
+    def test_find(self):
+        archive.write(self.path, entries(10), block_size=3)
+        a = archive.Archive(self.tempdir)
+        # Queries without a date range never read the archive
+        self.assertEqual(a.find({'n': 1}), [])
+        self.assertEqual(a.find({'_date': {'$gte': datetime.datetime(2011, 1, 1)}}), [])
+        results = a.find({'_date': {'$lt': datetime.datetime(2010, 1, 3)}})
+        self.assertEqual([e['n'] for e in results], [0, 1])
+        self.assertFalse(archive.Archive().enabled)
+
+    def test_limit(self):
+        archive.write(self.path, entries(10), block_size=2)
+        a = archive.Archive(self.tempdir)
+        a.refresh()
+        segment = a.segments[self.path]
+        reads = []
+        read = segment.read
+        segment.read = lambda block, spec: reads.append(block) or read(block, spec)
+        spec = {'_date': {'$gte': datetime.datetime(2010, 1, 1)}}
+        descending = txmongo.filter.sort(txmongo.filter.DESCENDING('_date'))
+        self.assertEqual([e['n'] for e in a.find(spec, limit=3, filter=descending)], [9, 8, 7])
+        # Reading stops once no other block can have a later entry
+        self.assertEqual(len(reads), 2)
+        # A stream position narrows the range read
+        del reads[:]
+        position = {'$or': [{'_date': {'$lt': datetime.datetime(2010, 1, 4)}},
+            {'_date': datetime.datetime(2010, 1, 4), '_id': {'$lt': txmongo.ObjectId()}}]}
+        results = a.find(dict(spec, **position), limit=2, filter=descending)
+        self.assertEqual([e['n'] for e in results], [3, 2])
+        self.assertEqual(len(reads), 1)
+
+class TestArchive(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(TestArchive, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        yield super(TestArchive, self).tearDown()
+
+    def init(self, call, **kwargs):
+        handler = super(TestArchive, self).init(call, **kwargs)
+        handler.archive = archive.Archive(self.tempdir)
+        return handler
+
+    @defer.inlineCallbacks
+    def test_archive(self):
+        put = self.init(api.EntryPut)
+        for summary, date in (('one', '2010-01-31T12:00:00Z'), ('two', '2010-02-01T12:00:00Z'),
+                ('three', '2010-03-01T12:00:00Z'), ('four', '2011-06-01T12:00:00Z')):
+            yield put({'_type': 'deploy', 'summary': summary, '_date': date})
+
+        total = yield archive.run(self.db.entry, self.tempdir, datetime.datetime(2011, 1, 1), block_size=2)
+        self.assertEqual(total, 3)
+        yield self.check_count(1)
+        # A segment per month
+        self.assertEqual(len([n for n in os.listdir(self.tempdir) if n.endswith(archive.EXTENSION)]), 3)
+
+        get = self.init(api.EntryGet)
+        response = yield get({'find': {'_date': {'$gte': '2010-02-01T00:00:00Z'}}, 'sort': [['_date', 1]],
+            'fields': ['summary'], 'skip': 1, 'limit': 2})
+        self.assertEqual([e['summary'] for e in json.loads(response['result'])], ['three', 'four'])
+        self.assertFalse('_date' in json.loads(response['result'])[0])
+        response = yield get({'find': {}})
+        self.assertEqual([e['summary'] for e in json.loads(response['result'])], ['four'])
+
+    @defer.inlineCallbacks
+    def test_segment_size(self):
+        put = self.init(api.EntryPut)
+        for day in range(1, 8):
+            yield put({'_type': 'deploy', 'summary': str(day), '_date': '2010-01-%02dT12:00:00Z' % day})
+
+        total = yield archive.run(self.db.entry, self.tempdir, datetime.datetime(2011, 1, 1),
+            block_size=2, segment_size=4)
+        self.assertEqual(total, 7)
+        yield self.check_count(0)
+        # A month is split once a segment reaches segment_size entries
+        names = sorted([n for n in os.listdir(self.tempdir) if n.endswith(archive.EXTENSION)])
+        counts = [archive.Segment(os.path.join(self.tempdir, n)).count for n in names]
+        self.assertEqual(counts, [4, 3])
+        self.assertEqual([n for n in os.listdir(self.tempdir) if n.endswith('.tmp')], [])
+
+    @defer.inlineCallbacks
+    def test_unsupported(self):
+        get = self.init(api.EntryGet)
+        # Queries that read the archive can only use operators it can match
+        try:
+            yield get({'find': {'_date': {'$lt': '2011-01-01T00:00:00Z'}, 'loc': {'$near': [0, 0]}}})
+        except api.Error, error:
+            self.assertEqual(error.code, api.INVALID_PARAMS)
+        else:
+            self.fail('Expected an unsupported operator')
@@ -0,0 +1,109 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import time
+from twisted.internet import defer
+from oplog.plugin.authentication import ldap
+from oplog.test import helper
+
+class Connection(object):
+
+    def __init__(self, down=False):
+        self.down = down
+        self.unbound = False
+
+    def unbind(self):
+        self.unbound = True
+        return defer.succeed(None)
+
+class TestPool(helper.TestCase):
+
+    def setUp(self):
+        self.pool = ldap.Pool(helper.Settings.ldap)
+        self.connections = []
+        def connect():
+            self.connections.append(Connection())
+            return defer.succeed(self.connections[-1])
+        self.pool.connect = connect
+
+    def search(self, connection):
+        if connection.down:
+            raise ldap.txldap.SERVER_DOWN()
+        return defer.succeed(connection)
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        connection = yield self.pool.run(self.search)
+        self.assertEqual(self.pool.idle, [connection])
+        result = yield self.pool.run(self.search)
+        self.assertTrue(result is connection)
+        self.assertEqual(len(self.connections), 1)
+
+    @defer.inlineCallbacks
+    def test_stale(self):
+        stale = [Connection(down=True), Connection(down=True)]
+        self.pool.idle.extend(stale)
+        # A stale idle connection is retried once with a fresh one
+        connection = yield self.pool.run(self.search)
+        self.assertTrue(connection is self.connections[0])
+        self.assertTrue(stale[0].unbound and stale[1].unbound)
+        self.assertEqual(self.pool.idle, [connection])
+        # A fresh connection that fails isn't retried
+        self.pool.idle[:] = []
+        connection.down = True
+        self.pool.connect = lambda: defer.succeed(connection)
+        yield self.assertFailure(self.pool.run(self.search), ldap.txldap.SERVER_DOWN)
+        self.assertEqual(self.pool.idle, [])
+
+class TestCredentials(helper.TestCase):
+
+    def test_check(self):
+        credentials = ldap.Credentials(ttl=300)
+        self.assertFalse(credentials.check('user', 'secret'))
+        credentials.add('user', u'secret')
+        self.assertTrue(credentials.check('user', 'secret'))
+        self.assertFalse(credentials.check('user', 'wrong'))
+        self.assertFalse(credentials.check('other', 'secret'))
+        # Only a hash is stored
+        self.assertFalse('secret' in repr(credentials._cache))
+        credentials.remove('user')
+        self.assertFalse(credentials.check('user', 'secret'))
+
+    def test_ttl(self):
+        credentials = ldap.Credentials(ttl=0.01)
+        credentials.add('user', 'secret')
+        time.sleep(0.02)
+        self.assertFalse(credentials.check('user', 'secret'))
+        credentials = ldap.Credentials(ttl=0)
+        credentials.add('user', 'secret')
+        self.assertFalse(credentials.check('user', 'secret'))
+
+class TestFailures(helper.TestCase):
+
+    def test_limited(self):
+        failures = ldap.Failures(limit=2, window=300)
+        failures.add('user')
+        self.assertFalse(failures.limited('user'))
+        failures.add('user')
+        self.assertTrue(failures.limited('user'))
+        self.assertFalse(failures.limited('other'))
+        failures.clear('user')
+        self.assertFalse(failures.limited('user'))
+
+    def test_address(self):
+        failures = ldap.Failures(limit=1, window=300)
+        failures.add('user', '10.0.0.1')
+        self.assertTrue(failures.limited('user', '10.0.0.1'))
+        # Failures from one address don't lock the user out of others
+        self.assertFalse(failures.limited('user', '10.0.0.2'))
+        failures.clear('user', '10.0.0.2')
+        self.assertTrue(failures.limited('user', '10.0.0.1'))
+
+    def test_window(self):
+        failures = ldap.Failures(limit=1, window=0.01)
+        failures.add('user')
+        self.assertTrue(failures.limited('user'))
+        time.sleep(0.02)
+        self.assertFalse(failures.limited('user'))
@@ -0,0 +1,67 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+from twisted.internet import defer
+from oplog import benchmark
+from oplog import settings
+from oplog.test import helper
+
+class TestBenchmark(helper.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([3], 99), 3)
+        self.assertEqual(benchmark.percentile([], 50), 0.0)
+
+    def test_compare(self):
+        result = benchmark.Result('entry.get', [0.001] * 99 + [0.01], 0.1)
+        self.assertEqual(result.compare({'p50': 0.001, 'p99': 0.001, 'throughput': 1000}), [])
+        self.assertEqual(len(result.compare({'p50': 0.0005, 'throughput': 2000})), 2)
+
+    def init(self):
+        s = settings.Settings('oplog', optparse=False).parse()
+        s.cache.size = 0
+        return benchmark.Benchmark(s, benchmark.Database(), iterations=5, size=2, seed=10)
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        results = yield self.init().run()
+        self.assertEqual([r.name for r in results], list(benchmark.Benchmark.names))
+        for result in results:
+            self.assertEqual(result.count, 5)
+
+    @defer.inlineCallbacks
+    def test_del(self):
+        b = self.init()
+        yield b.run(['entry.del'])
+        count = yield b.db.entry.count()
+        self.assertEqual(count, 5)
+
+    @defer.inlineCallbacks
+    def test_command(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'baseline.json')
+        out = StringIO.StringIO()
+        code = yield benchmark.command(['-n', '2', '-s', '1', '-w', path, 'mongify.encode', 'entry.get'], out)
+        self.assertEqual(code, 0)
+        self.assertEqual(out.getvalue().splitlines()[0].split()[0], 'benchmark')
+        with open(path) as f:
+            self.assertEqual(sorted(json.load(f)), ['entry.get', 'mongify.encode'])
+        # Anything is a regression against an impossible baseline
+        with open(path, 'w') as f:
+            json.dump({'mongify.encode': {'p50': 0, 'p99': 0, 'throughput': 1e12}}, f)
+        code = yield benchmark.command(['-n', '2', '-b', path, 'mongify.encode'], StringIO.StringIO())
+        self.assertEqual(code, 2)
+        self.patch(sys, 'stderr', StringIO.StringIO())
+        self.assertRaises(SystemExit, benchmark.command, ['unknown'])
@@ -0,0 +1,79 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import time
+from oplog import cache
+from oplog.test import helper
+
+class TestCache(helper.TestCase):
+
+    def test_encode(self):
+        result = cache.Encoded.encode([{'summary': 'test'}])
+        self.assertEqual(cache.encode({'result': result}), '{"result": [{"summary": "test"}]}')
+        self.assertEqual(cache.encode({'result': 1}), '{"result": 1}')
+
+    def test_key(self):
+        c = cache.Cache()
+        self.assertEqual(
+            c.key({'find': {'a': 1, 'b': 2}, 'limit': 1}),
+            c.key({'limit': 1, 'find': {'b': 2, 'a': 1}}),
+        )
+
+    def test_lru(self):
+        c = cache.Cache(size=2)
+        c.set('one', 1)
+        c.set('two', 2)
+        self.assertEqual(c.get('one'), 1)
+        c.set('three', 3)
+        self.assertEqual(c.get('two'), None)
+        self.assertEqual(c.get('one'), 1)
+        self.assertEqual(c.get('three'), 3)
+
+    def test_ttl(self):
+        c = cache.Cache(ttl=0.01)
+        c.set('one', 1)
+        self.assertEqual(c.get('one'), 1)
+        time.sleep(0.02)
+        self.assertEqual(c.get('one'), None)
+        c = cache.Cache(size=0)
+        c.set('one', 1)
+        self.assertEqual(c.get('one'), None)
+
+    def test_invalidate(self):
+        c = cache.Cache()
+        c.set('any', 1)
+        c.set('deploy', 2, 'deploy')
+        c.set('user', 3, 'user')
+        c.set('deploy-one', 4, 'deploy', 'one')
+        c.set('deploy-two', 5, 'deploy', 'two')
+        c.invalidate('deploy', 'one')
+        self.assertEqual(c.get('any'), None)
+        self.assertEqual(c.get('deploy'), None)
+        self.assertEqual(c.get('deploy-one'), None)
+        self.assertEqual(c.get('user'), 3)
+        self.assertEqual(c.get('deploy-two'), 5)
+
+    def test_generation(self):
+        c = cache.Cache()
+        generation = c.generation
+        c.invalidate('deploy', 'one')
+        c.set('any', 1, generation=generation)
+        self.assertEqual(c.get('any'), None)
+
+    def test_current(self):
+        c = cache.Cache()
+        deploy, user, one = c.current('deploy'), c.current('user'), c.current('deploy', 'one')
+        c.invalidate('deploy', 'two')
+        # Only results a write could change are kept out
+        c.set('deploy', 1, 'deploy', generation=deploy)
+        c.set('user', 2, 'user', generation=user)
+        c.set('deploy-one', 3, 'deploy', 'one', generation=one)
+        self.assertEqual(c.get('deploy'), None)
+        self.assertEqual(c.get('user'), 2)
+        self.assertEqual(c.get('deploy-one'), 3)
+        user = c.current('user')
+        c.clear()
+        c.set('user', 2, 'user', generation=user)
+        self.assertEqual(c.get('user'), None)
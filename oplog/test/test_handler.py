@@ -0,0 +1,168 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import json
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.test import proto_helpers
+from oplog import api
+from oplog import handler
+from oplog import settings
+from oplog import web
+from oplog.test import helper
+
+class TestRouteBatch(helper.TestCase):
+
+    def setUp(self):
+        self.handler = handler.Api.__new__(handler.Api)
+        self.handler.settings = helper.Settings()
+        self.pending = {}
+        self.running = []
+        self.most = 0
+        self.patch(api, 'route', self.route)
+
+    def route(self, user, request, message):
+        # Messages finish when the test fires them
+        self.running.append(message['id'])
+        self.most = max(self.most, len(self.running))
+        d = self.pending[message['id']] = defer.Deferred()
+        def done(result):
+            self.running.remove(message['id'])
+            return result
+        return d.addBoth(done)
+
+    def messages(self, count):
+        return [{'method': 'entry.get', 'params': {}, 'id': i} for i in range(count)]
+
+    def test_order(self):
+        results = []
+        self.handler.route_batch('user', self.messages(3)).addCallback(results.append)
+        # Finishing out of order still answers in request order
+        for i, value in ((2, 'two'), (0, 'zero'), (1, 'one')):
+            self.pending[i].callback({'result': value})
+        self.assertEqual(results, [[{'result': 'zero'}, {'result': 'one'}, {'result': 'two'}]])
+
+    def test_errors(self):
+        results = []
+        self.handler.route_batch('user', self.messages(3)).addCallback(results.append)
+        self.pending[0].callback({'result': 'zero'})
+        self.pending[1].errback(api.Error(api.INVALID_PARAMS))
+        self.pending[2].errback(ValueError('unexpected'))
+        self.assertEqual(results, [[
+            {'result': 'zero'},
+            {'error': {'code': api.INVALID_PARAMS, 'message': 'Invalid params'}},
+            {'error': {'code': api.INTERNAL_ERROR, 'message': 'Internal error'}},
+        ]])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_concurrency(self):
+        self.handler.settings.api = type('api', (object,), {'batch_concurrency': 2})
+        results = []
+        self.handler.route_batch('user', self.messages(5)).addCallback(results.append)
+        self.assertEqual(sorted(self.running), [0, 1])
+        # A message is started as soon as another one finishes
+        self.pending[1].callback({'result': 1})
+        self.assertEqual(sorted(self.running), [0, 2])
+        for i in (0, 2, 3, 4):
+            self.pending[i].callback({'result': i})
+        self.assertEqual(self.most, 2)
+        self.assertEqual([r['result'] for r in results[0]], [0, 1, 2, 3, 4])
+
+class HttpTestCase(helper.TestCase):
+    """Runs requests through the application on a fake connection."""
+
+    def setUp(self):
+        # The application replaces the shared handler state
+        for name in ('indexes', 'search_fields', 'slow_log', 'result_cache', 'feed', 'metrics',
+                'partitions', 'archive'):
+            self.patch(api.Handler, name, getattr(api.Handler, name))
+        self.patch(web.Handler, 'settings', web.Handler.settings)
+        self.settings = settings.Settings('oplog', optparse=False).parse()
+        self.application = web.Application(list(handler.route), self.settings)
+
+    def request(self, data):
+        self.transport = proto_helpers.StringTransport()
+        self.server = self.application.buildProtocol(None)
+        self.server.makeConnection(self.transport)
+        self.server.dataReceived(data)
+
+class TestApiStream(HttpTestCase):
+
+    def setUp(self):
+        super(TestApiStream, self).setUp()
+        self.patch(handler.Api, 'get_current_user', lambda handler: 'user')
+        self.patch(api, 'stream', self.stream)
+
+    def stream(self, user, request, message, write):
+        # Batches are written by the test
+        self.write = write
+        self.finished = defer.Deferred()
+        return self.finished
+
+    def post(self):
+        body = json.dumps({'method': 'entry.stream', 'params': {'find': {}}})
+        self.request('POST /api HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+
+    def body(self):
+        # Responses without a length are sent chunked
+        data = self.transport.value().split('\r\n\r\n', 1)[1]
+        chunks = []
+        while data:
+            size, data = data.split('\r\n', 1)
+            chunks.append(data[:int(size, 16)])
+            data = data[int(size, 16) + 2:]
+        return ''.join(chunks)
+
+    def test_stream(self):
+        self.post()
+        results = []
+        self.write('[1,2]').addCallback(results.append)
+        self.assertEqual(results, [True])
+        self.assertTrue('Connection: close' in self.transport.value())
+        # Writes wait for the transport to drain
+        self.transport.producer.pauseProducing()
+        self.write('[3]').addCallback(results.append)
+        self.assertEqual(results, [True])
+        self.transport.producer.resumeProducing()
+        self.assertEqual(results, [True, True])
+        self.finished.callback(None)
+        self.assertEqual(json.loads(self.body()), {'result': [1, 2, 3]})
+        self.assertTrue(self.transport.value().endswith('\r\n0\r\n\r\n'))
+        # The end of the result is the end of the connection
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.transport.producer, None)
+
+    def test_disconnect(self):
+        self.post()
+        results = []
+        self.transport.producer.pauseProducing()
+        self.write('[1]').addCallback(results.append)
+        self.transport.producer.stopProducing()
+        self.assertEqual(results, [False])
+        self.assertEqual(self.write('[2]'), False)
+        self.finished.callback(None)
+
+    def test_error(self):
+        self.post()
+        self.write('[1]')
+        self.finished.errback(api.ServerError('Failed to query entries'))
+        # An error response can't follow part of the result
+        self.assertTrue(self.transport.disconnected)
+        self.assertEqual(self.body(), '{"result": [1')
+        self.assertFalse(self.transport.value().endswith('\r\n0\r\n\r\n'))
+
+class TestStream(HttpTestCase):
+
+    def test_timeout(self):
+        clock = task.Clock()
+        self.patch(handler, 'reactor', clock)
+        self.patch(handler.Stream, 'get_current_user', lambda handler: 'user')
+        self.request('GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertTrue('text/event-stream' in self.transport.value())
+        self.assertFalse(self.transport.disconnecting)
+        # The client only reconnects if the connection is closed
+        clock.advance(self.settings.stream.timeout)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(len(api.Handler.feed.subscribers), 0)
@@ -0,0 +1,84 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+from twisted.internet import defer
+from oplog import api
+from oplog import history
+from oplog.test import helper
+
+class TestHistory(helper.TestCase):
+
+    def test_diff(self):
+        old = {'_id': 1, 'summary': 'old', 'details': {'host': 'web1', 'port': 80}, 'done': True}
+        new = {'_id': 1, 'summary': 'new', 'details': {'host': 'web1'}, 'done': 1, 'tags': ['a']}
+        sets, unsets = history.diff(new, old)
+        self.assertEqual(sorted(sets), [['details.port', 80], ['done', True], ['summary', 'old']])
+        self.assertEqual(unsets, ['tags'])
+        self.assertEqual(history.apply(new, {'set': sets, 'unset': unsets}), old)
+
+    def test_record(self):
+        old = {'_id': 1, '_version': 1, 'summary': 'old', 'details': 'x' * 100}
+        new = dict(old, _version=2, summary='new')
+        r = history.record(old, new, 'entry.put', threshold=0)
+        self.assertEqual((r['entry'], r['version'], r['type']), (1, 1, 'entry.put'))
+        self.assertFalse('body' in r)
+        self.assertEqual(history.rebuild([r], new, 1), old)
+        # Deletes and every snapshot_interval versions are stored in full
+        self.assertEqual(history.record(old, None, 'entry.del')['body'], old)
+        self.assertTrue('body' in history.record(old, new, 'entry.put', snapshot_interval=1))
+
+    def test_compress(self):
+        old = {'_id': 1, 'summary': 'x' * 2000}
+        r = history.record(old, None, 'entry.del', threshold=1024)
+        self.assertTrue(isinstance(r['body'], basestring))
+        self.assertTrue(len(r['body']) < 1024)
+        self.assertEqual(history.unpack(r['body']), old)
+
+    def test_incomplete(self):
+        old = {'_id': 1, '_version': 1, 'a': 1, 'details': 'x' * 100}
+        records = [history.record(old, dict(old, _version=2, a=2), 'entry.put')]
+        self.assertTrue('delta' in records[0])
+        # The delta from version 3 to 2 is missing
+        self.assertRaises(ValueError, history.rebuild, records, dict(old, _version=3, a=3), 1)
+
+class TestEntryHistory(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def get_history(self, **params):
+        response = yield self.init(api.EntryHistory)(params)
+        defer.returnValue(response['result'])
+
+    @defer.inlineCallbacks
+    def test_history(self):
+        put = self.init(api.EntryPut)
+        _id = (yield put({'_type': 'deploy', 'summary': 'version 0', 'host': 'web1'}))['result']
+        yield put({'_id': _id, '$set': {'summary': 'version 1'}})
+        yield put({'_id': _id, '$set': {'summary': 'version 2'}, '$unset': {'host': 1}})
+
+        result = yield self.get_history(_id=_id)
+        self.assertEqual(result['current'], 2)
+        self.assertEqual([v['version'] for v in result['versions']], [1, 0])
+        # Only the first version is a full copy
+        records = yield self.db.entry_history.find({'entry': {'$exists': True}})
+        self.assertEqual(len([r for r in records if 'body' in r]), 1)
+
+        entry = yield self.get_history(_id=_id, version=1)
+        self.assertEqual((entry['summary'], entry['host'], entry['_version']), ('version 1', 'web1', 1))
+        entry = yield self.get_history(_id=_id, version=0)
+        self.assertEqual((entry['summary'], entry['host']), ('version 0', 'web1'))
+
+        # Versions can still be rebuilt once the entry is deleted
+        yield self.init(api.EntryDel)({'_id': _id})
+        entry = yield self.get_history(_id=_id, version=2)
+        self.assertEqual(entry['summary'], 'version 2')
+        entry = yield self.get_history(_id=_id, version=0)
+        self.assertEqual(entry['summary'], 'version 0')
+
+        try:
+            yield self.get_history(_id=_id, version=5)
+        except api.Error, error:
+            self.assertEqual(error.code, api.INVALID_PARAMS)
+        else:
+            self.fail('Expected a missing version')
@@ -0,0 +1,69 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+from oplog import hub
+from oplog.test import helper
+
+class TestHub(helper.TestCase):
+
+    def event_id(self, message):
+        return message.split('\n')[0][len('id: '):]
+
+    def test_event(self):
+        self.assertEqual(hub.event('a-1', 'put', {'_id': '1'}),
+            'id: a-1\nevent: put\ndata: {"_id": "1"}\n\n')
+
+    def test_publish(self):
+        h = hub.Hub()
+        one, two = [], []
+        h.subscribe(one.append)
+        h.subscribe(two.append)
+        h.publish('put', {'_id': '1'})
+        self.assertEqual(len(one), 1)
+        self.assertEqual(one, two)
+        h.unsubscribe(two.append)
+        h.publish('put', {'_id': '2'})
+        self.assertEqual(len(one), 2)
+        self.assertEqual(len(two), 1)
+
+    def test_resume(self):
+        h = hub.Hub(size=2)
+        messages = []
+        h.subscribe(messages.append)
+        for i in range(3):
+            h.publish('put', {'_id': str(i)})
+
+        # Resume after the second event
+        resumed = []
+        self.assertTrue(h.subscribe(resumed.append, self.event_id(messages[1])))
+        self.assertEqual(resumed, messages[2:])
+
+        # Up to date
+        resumed = []
+        self.assertTrue(h.subscribe(resumed.append, self.event_id(messages[2])))
+        self.assertEqual(resumed, [])
+
+    def test_reset(self):
+        h = hub.Hub(size=2)
+        messages = []
+        h.subscribe(messages.append)
+        for i in range(4):
+            h.publish('put', {'_id': str(i)})
+
+        # The event after the first is no longer buffered
+        self.assertFalse(h.subscribe([].append, self.event_id(messages[0])))
+        self.assertTrue(h.subscribe([].append, self.event_id(messages[1])))
+        # Event from another hub
+        self.assertFalse(h.subscribe([].append, 'other-1'))
+        self.assertFalse(h.subscribe([].append, 'invalid'))
+
+    def test_relay(self):
+        h = hub.Hub()
+        relayed = []
+        h.relay = lambda name, data: relayed.append((name, data))
+        h.publish('put', {'_id': '1'})
+        h.publish('del', {'_id': '2'}, relay=False)
+        self.assertEqual(relayed, [('put', {'_id': '1'})])
+        self.assertEqual(h.counter, 2)
@@ -0,0 +1,33 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+from twisted.internet import defer
+from oplog import index
+from oplog.test import helper
+
+class TestParse(helper.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(index.parse('_date:-1; _type:1,_date:-1;'), [
+            [('_date', -1)],
+            [('_type', 1), ('_date', -1)],
+        ])
+        self.assertEqual(index.parse(''), [])
+
+    def test_parse_invalid(self):
+        self.assertRaises(ValueError, index.parse, '_date')
+        self.assertRaises(ValueError, index.parse, '_date:2')
+        self.assertRaises(ValueError, index.parse, ':1')
+
+class TestEnsure(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def test_ensure(self):
+        yield index.ensure(self.db, {'entry': index.parse('_type:1,_date:-1')})
+        information = yield index.information(self.db, 'entry')
+        self.assertTrue('_type_1__date_-1' in information)
+        yield index.drop(self.db, 'entry', '_type_1__date_-1')
+        information = yield index.information(self.db, 'entry')
+        self.assertFalse('_type_1__date_-1' in information)
@@ -0,0 +1,88 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+from oplog import api
+from oplog import metrics
+from oplog.test import helper
+
+class TestRegistry(helper.TestCase):
+
+    def test_count(self):
+        registry = metrics.Registry()
+        registry.count('oplog_requests_total', method='entry.get')
+        registry.count('oplog_requests_total', 2, method='entry.get')
+        registry.count('oplog_errors_total', method='entry.get', code=-32602)
+        self.assertEqual(registry.render().split('\n'), [
+            '# HELP oplog_errors_total API errors by method and error code.',
+            '# TYPE oplog_errors_total counter',
+            'oplog_errors_total{code="-32602",method="entry.get"} 1',
+            '# HELP oplog_requests_total API messages by method.',
+            '# TYPE oplog_requests_total counter',
+            'oplog_requests_total{method="entry.get"} 3',
+            '',
+        ])
+
+    def test_observe(self):
+        registry = metrics.Registry()
+        registry.observe('test_bytes', 100, buckets=(10, 100))
+        registry.observe('test_bytes', 5, buckets=(10, 100))
+        registry.observe('test_bytes', 1000, buckets=(10, 100))
+        self.assertEqual(registry.render().split('\n'), [
+            '# TYPE test_bytes histogram',
+            'test_bytes_bucket{le="10"} 1',
+            'test_bytes_bucket{le="100"} 2',
+            'test_bytes_bucket{le="+Inf"} 3',
+            'test_bytes_sum 1105.0',
+            'test_bytes_count 3',
+            '',
+        ])
+
+    def test_time(self):
+        registry = metrics.Registry()
+        with registry.time('oplog_decode_seconds'):
+            pass
+        self.assertEqual(registry.histograms['oplog_decode_seconds'][()].count, 1)
+
+    def test_disabled(self):
+        registry = metrics.Registry(enabled=False)
+        registry.count('oplog_requests_total')
+        registry.observe('oplog_decode_seconds', 0.1)
+        self.assertEqual(registry.render(), '\n')
+
+    def test_escape(self):
+        self.assertEqual(metrics.format_labels([('schema', 'a"b\\c')]), '{schema="a\\"b\\\\c"}')
+
+class TestStatsd(helper.TestCase):
+
+    def test_lines(self):
+        statsd = metrics.Statsd('localhost', prefix='oplog')
+        registry = metrics.Registry(sink=statsd)
+        registry.count('oplog_requests_total', method='entry.get')
+        registry.observe('oplog_method_seconds', 0.25, method='entry.get')
+        registry.observe('oplog_request_bytes', 512, buckets=metrics.BYTES)
+        self.assertEqual(statsd.lines, [
+            'oplog.requests_total.entry_get:1|c',
+            'oplog.method_seconds.entry_get:250.000|ms',
+            'oplog.request_bytes:512|h',
+        ])
+
+    def test_packet(self):
+        statsd = metrics.Statsd('localhost')
+        statsd.MAX_PACKET = 20
+        statsd.add('a' * 15)
+        statsd.add('b' * 15)
+        # The first packet was flushed (and dropped since nothing is listening)
+        self.assertEqual(statsd.lines, ['b' * 15])
+
+class TestValidate(helper.TestCase):
+
+    def test_type_label(self):
+        handler = api.Handler('testuser', helper.Settings(), None)
+        handler.metrics = metrics.Registry()
+        for _type in ('deploy', 'release', 'outage'):
+            handler.validate('entry.type.%s' % _type, {})
+        # Every type schema shares one series
+        lines = [l for l in handler.metrics.render().split('\n') if l.startswith('oplog_validate_seconds_count')]
+        self.assertEqual(lines, ['oplog_validate_seconds_count{schema="entry.type"} 3'])
@@ -0,0 +1,56 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+from twisted.internet import defer
+from twisted.internet import task
+from oplog import mongo
+from oplog.test import helper
+
+class TestHosts(helper.TestCase):
+
+    def test_hosts(self):
+        self.assertEqual(mongo.hosts('localhost'), [('localhost', 27017)])
+        self.assertEqual(mongo.hosts('one:27018, two', 27019), [('one', 27018), ('two', 27019)])
+
+    def test_invalid(self):
+        for value in ('', ',', ':27017', 'one:port'):
+            self.assertRaises(ValueError, mongo.hosts, value)
+
+class TestTimeout(helper.TestCase):
+
+    def test_result(self):
+        clock = task.Clock()
+        d = defer.Deferred()
+        result = mongo.timeout(d, 1, clock=clock)
+        d.callback('ok')
+        results = []
+        result.addCallback(results.append)
+        self.assertEqual(results, ['ok'])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        clock = task.Clock()
+        d = defer.Deferred()
+        result = mongo.timeout(d, 1, clock=clock)
+        clock.advance(1)
+        errors = []
+        result.addErrback(lambda failure: errors.append(failure.trap(mongo.Timeout)))
+        self.assertEqual(errors, [mongo.Timeout])
+        # A late result is ignored
+        d.callback('ok')
+
+    def test_disabled(self):
+        d = defer.Deferred()
+        self.assertTrue(mongo.timeout(d, 0) is d)
+
+class TestTimeoutDatabase(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def test_database(self):
+        db = mongo.Database(self.db, 5)
+        yield db.entry.insert({'_id': 'one'}, safe=True)
+        entry = yield db['entry'].find_one({'_id': 'one'})
+        self.assertEqual(entry, {'_id': 'one'})
+        self.assertEqual(str(db.entry), str(self.db.entry))
@@ -0,0 +1,104 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+import json
+from twisted.internet import defer
+import txmongo
+from oplog import api
+from oplog import partition
+from oplog.test import helper
+
+class TestPartition(helper.TestCase):
+
+    def test_name(self):
+        date = datetime.datetime(2011, 12, 7, 10, 30)
+        self.assertEqual(partition.name(date, 'year'), 'entry_2011')
+        self.assertEqual(partition.name(date, 'month'), 'entry_2011_12')
+        self.assertEqual(partition.name(date, 'day'), 'entry_2011_12_07')
+        self.assertEqual(partition.start('entry_2011_12', 'month'), datetime.datetime(2011, 12, 1))
+        self.assertEqual(partition.start('entry_2011_13', 'month'), None)
+        self.assertEqual(partition.start('entry_history', 'month'), None)
+        self.assertEqual(partition.following(datetime.datetime(2011, 12, 1), 'month'), datetime.datetime(2012, 1, 1))
+
+    def test_date_range(self):
+        low, high = datetime.datetime(2011, 10, 1), datetime.datetime(2011, 11, 1)
+        self.assertEqual(partition.date_range({'_type': 'deploy'}), (None, None))
+        self.assertEqual(partition.date_range({'_date': {'$gte': low, '$lt': high}}), (low, high))
+        self.assertEqual(partition.date_range({'$and': [{'_date': {'$gte': low}}, {'_date': {'$lte': high}}]}),
+            (low, high))
+        self.assertEqual(partition.date_range({'_date': {'$in': [high, low]}}), (low, high))
+        self.assertEqual(partition.date_range({'$or': [{'_date': {'$lt': low}}, {'_date': high}]}), (None, high))
+        self.assertEqual(partition.date_range({'$or': [{'_date': low}, {'_type': 'deploy'}]}), (None, None))
+
+    def test_route(self):
+        router = partition.Router('month')
+        router.names = set(['entry', 'entry_2011_09', 'entry_2011_10', 'entry_2011_11'])
+        self.assertEqual(router.all(), ['entry_2011_11', 'entry_2011_10', 'entry_2011_09', 'entry'])
+        self.assertEqual(router.route(datetime.datetime(2011, 10, 15), datetime.datetime(2011, 11, 1)),
+            ['entry_2011_11', 'entry_2011_10', 'entry'])
+        # The partition for now is always included
+        self.assertTrue(partition.name(datetime.datetime.utcnow(), 'month') in router.route())
+
+    def test_disabled(self):
+        router = partition.Router()
+        self.assertFalse(router.enabled)
+        self.assertRaises(ValueError, partition.Router, 'week')
+
+class TestEntries(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(TestEntries, self).setUp()
+        self.router = partition.Router('month')
+        yield self.drop()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.drop()
+        yield super(TestEntries, self).tearDown()
+
+    @defer.inlineCallbacks
+    def drop(self):
+        yield self.router.load(self.db, force=True)
+        for name in self.router.all():
+            yield partition.drop(self.db, name)
+
+    def init(self, call, **kwargs):
+        handler = super(TestEntries, self).init(call, **kwargs)
+        handler.partitions = self.router
+        return handler
+
+    @defer.inlineCallbacks
+    def test_entries(self):
+        put = self.init(api.EntryPut)
+        ids = []
+        for summary, date in (('one', '2011-09-30T23:00:00Z'), ('two', '2011-10-01T01:00:00Z'),
+                ('three', '2011-10-15T00:00:00Z')):
+            response = yield put({'_type': 'deploy', 'summary': summary, '_date': date})
+            ids.append(response['result'])
+        yield self.router.load(self.db, force=True)
+        self.assertEqual(self.router.all(), ['entry_2011_10', 'entry_2011_09'])
+
+        get = self.init(api.EntryGet)
+        response = yield get({'find': {}, 'sort': [['_date', -1]], 'limit': 2})
+        self.assertEqual([entry['summary'] for entry in json.loads(response['result'])],
+            ['three', 'two'])
+        response = yield get({'find': {'_date': {'$lt': '2011-10-01T00:00:00Z'}}})
+        self.assertEqual([entry['summary'] for entry in json.loads(response['result'])], ['one'])
+
+        # Entries are found by _id in any partition
+        yield put({'_id': ids[0], '$set': {'summary': 'updated'}})
+        entry = yield self.router.entries(self.db).find_one({'_id': txmongo.ObjectId(ids[0])})
+        self.assertEqual(entry['summary'], 'updated')
+        # An entry whose _date moves to another interval moves partition
+        yield put({'_id': ids[1], '$set': {'_date': '2011-11-02T00:00:00Z'}})
+        response = yield get({'find': {'_date': {'$gte': '2011-11-01T00:00:00Z'}}})
+        self.assertEqual([entry['summary'] for entry in json.loads(response['result'])], ['two'])
+        count = yield self.db['entry_2011_10'].count()
+        self.assertEqual(count, 1)
+        yield self.init(api.EntryDel)({'_id': ids[0]})
+        count = yield self.router.entries(self.db).count()
+        self.assertEqual(count, 2)
@@ -0,0 +1,105 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import os
+import shutil
+import tempfile
+import time
+from oplog import profile
+from oplog.test import helper
+
+class TestProfiles(helper.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'profile.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, text, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_valid(self):
+        self.write('[one]\nkey = secret\n\n[two]\nrate = 1\n')
+        profiles = profile.Profiles(self.path)
+        profiles.load()
+        self.assertTrue(profiles.valid('one', 'secret'))
+        self.assertTrue(profiles.valid('one', u'secret'))
+        self.assertFalse(profiles.valid('one', 'wrong'))
+        # No key
+        self.assertFalse(profiles.valid('two', ''))
+        self.assertFalse(profiles.valid('missing', ''))
+
+    def test_load_invalid(self):
+        self.assertRaises(profile.Error, profile.Profiles(self.path).load)
+        self.write('[one]\nkey = secret\nrate = fast\n')
+        self.assertRaises(profile.Error, profile.Profiles(self.path).load)
+
+    def test_reload(self):
+        self.write('[one]\nkey = secret\n', mtime=1000)
+        profiles = profile.Profiles(self.path, interval=0)
+        profiles.load()
+        self.write('[one]\nkey = changed\n', mtime=2000)
+        self.assertTrue(profiles.valid('one', 'changed'))
+        self.assertFalse(profiles.valid('one', 'secret'))
+        # Broken files keep the current table
+        self.write('[one', mtime=3000)
+        self.assertTrue(profiles.valid('one', 'changed'))
+
+    def test_rate(self):
+        self.write('[one]\nkey = secret\nrate = 0.001\nburst = 2\n\n[two]\nkey = secret\n')
+        profiles = profile.Profiles(self.path)
+        profiles.load()
+        self.assertEqual(profiles.limit('one'), None)
+        self.assertEqual(profiles.limit('one'), None)
+        self.assertEqual(profiles.limit('one'), 'rate limit exceeded')
+        # Unlimited
+        for i in range(10):
+            self.assertEqual(profiles.limit('two'), None)
+        # Limits are kept over reloads that don't change them
+        profiles.load()
+        self.assertEqual(profiles.limit('one'), 'rate limit exceeded')
+
+    def test_quota(self):
+        self.write('[one]\nkey = secret\n')
+        profiles = profile.Profiles(self.path, quota=3)
+        profiles.load()
+        self.assertEqual(profiles.limit('one', 2), None)
+        self.assertEqual(profiles.limit('one', 2), 'quota exceeded')
+        self.assertEqual(profiles.limit('one'), None)
+        self.assertEqual(profiles.limit('one'), 'quota exceeded')
+        # The quota is used up until the next UTC day
+        self.assertTrue(0 < profiles.wait('one') <= 86400)
+        self.assertEqual(profiles.largest('one'), 3)
+
+    def test_largest(self):
+        self.write('[one]\nkey = secret\nrate = 1\nburst = 5\nquota = 3\n\n[two]\nkey = secret\nrate = 1\n\n'
+            '[three]\nkey = secret\n')
+        profiles = profile.Profiles(self.path)
+        profiles.load()
+        self.assertEqual(profiles.largest('one'), 3)
+        self.assertEqual(profiles.largest('two'), 1)
+        self.assertEqual(profiles.largest('three'), None)
+        self.assertEqual(profiles.largest('unknown'), None)
+
+class TestBucket(helper.TestCase):
+
+    def test_take(self):
+        bucket = profile.Bucket(rate=100, burst=1)
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+        time.sleep(0.02)
+        self.assertTrue(bucket.take())
+
+    def test_wait(self):
+        bucket = profile.Bucket(rate=0.5, burst=2)
+        self.assertEqual(bucket.wait(2), 0)
+        self.assertTrue(bucket.take(2))
+        # Two tokens refill in four seconds
+        self.assertTrue(3.9 < bucket.wait(2) <= 4)
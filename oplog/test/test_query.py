@@ -0,0 +1,115 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+from oplog import index
+from oplog import query
+from oplog.test import helper
+
+class TestUnindexed(helper.TestCase):
+
+    indexes = index.configured()['entry']
+
+    def test_indexed(self):
+        for find in [
+                {},
+                {'_id': '4d433c461f48517114000000'},
+                {'_type': 'user', 'summary': {'$regex': 'test'}},
+                {'_date': {'$gt': '2011-01-28T21:59:34Z'}},
+                {'_user': {'$in': ['one', 'two']}},
+                {'_type': {'$regex': '^deploy'}},
+                {'$and': [{'summary': 'test'}, {'_user': 'one'}]},
+                {'$or': [{'_user': 'one'}, {'_type': 'user'}]},
+                ]:
+            self.assertEqual(query.unindexed(find, self.indexes), None, find)
+
+    def test_unindexed(self):
+        for find in [
+                {'summary': 'test'},
+                {'_type': {'$ne': 'user'}},
+                {'_type': {'$regex': 'deploy'}},
+                {'_type': {'$regex': '^deploy', '$options': 'i'}},
+                {'$or': [{'_user': 'one'}, {'summary': 'test'}]},
+                {'_user': 'one', '$where': 'this.a > 1'},
+                ]:
+            self.assertNotEqual(query.unindexed(find, self.indexes), None, find)
+
+    def test_max_time(self):
+        f = query.max_time(100)
+        self.assertEqual(f['$maxTimeMS'], 100)
+        f = index.sort([('_date', -1)]) + f
+        self.assertEqual(f['$maxTimeMS'], 100)
+        self.assertEqual(f['orderby'], (('_date', -1),))
+
+class TestMatch(helper.TestCase):
+
+    def test_match(self):
+        document = {'_type': 'deploy', 'build': 5, 'host': {'name': 'web01'}, 'tags': ['a', 'b']}
+        self.assertTrue(query.match(document, {'_type': 'deploy', 'host.name': 'web01'}))
+        self.assertTrue(query.match(document, {'build': {'$gt': 1, '$lte': 5}}))
+        self.assertTrue(query.match(document, {'tags': 'a'}))
+        self.assertTrue(query.match(document, {'tags': {'$all': ['b', 'a']}}))
+        self.assertTrue(query.match(document, {'$or': [{'build': 1}, {'_type': {'$regex': '^dep'}}]}))
+        self.assertFalse(query.match(document, {'$nor': [{'build': 5}]}))
+        self.assertFalse(query.match(document, {'_type': {'$in': ['release']}}))
+        self.assertFalse(query.match(document, {'missing': {'$exists': True}}))
+        self.assertRaises(ValueError, query.match, document, {'$where': 'this.build > 1'})
+
+    def test_array(self):
+        document = {'tags': ['web', 'db'], 'hosts': [{'name': 'web01'}, {'name': 'web02'}]}
+        self.assertTrue(query.match(document, {'tags': {'$in': ['web']}}))
+        self.assertFalse(query.match(document, {'tags': {'$nin': ['web']}}))
+        self.assertFalse(query.match(document, {'tags': {'$ne': 'web'}}))
+        self.assertTrue(query.match(document, {'tags': ['web', 'db']}))
+        self.assertTrue(query.match(document, {'hosts.name': 'web02'}))
+        self.assertTrue(query.match(document, {'hosts': {'$elemMatch': {'name': {'$regex': '2$'}}}}))
+        self.assertTrue(query.match(document, {'tags': {'$size': 2}}))
+
+    def test_operators(self):
+        document = {'build': 5, 'summary': 'deploy', 'note': None}
+        self.assertTrue(query.match(document, {'build': {'$not': {'$gt': 5}}}))
+        self.assertTrue(query.match(document, {'build': {'$mod': [2, 1]}}))
+        self.assertTrue(query.match(document, {'build': {'$type': 'number'}, 'summary': {'$type': 2}}))
+        # Values of different types are never compared
+        self.assertFalse(query.match(document, {'summary': {'$gt': 1}}))
+        # Null matches a missing field, but a null field still exists
+        self.assertTrue(query.match(document, {'missing': None}))
+        self.assertFalse(query.match(document, {'missing': {'$ne': None}}))
+        self.assertTrue(query.match(document, {'note': {'$exists': True}}))
+        self.assertEqual(query.unsupported({'$or': [{'a': {'$near': [0, 0]}}]}), '$near')
+        self.assertEqual(query.unsupported({'a': {'$in': [1]}}), None)
+
+    def test_after(self):
+        self.assertEqual(query.after(None, 1), [{'$ne': None}])
+        self.assertEqual(query.after(None, -1), [])
+        # Strings sort after numbers and before objects
+        self.assertEqual(query.after('x', -1)[0], {'$lt': 'x'})
+        self.assertEqual(query.after('x', -1)[1:], [{'$type': 1}, {'$type': 16}, {'$type': 18}, None])
+        self.assertEqual(query.after(datetime.datetime(2011, 1, 1), 1), [{'$gt': datetime.datetime(2011, 1, 1)}])
+
+class TestSlowLog(helper.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_log(self):
+        path = os.path.join(self.path, 'slow.log')
+        slow_log = query.SlowLog(path, 1.0)
+        slow_log(time.time(), method='entry.get', find={'fast': True})
+        slow_log(time.time() - 2, method='entry.get', find={'slow': True})
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        entry = json.loads(lines[0])
+        self.assertEqual(entry['find'], {'slow': True})
+        self.assertTrue(entry['time'] >= 2000)
@@ -0,0 +1,72 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import json
+from twisted.internet import defer
+from oplog import api
+from oplog import search
+from oplog.test import helper
+
+class TestSearch(helper.TestCase):
+
+    def test_fields(self):
+        self.assertEqual(search.fields('summary:10, details.host'), [('summary', 10), ('details.host', 1)])
+        self.assertEqual(search.fields(''), [])
+        for value in ('summary:0', 'summary:high', ':2'):
+            self.assertRaises(ValueError, search.fields, value)
+
+    def test_terms(self):
+        self.assertEqual(search.terms('Disk "out of space" -db1 -"read only"'), ['disk', 'out', 'of', 'space'])
+
+    def test_highlights(self):
+        entry = {'summary': 'Failed deploy, deploying again', 'details': {'host': 'web1 failing'}, 'count': 1}
+        fields = [('summary', 1), ('details.host', 1), ('count', 1)]
+        self.assertEqual(search.highlights(entry, fields, ['deploys', 'failed']), {
+            'summary': [[0, 6], [7, 13], [15, 24]],
+            'details.host': [[5, 12]],
+        })
+
+class TestEntrySearch(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(TestEntrySearch, self).setUp()
+        self.fields = [('summary', 1)]
+        yield search.ensure(self.db, self.fields)
+        put = self.init(api.EntryPut)
+        for _type, summary in (('deploy', 'Deployed web to production'), ('outage', 'Web outage after deploy'),
+                ('outage', 'Database failover')):
+            yield put({'_type': _type, 'summary': summary})
+
+    @defer.inlineCallbacks
+    def search(self, **params):
+        handler = self.init(api.EntrySearch)
+        handler.search_fields = self.fields
+        response = yield handler(params)
+        defer.returnValue(json.loads(response['result']))
+
+    @defer.inlineCallbacks
+    def test_search(self):
+        results = yield self.search(q='deploy')
+        self.assertEqual(sorted([entry['summary'] for entry in results]),
+            ['Deployed web to production', 'Web outage after deploy'])
+        for entry in results:
+            self.assertTrue(entry['_score'] > 0)
+            self.assertTrue(entry['_highlights']['summary'])
+
+        results = yield self.search(q='web -production', find={'_type': 'outage'}, fields=['_type'])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['_type'], 'outage')
+        self.assertFalse('summary' in results[0])
+
+    @defer.inlineCallbacks
+    def test_invalid(self):
+        for params in ({'q': '-deploy'}, {'q': 'deploy', 'find': {'summary': 'deploy'}}):
+            try:
+                yield self.search(**params)
+            except api.Error, error:
+                self.assertEqual(error.code, api.INVALID_PARAMS)
+            else:
+                self.fail('Expected invalid params: %s' % params)
@@ -0,0 +1,75 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import os
+import shutil
+import tempfile
+from twisted.internet import defer
+import txmongo
+from txmongo._pymongo import bson
+from oplog import spool
+from oplog.test import helper
+
+class TestSpool(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(TestSpool, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'entry.spool')
+        self.flushed = []
+        self.spool = spool.Spool(self.path, lambda: self.db.entry,
+            batch_size=2, interval=60, flushed=self.flushed.extend)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.spool.stop()
+        shutil.rmtree(self.tempdir)
+        yield super(TestSpool, self).tearDown()
+
+    @defer.inlineCallbacks
+    def test_put(self):
+        yield self.spool.start()
+        for i in range(3):
+            yield self.spool.put({'_id': txmongo.ObjectId(), 'summary': 'test %s' % i})
+
+        yield self.spool.flush()
+        yield self.check_count(3)
+        self.assertEqual(len(self.flushed), 3)
+        self.assertFalse(os.path.exists(self.spool.flushing_path))
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        _id = txmongo.ObjectId()
+        yield self.db.entry.insert({'_id': _id, 'summary': 'old'}, safe=True)
+        with open(self.path, 'wb') as f:
+            f.write(bson.BSON.from_dict({'_id': _id, 'summary': 'test 1'}))
+            f.write(bson.BSON.from_dict({'_id': txmongo.ObjectId(), 'summary': 'test 2'}))
+            # Cut short by a crash
+            f.write(bson.BSON.from_dict({'_id': txmongo.ObjectId(), 'summary': 'test 3'})[:10])
+
+        yield self.spool.start()
+        yield self.check_count(2)
+        entry = yield self.db.entry.find_one({'_id': _id})
+        self.assertEqual(entry['summary'], 'test 1')
+        self.assertEqual(len(self.flushed), 2)
+
+    @defer.inlineCallbacks
+    def test_orphans(self):
+        # Spools of workers that are no longer run
+        for path in (self.path + '.0', self.path + '.3.flushing'):
+            with open(path, 'wb') as f:
+                f.write(bson.BSON.from_dict({'_id': txmongo.ObjectId(), 'summary': path}))
+        self.assertEqual(spool.orphans(self.path), [self.path + '.0', self.path + '.3.flushing'])
+        self.assertEqual(spool.orphans(self.path, worker=0, workers=1), [self.path + '.3.flushing'])
+        self.assertEqual(spool.orphans(self.path, worker=1, workers=4), [])
+
+        self.spool.orphans = spool.orphans(self.path)
+        yield self.spool.start()
+        yield self.check_count(2)
+        self.assertEqual(spool.orphans(self.path), [])
+
+    def test_not_running(self):
+        self.assertRaises(spool.Error, self.spool.put, {'_id': txmongo.ObjectId()})
@@ -0,0 +1,102 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import datetime
+from twisted.internet import defer
+from oplog import api
+from oplog import index
+from oplog import partition
+from oplog import stats
+from oplog.test import helper
+
+class TestChanges(helper.TestCase):
+
+    def test_bucket(self):
+        date = datetime.datetime(2011, 10, 1, 12, 34, 56, 789)
+        self.assertEqual(stats.bucket(date, 'minute'), datetime.datetime(2011, 10, 1, 12, 34))
+        self.assertEqual(stats.bucket(date, 'hour'), datetime.datetime(2011, 10, 1, 12))
+        self.assertEqual(stats.bucket(date, 'day'), datetime.datetime(2011, 10, 1))
+        self.assertRaises(ValueError, stats.bucket, date, 'week')
+
+    def test_changes(self):
+        date = datetime.datetime(2011, 10, 1, 12, 34)
+        counts = stats.changes([
+            {'_date': date, '_type': 'deploy', '_user': 'one'},
+            {'_date': date, '_type': 'deploy', '_user': 'one'},
+            # Entries without a date aren't counted
+            {'_date': '2011-10-01', '_type': 'deploy', '_user': 'one'},
+        ])
+        stats.changes([{'_date': date, '_type': 'deploy', '_user': 'one'}], -1, counts)
+        self.assertEqual(dict(counts), {
+            ('minute', date, 'deploy', 'one'): 1,
+            ('hour', datetime.datetime(2011, 10, 1, 12), 'deploy', 'one'): 1,
+            ('day', datetime.datetime(2011, 10, 1), 'deploy', 'one'): 1,
+        })
+
+    def test_summarize(self):
+        date = datetime.datetime(2011, 10, 1)
+        self.assertEqual(stats.summarize([
+            {'date': date, '_type': 'deploy', '_user': 'one', 'count': 2},
+            {'date': date, '_type': 'deploy', '_user': 'two', 'count': 1},
+            {'date': date, '_type': 'outage', '_user': 'two', 'count': 0},
+        ], ['_type']), [{'date': date, '_type': 'deploy', 'count': 3}])
+
+class TestEntryStats(helper.MongoTestCase):
+
+    @defer.inlineCallbacks
+    def put(self, *entries):
+        ids = []
+        for _type, _date in entries:
+            response = yield self.init(api.EntryPut)({'_type': _type, '_date': _date, 'summary': 'test'})
+            ids.append(response['result'])
+        defer.returnValue(ids)
+
+    @defer.inlineCallbacks
+    def get_stats(self, **params):
+        params.setdefault('start', '2011-10-01T00:00:00Z')
+        params.setdefault('end', '2011-10-02T00:00:00Z')
+        response = yield self.init(api.EntryStats)(params)
+        defer.returnValue(response['result'])
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        ids = yield self.put(
+            ('deploy', '2011-10-01T10:15:00Z'),
+            ('deploy', '2011-10-01T10:45:00Z'),
+            ('outage', '2011-10-01T11:00:00Z'),
+        )
+        result = yield self.get_stats()
+        self.assertEqual(result, [
+            {'date': '2011-10-01T10:00:00Z', '_type': 'deploy', 'count': 2},
+            {'date': '2011-10-01T11:00:00Z', '_type': 'outage', 'count': 1},
+        ])
+
+        yield self.init(api.EntryDel)({'_id': ids[0]})
+        result = yield self.get_stats(unit='day', group=['_type', '_user'], find={'_type': {'$in': ['deploy']}})
+        self.assertEqual(result, [
+            {'date': '2011-10-01T00:00:00Z', '_type': 'deploy', '_user': self.user, 'count': 1},
+        ])
+
+        # Rebuilding gives the same counts and keeps the indexes
+        yield index.ensure(self.db, {'entry_stats': index.configured()['entry_stats']})
+        total = yield stats.rebuild(self.db)
+        self.assertEqual(total, 2)
+        result = yield self.get_stats(unit='day', group=[])
+        self.assertEqual(result, [{'date': '2011-10-01T00:00:00Z', 'count': 2}])
+        information = yield index.information(self.db, 'entry_stats')
+        self.assertTrue([('unit', 1), ('date', 1)] in information.values())
+        names = yield partition.list_collections(self.db)
+        self.assertFalse(stats.REBUILD in names)
+
+    @defer.inlineCallbacks
+    def test_invalid(self):
+        for params in ({'find': {'summary': 'test'}}, {'unit': 'minute', 'start': '2001-01-01T00:00:00Z'},
+                {'start': '2011-10-03T00:00:00Z'}):
+            try:
+                yield self.get_stats(**params)
+            except api.Error, error:
+                self.assertEqual(error.code, api.INVALID_PARAMS)
+            else:
+                self.fail('Expected invalid params: %s' % params)
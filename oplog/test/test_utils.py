@@ -3,7 +3,10 @@
 #
 # This file is subject to the MIT License (see the LICENSE file).
 
+import datetime
+import json
 from twisted.internet import defer
+import txmongo
 from oplog import utils
 from oplog.test import helper
 
@@ -24,3 +27,112 @@ class TestMongify(helper.TestCase):
         self.assertTrue('_date' in data)
         self.assertTrue('_type' in data)
         self.assertTrue('summary' in data)
+
+    def test_encode(self):
+        data = utils.mongify.encode({
+            '_id': '4d433c461f48517114000000',
+            '_date': '2011-01-28T21:59:34Z',
+            'summary': 'hello world',
+        })
+        self.assertTrue(isinstance(data['_id'], txmongo.ObjectId))
+        self.assertTrue(isinstance(data['_date'], datetime.datetime))
+        self.assertEqual(data['summary'], 'hello world')
+
+    def test_encode_list(self):
+        data = utils.mongify.encode({
+            'hosts': ['web01', '4d433c461f48517114000000', {'started': '2011-01-28T21:59:34Z'}],
+            'tags': ('a', 'b'),
+        })
+        self.assertEqual(data['hosts'][0], 'web01')
+        self.assertTrue(isinstance(data['hosts'][1], txmongo.ObjectId))
+        self.assertTrue(isinstance(data['hosts'][2]['started'], datetime.datetime))
+        self.assertEqual(data['tags'], ['a', 'b'])
+
+    def test_clean_list(self):
+        data = utils.mongify.encode([{'_id': 1, 'summary': 'one'}, {'_user': 2}], clean=True)
+        self.assertEqual(data, [{'summary': 'one'}, {}])
+        # only base fields of the top-level documents are cleaned
+        data = utils.mongify.encode({'deploy': {'_id': 1}}, clean=True)
+        self.assertEqual(data, {'deploy': {'_id': 1}})
+
+    def test_decode(self):
+        data = utils.mongify.decode({
+            '_id': txmongo.ObjectId('4d433c461f48517114000000'),
+            'dates': [datetime.datetime(2011, 1, 28, 21, 59, 34)],
+            'n': 1,
+        })
+        self.assertEqual(data, {'_id': '4d433c461f48517114000000', 'dates': ['2011-01-28T21:59:34Z'], 'n': 1})
+
+    def test_deep(self):
+        # Deeper than the recursion limit
+        data = value = {}
+        for i in range(5000):
+            value['a'] = {'b': [i]}
+            value = value['a']
+        result = utils.mongify.decode(utils.mongify.encode(data))
+        # Compared a level at a time since == recurses too
+        for i in range(5000):
+            result = result['a']
+            self.assertEqual(sorted(result), ['a', 'b'] if i < 4999 else ['b'])
+            self.assertEqual(result['b'], [i])
+
+    def test_encode_types(self):
+        date = '2011-01-28T21:59:34Z'
+        data = utils.mongify.encode({
+            '_date': {'$gt': date},
+            'deploy': {'start': date},
+            'note': date,
+            'build': '4d433c461f48517114000000',
+            '$or': [{'_id': '4d433c461f48517114000000'}],
+        }, types={'_date': 'date-time', '_id': 'objectid', 'deploy.start': 'date-time', 'build': 'date-time'})
+        self.assertTrue(isinstance(data['_date']['$gt'], datetime.datetime))
+        self.assertTrue(isinstance(data['deploy']['start'], datetime.datetime))
+        self.assertTrue(isinstance(data['$or'][0]['_id'], txmongo.ObjectId))
+        # Declared fields are only converted to their type, the rest are
+        # guessed
+        self.assertEqual(data['build'], '4d433c461f48517114000000')
+        self.assertTrue(isinstance(data['note'], datetime.datetime))
+
+class TestMongoJson(helper.TestCase):
+
+    def test_encode(self):
+        document = {
+            '_id': txmongo.ObjectId('4d433c461f48517114000000'),
+            '_date': datetime.datetime(2011, 1, 28, 21, 59, 34),
+            'hosts': [{'name': 'web01'}],
+            'html': '</script>',
+        }
+        data = utils.mongo_json.encode(document)
+        self.assertEqual(json.loads(data), utils.mongify.decode(document))
+        self.assertTrue('<\\/script>' in data)
+
+class TestCompare(helper.TestCase):
+
+    def test_compare(self):
+        self.assertTrue(utils.compare('secret', 'secret'))
+        self.assertFalse(utils.compare('secret', 'secreT'))
+        self.assertFalse(utils.compare('secret', 'secrets'))
+        self.assertTrue(utils.compare('', ''))
+
+class TestModify(helper.TestCase):
+
+    def test_operators(self):
+        entry = {'_id': 1, 'a': {'b': [1, 2, 3]}, 'n': 1, 's': 'x'}
+        data = utils.modify.apply(entry, {
+            '$set': {'a.b.1': 9, 'x.y': 'z'},
+            '$inc': {'n': 2},
+            '$unset': {'s': 1},
+            '$push': {'l': 1},
+        })
+        self.assertEqual(data, {'_id': 1, 'a': {'b': [1, 9, 3]}, 'n': 3, 'x': {'y': 'z'}, 'l': [1]})
+        # original isn't changed
+        self.assertEqual(entry, {'_id': 1, 'a': {'b': [1, 2, 3]}, 'n': 1, 's': 'x'})
+
+    def test_replace(self):
+        data = utils.modify.apply({'_id': 1, 'a': 1}, {'b': 2})
+        self.assertEqual(data, {'_id': 1, 'b': 2})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, utils.modify.apply, {}, {'$set': {'a': 1}, 'b': 2})
+        self.assertRaises(ValueError, utils.modify.apply, {}, {'$bit': {'a': 1}})
+        self.assertRaises(ValueError, utils.modify.apply, {'a': 'b'}, {'$inc': {'a': 1}})
@@ -0,0 +1,80 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import json
+import os
+import shutil
+import tempfile
+from oplog import validation
+from oplog.test import helper
+
+class TestCompile(helper.TestCase):
+
+    def test_validate(self):
+        validate = validation.compile({
+            'type': 'object',
+            'properties': {
+                'name': {'type': 'string', 'required': True, 'maxLength': 3},
+                'date': {'type': 'string', 'format': 'date-time'},
+                'count': {'type': 'integer', 'minimum': 1},
+                'tags': {'type': 'array', 'items': {'type': 'string'}},
+            },
+        })
+        validate({'name': 'abc'})
+        validate({'name': 'abc', 'date': '2011-01-28T21:59:34Z', 'count': 1, 'tags': ['a']})
+        self.assertRaises(ValueError, validate, {})
+        self.assertRaises(ValueError, validate, {'name': ''})
+        self.assertRaises(ValueError, validate, {'name': 'abcd'})
+        self.assertRaises(ValueError, validate, {'name': 'abc', 'date': '2011-01-28'})
+        self.assertRaises(ValueError, validate, {'name': 'abc', 'count': 0})
+        self.assertRaises(ValueError, validate, {'name': 'abc', 'count': True})
+        # Large integers are decoded as long
+        validate({'name': 'abc', 'count': 2 ** 64})
+        self.assertRaises(ValueError, validate, {'name': 'abc', 'count': 0L})
+        self.assertRaises(ValueError, validate, {'name': 'abc', 'count': 1.5})
+        self.assertRaises(ValueError, validate, {'name': 'abc', 'tags': [1]})
+
+    def test_fallback(self):
+        validate = validation.compile({
+            'type': 'object',
+            'properties': {'name': {'type': 'string'}},
+            'additionalProperties': False,
+        })
+        validate({'name': 'abc'})
+        self.assertRaises(ValueError, validate, {'other': 'abc'})
+
+class TestRegistry(helper.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.registry = validation.Registry([self.path], interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, schema):
+        with open(os.path.join(self.path, '%s.json' % name), 'w') as f:
+            f.write(json.dumps(schema))
+
+    def test_missing(self):
+        self.registry.validate('entry.type.test', {})
+        self.assertTrue(self.registry.get('entry.type.test').validate is None)
+
+    def test_reload(self):
+        self.write('entry.type.test', {'properties': {'a': {'required': True}}})
+        self.assertRaises(ValueError, self.registry.validate, 'entry.type.test', {})
+        os.remove(os.path.join(self.path, 'entry.type.test.json'))
+        self.registry.clear()
+        self.registry.validate('entry.type.test', {})
+
+    def test_combined_types(self):
+        self.write('entry.type.deploy', {'properties': {'start': {'format': 'date-time'},
+            'build': {'format': 'objectid'}}})
+        self.write('entry.type.release', {'properties': {'start': {'format': 'date-time'},
+            'build': {'format': 'date-time'}}})
+        names = self.registry.names('entry.type.')
+        self.assertEqual(names, ['entry.type.deploy', 'entry.type.release'])
+        # Fields declared with different types are left out
+        self.assertEqual(self.registry.combined_types(names), {'start': 'date-time'})
@@ -3,74 +3,401 @@
 #
 # This file is subject to the MIT License (see the LICENSE file).
 
+import copy
+import json
 import re
 import txmongo
 from datetime import datetime
 
 OBJECT_ID = re.compile(r'^[a-f0-9]{24}$')
+DATE_TIME = '%Y-%m-%dT%H:%M:%SZ'
 
 class mongify:
 
     @staticmethod
-    def _basestring_encode(value, clean=False):
-        # TODO(ssewell): are these bad assumptions, maybe extend schema and use
-        # that for special types
-        if OBJECT_ID.match(value):
+    def _objectid_encode(value):
+        if len(value) == 24 and OBJECT_ID.match(value):
             return txmongo.ObjectId(value)
-        try:
-            return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
-        except ValueError:
-            pass
         return value
 
+    @staticmethod
+    def _datetime_encode(value):
+        # Cheap shape check so we don't pay for a failing strptime on every
+        # string
+        if len(value) == 20 and value[10] == 'T' and value[19] == 'Z' and value[:4].isdigit():
+            try:
+                return datetime.strptime(value, DATE_TIME)
+            except ValueError:
+                pass
+        return value
+
+    @staticmethod
+    def _basestring_encode(value, clean=False):
+        # Without a schema we have to guess which strings are special types
+        length = len(value)
+        if length == 24:
+            return mongify._objectid_encode(value)
+        elif length == 20:
+            return mongify._datetime_encode(value)
+        return value
+
+    @staticmethod
+    def _dispatch(table, kind):
+        """Return the handler for a type from a dispatch table, subclasses use
+        the handler of their base type. Lookups are cached in the table."""
+        handler = None
+        for base, value in table.items():
+            if issubclass(kind, base):
+                handler = value
+                break
+        table[kind] = handler
+        return handler
+
+    @staticmethod
+    def _walk(value, table, clean=False):
+        """Copy a value converting every leaf with the handler for its type in
+        table (None leaves it as is), dict and list handlers copy containers.
+
+        Documents are walked with a stack instead of recursion and every
+        container is built in place, so nesting depth and array size only
+        cost linear time and memory. ``clean`` drops the base fields of the
+        top-level document (or documents in a top-level list).
+        """
+        kind = type(value)
+        handler = table.get(kind, MISSING)
+        if handler is MISSING:
+            handler = mongify._dispatch(table, kind)
+        if handler is None:
+            return value
+        if handler is not dict and handler is not list:
+            return handler(value)
+        result = handler()
+        stack = [(value, result, clean)]
+        pop = stack.pop
+        push = stack.append
+        dispatch = mongify._dispatch
+        while stack:
+            source, target, clean = pop()
+            if type(target) is dict:
+                for n, v in source.iteritems():
+                    if clean and n.strip() in CLEAN:
+                        continue
+                    kind = type(v)
+                    handler = table.get(kind, MISSING)
+                    if handler is MISSING:
+                        handler = dispatch(table, kind)
+                    if handler is None:
+                        target[n] = v
+                    elif handler is dict or handler is list:
+                        child = target[n] = handler()
+                        push((v, child, False))
+                    else:
+                        target[n] = handler(v)
+            else:
+                append = target.append
+                for v in source:
+                    kind = type(v)
+                    handler = table.get(kind, MISSING)
+                    if handler is MISSING:
+                        handler = dispatch(table, kind)
+                    if handler is None:
+                        append(v)
+                    elif handler is dict or handler is list:
+                        child = handler()
+                        append(child)
+                        push((v, child, clean))
+                    else:
+                        append(handler(v))
+        return result
+
+    @staticmethod
+    def _typed_value_encode(value, encode):
+        table = TYPED_TABLES.get(encode)
+        if table is None:
+            table = TYPED_TABLES[encode] = {str: encode, unicode: encode, dict: dict, list: list, tuple: list}
+        return mongify._walk(value, table)
+
+    @staticmethod
+    def _typed_encode(value, types, clean=False):
+        result = {}
+        stack = [(value, result, '', clean)]
+        while stack:
+            source, target, prefix, clean = stack.pop()
+            for n, v in source.iteritems():
+                if clean and n.strip() in CLEAN:
+                    continue
+                # Operators ($set, $or, etc...) contain fields at the same level
+                if n.startswith('$'):
+                    child = prefix
+                elif prefix + n in types:
+                    target[n] = mongify._typed_value_encode(v, TYPE_ENCODE[types[prefix + n]])
+                    continue
+                else:
+                    child = prefix + n + '.'
+                if isinstance(v, dict):
+                    target[n] = {}
+                    stack.append((v, target[n], child, False))
+                elif isinstance(v, (list, tuple)):
+                    items = target[n] = []
+                    for i in v:
+                        if isinstance(i, dict):
+                            items.append({})
+                            stack.append((i, items[-1], child, False))
+                        else:
+                            items.append(mongify._walk(i, ENCODE))
+                else:
+                    target[n] = mongify._walk(v, ENCODE)
+        return result
+
     @staticmethod
     def _datetime_decode(value):
-        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return value.strftime(DATE_TIME)
 
     @staticmethod
     def _objectid_decode(value):
         return str(value)
 
     @staticmethod
-    def _dict_encode(value, clean=False):
-        return dict(
-            [(mongify.encode(n), mongify.encode(v)) \
-                for n, v \
-                in value.items() \
-                if not clean or n.strip() not in ('_id', '_user')])
+    def encode(value, clean=False, types=None):
+        """Encode a document, query or update for Mongo.
+
+        If ``types`` (a dict of dotted field names to "date-time" or
+        "objectid") is given those fields are only converted to their type,
+        every other string that looks like an ObjectId or date-time is.
+        """
+        if types is not None and isinstance(value, dict):
+            return mongify._typed_encode(value, types, clean=clean)
+        return mongify._walk(value, ENCODE, clean)
 
     @staticmethod
-    def _dict_decode(value):
-        return dict([(mongify.decode(n), mongify.decode(v)) for n, v in value.items()])
+    def decode(value):
+        return mongify._walk(value, DECODE)
+
+# Marks types missing from a dispatch table
+MISSING = object()
+
+# Base fields that can't be set by "clean" encodes
+CLEAN = ('_id', '_user', '_version')
+
+TYPE_ENCODE = {
+    'date-time': mongify._datetime_encode,
+    'objectid': mongify._objectid_encode,
+}
+
+# Dispatch tables of type to handler, dict and list copy containers and None
+# leaves values as they are
+ENCODE = {
+    str: mongify._basestring_encode,
+    unicode: mongify._basestring_encode,
+    dict: dict,
+    list: list,
+    tuple: list,
+    int: None,
+    float: None,
+    bool: None,
+    type(None): None,
+}
+
+DECODE = {
+    datetime: mongify._datetime_decode,
+    txmongo.ObjectId: mongify._objectid_decode,
+    dict: dict,
+    list: list,
+    tuple: list,
+    str: None,
+    unicode: None,
+    int: None,
+    float: None,
+    bool: None,
+    type(None): None,
+}
+
+TYPED_TABLES = {}
+
+class MongoEncoder(json.JSONEncoder):
+    """JSON encoder for documents straight from Mongo, ObjectIds and dates
+    are written the way mongify.decode would return them."""
+
+    def default(self, value):
+        if isinstance(value, datetime):
+            return value.strftime(DATE_TIME)
+        if isinstance(value, txmongo.ObjectId):
+            return str(value)
+        return json.JSONEncoder.default(self, value)
+
+class mongo_json:
+
+    encoder = MongoEncoder()
 
     @staticmethod
-    def _list_encode(value, clean=False):
-        return [mongify.encode(value, clean=clean) for v in value]
+    def encode(value):
+        """JSON encode Mongo documents without decoding a copy of them
+        first, escaped like huck.utils.json.encode."""
+        return mongo_json.encoder.encode(value).replace('</', '<\\/')
+
+class modify:
+    """Apply a Mongo update document to a document in memory, so the result
+    can be validated before anything is written."""
 
     @staticmethod
-    def _list_decode(value):
-        return map(mongify.decode, value)
+    def _key(container, key):
+        if isinstance(container, list):
+            try:
+                return int(key)
+            except ValueError:
+                raise ValueError('Can not use field "%s" on an array' % key)
+        return key
 
     @staticmethod
-    def encode(value, clean=False):
-        if isinstance(value, basestring):
-            return mongify._basestring_encode(value, clean=clean)
-        elif isinstance(value, dict):
-            return mongify._dict_encode(value, clean=clean)
-        elif isinstance(value, (list, tuple)):
-            return mongify._list_encode(value, clean=clean)
-        else:
-            return value
+    def _path(document, name, create=True):
+        """Return the container and key for a dotted field name."""
+        parts = name.split('.')
+        container = document
+        for part in parts[:-1]:
+            key = modify._key(container, part)
+            try:
+                container = container[key]
+            except (KeyError, IndexError):
+                if not create:
+                    return None, None
+                if isinstance(container, list):
+                    raise ValueError('Array index "%s" out of range' % part)
+                container[key] = {}
+                container = container[key]
+            if not isinstance(container, (dict, list)):
+                raise ValueError('Can not use field "%s" on a non-container' % name)
+        return container, modify._key(container, parts[-1])
 
     @staticmethod
-    def decode(value):
-        if isinstance(value, datetime):
-            return mongify._datetime_decode(value)
-        elif isinstance(value, txmongo.ObjectId):
-            return mongify._objectid_decode(value)
-        elif isinstance(value, dict):
-            return mongify._dict_decode(value)
-        elif isinstance(value, (list, tuple)):
-            return mongify._list_decode(value)
+    def _get(document, name, default=None):
+        container, key = modify._path(document, name, create=False)
+        if container is None:
+            return default
+        try:
+            return container[key]
+        except (KeyError, IndexError):
+            return default
+
+    @staticmethod
+    def _set(document, name, value):
+        container, key = modify._path(document, name)
+        if isinstance(container, list) and key >= len(container):
+            container.extend([None] * (key - len(container) + 1))
+        container[key] = value
+
+    @staticmethod
+    def _unset(document, name):
+        container, key = modify._path(document, name, create=False)
+        if container is None:
+            return
+        if isinstance(container, list):
+            if key < len(container):
+                container[key] = None
         else:
-            return value
+            container.pop(key, None)
+
+    @staticmethod
+    def _array(document, name):
+        value = modify._get(document, name)
+        if value is None:
+            value = []
+            modify._set(document, name, value)
+        elif not isinstance(value, list):
+            raise ValueError('Field "%s" is not an array' % name)
+        return value
+
+    @staticmethod
+    def _each(value):
+        if isinstance(value, dict) and '$each' in value:
+            return list(value['$each'])
+        return [value]
+
+    @staticmethod
+    def op_set(document, name, value):
+        modify._set(document, name, copy.deepcopy(value))
+
+    @staticmethod
+    def op_unset(document, name, value):
+        modify._unset(document, name)
+
+    @staticmethod
+    def op_inc(document, name, value):
+        current = modify._get(document, name, 0)
+        if not isinstance(current, (int, long, float)) or isinstance(current, bool):
+            raise ValueError('Can not increment non-numeric field "%s"' % name)
+        modify._set(document, name, current + value)
+
+    @staticmethod
+    def op_push(document, name, value):
+        modify._array(document, name).extend(copy.deepcopy(modify._each(value)))
+
+    @staticmethod
+    def op_pushAll(document, name, value):
+        modify._array(document, name).extend(copy.deepcopy(value))
+
+    @staticmethod
+    def op_addToSet(document, name, value):
+        array = modify._array(document, name)
+        for item in modify._each(value):
+            if item not in array:
+                array.append(copy.deepcopy(item))
+
+    @staticmethod
+    def op_pop(document, name, value):
+        array = modify._array(document, name)
+        if array:
+            array.pop(0 if value == -1 else -1)
+
+    @staticmethod
+    def op_pull(document, name, value):
+        array = modify._array(document, name)
+        if isinstance(value, dict) and any(k.startswith('$') for k in value):
+            raise ValueError('Conditional $pull is not supported')
+        array[:] = [item for item in array if item != value]
+
+    @staticmethod
+    def op_pullAll(document, name, value):
+        array = modify._array(document, name)
+        array[:] = [item for item in array if item not in value]
+
+    @staticmethod
+    def op_rename(document, name, value):
+        missing = object()
+        current = modify._get(document, name, missing)
+        if current is not missing:
+            modify._unset(document, name)
+            modify._set(document, value, current)
+
+    @staticmethod
+    def apply(document, update):
+        """Return a copy of document with update applied, update is either a
+        replacement document or a document of update operators."""
+        operators = [name for name in update if name.startswith('$')]
+        if not operators:
+            result = copy.deepcopy(update)
+            if '_id' in document:
+                result['_id'] = document['_id']
+            return result
+        if len(operators) != len(update):
+            raise ValueError('Can not mix update operators and fields')
+        result = copy.deepcopy(document)
+        for operator in operators:
+            op = getattr(modify, 'op_%s' % operator[1:], None)
+            if op is None:
+                raise ValueError('Unsupported update operator: %s' % operator)
+            fields = update[operator]
+            if not isinstance(fields, dict):
+                raise ValueError('Invalid %s update' % operator)
+            for name, value in fields.items():
+                op(result, name, value)
+        return result
+
+def compare(a, b):
+    """Compare two strings in constant time so the result can't be guessed
+    from how long the comparison took."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
@@ -0,0 +1,342 @@
+# Copyright (c) 2011, Shutterstock Images LLC.
+# All rights reserved.
+#
+# This file is subject to the MIT License (see the LICENSE file).
+
+import json
+import os
+import re
+import time
+from datetime import datetime
+import validictory
+from twisted.python import log
+
+# Keywords validictory acts on that the compiler doesn't handle, schemas using
+# them are validated with validictory instead
+UNSUPPORTED = set([
+    'additionalItems',
+    'additionalProperties',
+    'dependencies',
+    'disallow',
+    'divisibleBy',
+    'extends',
+    'patternProperties',
+    'requires',
+    'uniqueItems',
+])
+
+def _integer(value):
+    # bool is a subclass of int but isn't a JSON number
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def _number(value):
+    return _integer(value) or isinstance(value, float)
+
+TYPES = {
+    'string': lambda value: isinstance(value, basestring),
+    'integer': _integer,
+    'number': _number,
+    'boolean': lambda value: type(value) == bool,
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, (list, tuple)),
+    'null': lambda value: value is None,
+    'any': lambda value: True,
+}
+
+def _datetime_format(format):
+    def check(value):
+        try:
+            datetime.strptime(value, format)
+        except (TypeError, ValueError):
+            return False
+        return True
+    return check
+
+FORMATS = {
+    'date-time': _datetime_format('%Y-%m-%dT%H:%M:%SZ'),
+    'date': _datetime_format('%Y-%m-%d'),
+    'time': _datetime_format('%H:%M:%S'),
+    'utc-millisec': lambda value: _number(value) and value > 0,
+}
+
+# Formats that are stored as Mongo types rather than strings
+ENCODED_FORMATS = ('date-time', 'objectid')
+
+class Unsupported(Exception): pass
+
+def _error(message, value, fieldname):
+    raise validictory.ValidationError(message % {'value': value, 'fieldname': fieldname})
+
+def _compile_type(fieldtype):
+    names = fieldtype if isinstance(fieldtype, (list, tuple)) else [fieldtype]
+    checks = []
+    for name in names:
+        if isinstance(name, dict):
+            raise Unsupported('schema types')
+        if name not in TYPES:
+            raise validictory.SchemaError("Field type '%s' is not supported." % name)
+        checks.append(TYPES[name])
+    def check(value, fieldname, exists):
+        if exists and not any(c(value) for c in checks):
+            _error("Value %%(value)r for field '%%(fieldname)s' is not of type %s" % fieldtype, value, fieldname)
+    return check
+
+def _compile_node(schema):
+    """Compile a schema node into a function that checks ``x[fieldname]``."""
+    if not isinstance(schema, dict):
+        raise validictory.SchemaError('Schema structure is invalid.')
+    if UNSUPPORTED.intersection(schema):
+        raise Unsupported(', '.join(UNSUPPORTED.intersection(schema)))
+
+    checks = []
+
+    if schema.get('type'):
+        checks.append(_compile_type(schema['type']))
+
+    if schema.get('required', False):
+        def check(value, fieldname, exists):
+            if not exists:
+                _error("Required field '%(fieldname)s' is missing", None, fieldname)
+        checks.append(check)
+
+    if not schema.get('blank', False):
+        def check(value, fieldname, exists):
+            if isinstance(value, basestring) and not value:
+                _error("Value %(value)r for field '%(fieldname)s' cannot be blank'", value, fieldname)
+        checks.append(check)
+
+    for name in ('minLength', 'minItems'):
+        if name in schema:
+            def check(value, fieldname, exists, length=schema[name]):
+                if isinstance(value, (basestring, list, tuple)) and len(value) < length:
+                    _error("Length of value %%(value)r for field '%%(fieldname)s' must be greater than or equal to %d" % length, value, fieldname)
+            checks.append(check)
+
+    for name in ('maxLength', 'maxItems'):
+        if name in schema:
+            def check(value, fieldname, exists, length=schema[name]):
+                if isinstance(value, (basestring, list, tuple)) and len(value) > length:
+                    _error("Length of value %%(value)r for field '%%(fieldname)s' must be less than or equal to %d" % length, value, fieldname)
+            checks.append(check)
+
+    if 'minimum' in schema:
+        minimum = schema['minimum']
+        exclusive = schema.get('exclusiveMinimum', False)
+        def check(value, fieldname, exists):
+            if _number(value) and (value <= minimum if exclusive else value < minimum):
+                _error("Value %%(value)r for field '%%(fieldname)s' is less than minimum value: %f" % minimum, value, fieldname)
+        checks.append(check)
+
+    if 'maximum' in schema:
+        maximum = schema['maximum']
+        exclusive = schema.get('exclusiveMaximum', False)
+        def check(value, fieldname, exists):
+            if _number(value) and (value >= maximum if exclusive else value > maximum):
+                _error("Value %%(value)r for field '%%(fieldname)s' is greater than maximum value: %f" % maximum, value, fieldname)
+        checks.append(check)
+
+    if schema.get('format') in FORMATS:
+        format = schema['format']
+        format_check = FORMATS[format]
+        def check(value, fieldname, exists):
+            if value is not None and not format_check(value):
+                _error("Value %%(value)r of field '%%(fieldname)s' is not in '%s' format" % format, value, fieldname)
+        checks.append(check)
+
+    if 'pattern' in schema:
+        pattern = re.compile(schema['pattern'])
+        def check(value, fieldname, exists):
+            if isinstance(value, basestring) and not pattern.match(value):
+                _error("Value %%(value)r for field '%%(fieldname)s' does not match regular expression '%s'" % pattern.pattern, value, fieldname)
+        checks.append(check)
+
+    if 'enum' in schema:
+        options = schema['enum']
+        if not isinstance(options, (list, tuple)):
+            raise validictory.SchemaError('Enumeration for field is not a list type')
+        def check(value, fieldname, exists):
+            if value is not None and value not in options:
+                _error("Value %%(value)r for field '%%(fieldname)s' is not in the enumeration: %r" % (options,), value, fieldname)
+        checks.append(check)
+
+    if 'properties' in schema:
+        if not isinstance(schema['properties'], dict):
+            raise validictory.SchemaError('Properties definition is not an object')
+        properties = [(name, _compile_node(value)) for name, value in schema['properties'].items()]
+        def check(value, fieldname, exists):
+            if isinstance(value, dict):
+                for name, node in properties:
+                    node(value, name)
+        checks.append(check)
+
+    if 'items' in schema:
+        if not isinstance(schema['items'], dict):
+            raise Unsupported('tuple items')
+        item_node = _compile_node(schema['items'])
+        def check(value, fieldname, exists):
+            if isinstance(value, (list, tuple)):
+                for item in value:
+                    try:
+                        item_node({'_data': item}, '_data')
+                    except ValueError, error:
+                        raise type(error)("Failed to validate field '%s' list schema: %s" % (fieldname, error))
+        checks.append(check)
+
+    def node(x, fieldname):
+        exists = fieldname in x
+        value = x.get(fieldname)
+        for check in checks:
+            check(value, fieldname, exists)
+    return node
+
+def compile(schema):
+    """Compile a schema into a function that raises ValueError when the data
+    passed to it doesn't validate.
+
+    Schemas are validated with the same rules validictory uses (with required
+    off by default), falling back to validictory itself for keywords the
+    compiler doesn't handle.
+    """
+    try:
+        node = _compile_node(schema)
+    except Unsupported:
+        validator = validictory.SchemaValidator(required_by_default=False)
+        return lambda data: validator.validate(data, schema)
+    return lambda data: node({'_data': data}, '_data')
+
+def field_types(schema, prefix=''):
+    """Return a dict of dotted field names to the special types
+    (``ENCODED_FORMATS``) declared for them with ``format``."""
+    types = {}
+    properties = schema.get('properties') if isinstance(schema, dict) else None
+    if isinstance(properties, dict):
+        for name, value in properties.items():
+            if not isinstance(value, dict):
+                continue
+            if value.get('format') in ENCODED_FORMATS:
+                types[prefix + name] = value['format']
+            types.update(field_types(value, prefix + name + '.'))
+    return types
+
+class Schema(object):
+
+    def __init__(self, name, path=None, mtime=None, schema=None):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.schema = schema
+        self.validate = compile(schema) if schema else None
+        self.types = field_types(schema) if schema else None
+        self.checked = time.time()
+
+class Registry(object):
+    """Loads and compiles schemas by name from a list of directories.
+
+    Lookups (including missing schemas) are cached and only checked against
+    the filesystem every ``interval`` seconds, a schema is reloaded when its
+    file modification time changes or when the registry is cleared.
+    """
+
+    def __init__(self, paths=None, interval=5):
+        self.paths = list(paths or [])
+        self.interval = interval
+        self._cache = {}
+        self._names = {}
+        self._combined = None
+
+    def add_path(self, path):
+        if path and path not in self.paths:
+            self.paths.append(path)
+            self.clear()
+
+    def clear(self):
+        self._cache = {}
+        self._names = {}
+        self._combined = None
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def _find(self, name):
+        for root in self.paths:
+            path = '%s.json' % os.path.join(root, name)
+            if os.path.isfile(path):
+                return path
+
+    def load(self, name):
+        path = self._find(name)
+        if not path:
+            log.err('No schema found for: %s' % name)
+            return Schema(name)
+        mtime = self._mtime(path)
+        try:
+            with open(path) as f:
+                return Schema(name, path, mtime, json.loads(f.read()))
+        except Exception, error:
+            log.err('Unable to parse schema: %s (%s)' % (path, error))
+            return Schema(name, path, mtime)
+
+    def get(self, name):
+        schema = self._cache.get(name)
+        now = time.time()
+        if schema is not None:
+            if schema.checked + self.interval > now:
+                return schema
+            # A missing schema is looked up again, a found one is only reloaded
+            # if its file has changed
+            if schema.path and self._mtime(schema.path) == schema.mtime:
+                schema.checked = now
+                return schema
+        schema = self._cache[name] = self.load(name)
+        return schema
+
+    def types(self, name):
+        """Return the special field types declared by a schema, or None if no
+        schema with that name exists."""
+        return self.get(name).types
+
+    def names(self, prefix=''):
+        """Return the names of the schemas that start with prefix, the
+        directories are listed at most every ``interval`` seconds."""
+        checked, names = self._names.get(prefix, (None, None))
+        now = time.time()
+        if checked is not None and checked + self.interval > now:
+            return names
+        found = set()
+        for root in self.paths:
+            try:
+                files = os.listdir(root)
+            except OSError:
+                continue
+            found.update([f[:-5] for f in files if f.startswith(prefix) and f.endswith('.json')])
+        names = sorted(found)
+        self._names[prefix] = (now, names)
+        return names
+
+    def combined_types(self, names):
+        """Return the special field types declared by any of the schemas,
+        fields declared with different types are left out."""
+        schemas = [self.get(name) for name in names]
+        key = [(schema.name, schema.path, schema.mtime) for schema in schemas]
+        if self._combined is not None and self._combined[0] == key:
+            return self._combined[1]
+        types = {}
+        conflicts = set()
+        for schema in schemas:
+            for field, kind in (schema.types or {}).items():
+                if types.setdefault(field, kind) != kind:
+                    conflicts.add(field)
+        for field in conflicts:
+            del types[field]
+        self._combined = (key, types)
+        return types
+
+    def validate(self, name, data):
+        """Validate data against a schema, data is valid if no schema with
+        that name exists."""
+        validate = self.get(name).validate
+        if validate:
+            validate(data)
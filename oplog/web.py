@@ -6,12 +6,24 @@
 import httplib
 import os
 import sys
+import time
+from twisted.internet import task
 from twisted.python import log
+from huck import http
 from huck import mail
 from huck import web
 from huck.web import HTTPError as Error
+from huck.web import asynchronous
 from huck.web import authenticated
 from oplog import api
+from oplog import archive
+from oplog import cache
+from oplog import hub
+from oplog import index
+from oplog import metrics
+from oplog import partition
+from oplog import query
+from oplog import search
 
 class Handler(web.RequestHandler):
 
@@ -22,6 +34,10 @@ class Handler(web.RequestHandler):
     def mongo(self):
         return self.application.mongo[self.settings.mongo.database]
 
+    @property
+    def mongo_read(self):
+        return self.application.mongo.database(self.settings.mongo.database, read=True)
+
     def prepare(self):
         self._message_type = ''
         self._message_text = ''
@@ -82,7 +98,7 @@ class Handler(web.RequestHandler):
         else:
             app = self.request.get('app', None)
             key = self.request.get('key', None)
-            if app and key and self.settings.general.profile(app, key):
+            if app and key and self.settings.general.profile.valid(app, key):
                 return '[%s]' % app
             else:
                 return None
@@ -101,9 +117,28 @@ class Handler(web.RequestHandler):
         message = mail.Message(self.settings.email.from_address, to, subject, message)
         return mail.sendmail(mailconf, message)
 
+class Server(http.Server):
+
+    def connectionMade(self):
+        http.Server.connectionMade(self)
+        self.factory.connections.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        http.Server.connectionLost(self, reason)
+
+def ensure_partition(db, name):
+    """Create the entry indexes (and the search index) on a partition."""
+    d = index.ensure(db, {name: api.Handler.indexes['entry']})
+    if api.Handler.search_fields:
+        d.addCallback(lambda result: search.ensure(db, api.Handler.search_fields,
+            Handler.settings.search.language, collection=name))
+    return d
+
 class Application(web.Application):
 
     mongo = None
+    protocol = Server
 
     def __init__(self, route, settings):
         root_path = os.path.dirname(os.path.realpath(__file__))
@@ -120,6 +155,35 @@ class Application(web.Application):
         route.append((r'/static/(.*)', web.StaticFileHandler, {'path': setup['template_path']}))
 
         Handler.settings = settings
-        api.Handler._schema_list.append(settings.general.schema)
+        api.Handler.schema.interval = settings.general.schema_interval
+        api.Handler.schema.add_path(settings.general.schema)
+        api.Handler.indexes = index.configured(settings)
+        api.Handler.search_fields = search.fields(settings.search.fields)
+        api.Handler.slow_log = query.SlowLog(settings.query.slow_log, settings.query.slow_time)
+        api.Handler.result_cache = cache.Cache(settings.cache.size, settings.cache.ttl)
+        api.Handler.feed = hub.Hub(settings.stream.buffer)
+        api.Handler.metrics = metrics.Registry(settings.metrics.enabled)
+        api.Handler.partitions = partition.Router(
+            settings.partition.interval,
+            settings.partition.refresh,
+            created=ensure_partition if settings.index.ensure else None,
+        )
+        api.Handler.archive = archive.Archive(settings.archive.path or None)
+
+        self.connections = set()
 
         web.Application.__init__(self, route, **setup)
+
+    def drain(self, timeout):
+        """Close idle connections and wait up to timeout seconds for the
+        requests in progress to finish."""
+        for connection in list(self.connections):
+            connection.no_keep_alive = True
+            if connection._request is None:
+                connection.transport.loseConnection()
+        deadline = time.time() + timeout
+        def check():
+            if not self.connections or time.time() >= deadline:
+                loop.stop()
+        loop = task.LoopingCall(check)
+        return loop.start(0.1)
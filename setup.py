@@ -8,4 +8,5 @@ setup(
     url='https://github.com/shutterstock/oplog',
     author='Silas Sewell',
     author_email='silas@shutterstock.com',
+    scripts=['bin/oplog-admin', 'bin/oplog-benchmark'],
 )